@@ -1,6 +1,19 @@
-from flask import Flask, request, render_template
+import os
+
+from flask import Flask, request, render_template, url_for
+
+from scan_service import ScanQueueFull, ScanService
 
 app = Flask(__name__)
+# 上传的 apk 大小上限
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('SCAN_MAX_UPLOAD', 512 << 20))
+
+scan_service = ScanService(
+    os.environ.get('SCAN_WORK_DIR', 'scan_jobs'),
+    workers=int(os.environ.get('SCAN_WORKERS', 0)) or None,
+    max_pending=int(os.environ.get('SCAN_MAX_PENDING', 0)) or None,
+    result_ttl=int(os.environ.get('SCAN_RESULT_TTL', 3600)),
+)
 
 class User:
     def __init__(self,username):
@@ -30,5 +43,31 @@ def filter():
     return render_template('filter.html',user=user)
 
 
+@app.route('/scan', methods=['POST'])
+def scan():
+    """上传 apk，立即返回任务编号，通过 /scan/<job_id> 查询结果"""
+    apk = request.files.get('apk')
+    if apk is None or not apk.filename:
+        return {'error': '缺少 apk 文件'}, 400
+    try:
+        job, created = scan_service.submit(apk.stream)
+    except ScanQueueFull as e:
+        return {'error': str(e)}, 503, {'Retry-After': '30'}
+    status_url = url_for('scan_status', job_id=job.job_id)
+    # 相同的 apk 已有结果时直接返回 200，新任务或正在分析的任务返回 202
+    status_code = 200 if job.finished is not None else 202
+    return {'job_id': job.job_id, 'sha256': job.sha256, 'status': job.status, 'created': created,
+            'url': status_url}, status_code, {'Location': status_url}
+
+
+@app.route('/scan/<job_id>')
+def scan_status(job_id):
+    job = scan_service.get(job_id)
+    if job is None:
+        return {'error': '任务不存在'}, 404
+    return job.to_dict()
+
+
 if __name__ == '__main__':
-    app.run()
+    # 每个请求一个线程，分析在 scan_service 的进程池中进行
+    app.run(threaded=True)
@@ -0,0 +1,3 @@
+"""
+解析 → AST → 向量 热路径的基准测试
+"""
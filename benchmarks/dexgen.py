@@ -0,0 +1,373 @@
+"""
+最小 dex 文件生成器，用于构造基准测试与单元测试所需的 dex 样本
+只写入 androguard 解析方法和指令所需的部分：常量池、类定义、class_data 和 code_item，
+没有调试信息、注解和 try/catch；字符串按 UTF-8 写入，只应使用 ASCII 字符串
+"""
+import hashlib
+import struct
+import zlib
+
+NO_INDEX = 0xffffffff
+
+ACC_PUBLIC = 0x1
+ACC_STATIC = 0x8
+ACC_CONSTRUCTOR = 0x10000
+
+
+def _uleb128(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _mutf8(s):
+    return s.encode('utf-8')
+
+
+def _shorty(desc):
+    if desc[0] in 'L[':
+        return 'L'
+    return desc[0]
+
+
+def _split_params(params_desc):
+    params = []
+    i = 0
+    while i < len(params_desc):
+        start = i
+        while params_desc[i] == '[':
+            i += 1
+        if params_desc[i] == 'L':
+            i = params_desc.index(';', i) + 1
+        else:
+            i += 1
+        params.append(params_desc[start:i])
+    return params
+
+
+class _Ref:
+    """延迟解析的常量池引用"""
+
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+
+
+def string(s):
+    return _Ref('string', s)
+
+
+def type_(desc):
+    return _Ref('type', desc)
+
+
+def field(cls, name, desc):
+    return _Ref('field', (cls, name, desc))
+
+
+def method(cls, name, desc):
+    return _Ref('method', (cls, name, desc))
+
+
+# ---------------------------------------------------------------------------
+# 指令编码，返回 16 位代码单元列表（可包含 _Ref 待解析）
+# ---------------------------------------------------------------------------
+
+def op_10x(op):
+    return [op]
+
+
+def op_11x(op, a):
+    return [(a << 8) | op]
+
+
+def op_11n(op, a, b):
+    return [((b & 0xf) << 12) | (a << 8) | op]
+
+
+def op_12x(op, a, b):
+    return [(b << 12) | (a << 8) | op]
+
+
+def op_21c(op, a, ref):
+    return [(a << 8) | op, ref]
+
+
+def op_21t(op, a, offset):
+    return [(a << 8) | op, offset & 0xffff]
+
+
+def op_22c(op, a, b, ref):
+    return [(b << 12) | (a << 8) | op, ref]
+
+
+def op_22t(op, a, b, offset):
+    return [(b << 12) | (a << 8) | op, offset & 0xffff]
+
+
+def op_22b(op, a, b, lit):
+    return [(a << 8) | op, ((lit & 0xff) << 8) | b]
+
+
+def op_23x(op, a, b, c):
+    return [(a << 8) | op, (c << 8) | b]
+
+
+def invoke(op, ref, regs):
+    """35c 格式的调用指令，regs 最多 5 个寄存器"""
+    regs = list(regs)
+    padded = regs + [0] * (5 - len(regs))
+    c, d, e, f, g = padded
+    return [(len(regs) << 12) | (g << 8) | op, ref, (f << 12) | (e << 8) | (d << 4) | c]
+
+
+def invoke_range(op, ref, first, count):
+    """3rc 格式的调用指令，使用从 first 开始的 count 个连续寄存器"""
+    return [(count << 8) | op, ref, first]
+
+
+class DexBuilder:
+    """按类、方法、代码的描述构造 dex 字节"""
+
+    def __init__(self):
+        self.classes = []
+
+    def add_class(self, name, superclass='Ljava/lang/Object;', access=ACC_PUBLIC,
+                  instance_fields=(), static_fields=()):
+        cls = {
+            'name': name, 'super': superclass, 'access': access,
+            'ifields': list(instance_fields), 'sfields': list(static_fields),
+            'methods': [],
+        }
+        self.classes.append(cls)
+        return cls
+
+    @staticmethod
+    def add_method(cls, name, desc, insns, registers, ins, outs=0, access=ACC_PUBLIC):
+        cls['methods'].append({
+            'name': name, 'desc': desc, 'insns': insns,
+            'registers': registers, 'ins': ins, 'outs': outs, 'access': access,
+        })
+
+    # -- 常量池收集 --------------------------------------------------------
+
+    def _collect(self):
+        strings, types, protos, fields, methods = set(), set(), set(), set(), set()
+
+        def add_type(desc):
+            types.add(desc)
+            strings.add(desc)
+
+        def add_proto(desc):
+            params_desc, ret = desc[1:].split(')')
+            params = tuple(_split_params(params_desc))
+            add_type(ret)
+            for p in params:
+                add_type(p)
+            shorty = _shorty(ret) + ''.join(_shorty(p) for p in params)
+            strings.add(shorty)
+            protos.add((shorty, ret, params))
+
+        def add_ref(ref):
+            if ref.kind == 'string':
+                strings.add(ref.key)
+            elif ref.kind == 'type':
+                add_type(ref.key)
+            elif ref.kind == 'field':
+                cls, name, desc = ref.key
+                add_type(cls)
+                add_type(desc)
+                strings.add(name)
+                fields.add(ref.key)
+            elif ref.kind == 'method':
+                cls, name, desc = ref.key
+                add_type(cls)
+                strings.add(name)
+                add_proto(desc)
+                methods.add(ref.key)
+
+        for cls in self.classes:
+            add_type(cls['name'])
+            if cls['super']:
+                add_type(cls['super'])
+            for name, desc in cls['ifields'] + cls['sfields']:
+                add_ref(field(cls['name'], name, desc))
+            for m in cls['methods']:
+                add_ref(method(cls['name'], m['name'], m['desc']))
+                for unit in m['insns']:
+                    if isinstance(unit, _Ref):
+                        add_ref(unit)
+
+        self.strings = sorted(strings, key=lambda s: s.encode('utf-16-be'))
+        string_idx = {s: i for i, s in enumerate(self.strings)}
+        self.types = sorted(types, key=lambda t: string_idx[t])
+        type_idx = {t: i for i, t in enumerate(self.types)}
+        self.protos = sorted(protos, key=lambda p: (type_idx[p[1]], [type_idx[x] for x in p[2]]))
+        proto_idx = {(p[1], p[2]): i for i, p in enumerate(self.protos)}
+        self.fields = sorted(fields, key=lambda f: (type_idx[f[0]], string_idx[f[1]], type_idx[f[2]]))
+        field_idx = {f: i for i, f in enumerate(self.fields)}
+
+        def proto_of(desc):
+            params_desc, ret = desc[1:].split(')')
+            return proto_idx[(ret, tuple(_split_params(params_desc)))]
+
+        self.methods = sorted(methods, key=lambda m: (type_idx[m[0]], string_idx[m[1]], proto_of(m[2])))
+        method_idx = {m: i for i, m in enumerate(self.methods)}
+        self._index = {
+            'string': string_idx, 'type': type_idx, 'field': field_idx, 'method': method_idx,
+        }
+        self._proto_of = proto_of
+
+    def _resolve(self, ref):
+        return self._index[ref.kind][ref.key]
+
+    # -- 序列化 -------------------------------------------------------------
+
+    def build(self):
+        self._collect()
+        header_size = 0x70
+        off = header_size
+        string_ids_off = off
+        off += 4 * len(self.strings)
+        type_ids_off = off
+        off += 4 * len(self.types)
+        proto_ids_off = off
+        off += 12 * len(self.protos)
+        field_ids_off = off
+        off += 8 * len(self.fields)
+        method_ids_off = off
+        off += 8 * len(self.methods)
+        class_defs_off = off
+        off += 32 * len(self.classes)
+        data_off = off
+
+        data = bytearray()
+
+        def align(n):
+            while (data_off + len(data)) % n:
+                data.append(0)
+
+        # code_item
+        code_offs = {}
+        align(4)
+        code_start = data_off + len(data)
+        code_count = 0
+        for cls in self.classes:
+            for m in cls['methods']:
+                if m['insns'] is None:
+                    continue
+                align(4)
+                code_offs[(cls['name'], m['name'], m['desc'])] = data_off + len(data)
+                units = [self._resolve(u) if isinstance(u, _Ref) else u for u in m['insns']]
+                data += struct.pack('<HHHHII', m['registers'], m['ins'], m['outs'], 0, 0, len(units))
+                data += struct.pack(f'<{len(units)}H', *units)
+                code_count += 1
+
+        # type_list
+        align(4)
+        typelist_offs = {}
+        typelist_start = data_off + len(data)
+        for shorty, ret, params in self.protos:
+            if params and params not in typelist_offs:
+                align(4)
+                typelist_offs[params] = data_off + len(data)
+                data += struct.pack('<I', len(params))
+                data += struct.pack(f'<{len(params)}H', *[self._index['type'][p] for p in params])
+
+        # string_data
+        string_data_start = data_off + len(data)
+        string_offs = []
+        for s in self.strings:
+            string_offs.append(data_off + len(data))
+            data += _uleb128(len(s.encode('utf-16-le')) // 2) + _mutf8(s) + b'\x00'
+
+        # class_data
+        class_data_start = data_off + len(data)
+        class_data_offs = []
+        for cls in self.classes:
+            class_data_offs.append(data_off + len(data))
+            sfields = sorted(self._resolve(field(cls['name'], n, d)) for n, d in cls['sfields'])
+            ifields = sorted(self._resolve(field(cls['name'], n, d)) for n, d in cls['ifields'])
+            direct, virtual = [], []
+            for m in cls['methods']:
+                idx = self._resolve(method(cls['name'], m['name'], m['desc']))
+                entry = (idx, m['access'], code_offs.get((cls['name'], m['name'], m['desc']), 0))
+                if m['access'] & (ACC_STATIC | ACC_CONSTRUCTOR) or m['name'] == '<init>':
+                    direct.append(entry)
+                else:
+                    virtual.append(entry)
+            direct.sort()
+            virtual.sort()
+            data += _uleb128(len(sfields)) + _uleb128(len(ifields))
+            data += _uleb128(len(direct)) + _uleb128(len(virtual))
+            for group in (sfields, ifields):
+                prev = 0
+                for idx in group:
+                    data += _uleb128(idx - prev) + _uleb128(ACC_PUBLIC)
+                    prev = idx
+            for group in (direct, virtual):
+                prev = 0
+                for idx, access, code_off in group:
+                    data += _uleb128(idx - prev) + _uleb128(access) + _uleb128(code_off)
+                    prev = idx
+
+        # map_list
+        align(4)
+        map_off = data_off + len(data)
+        items = [
+            (0x0000, 1, 0),
+            (0x0001, len(self.strings), string_ids_off),
+            (0x0002, len(self.types), type_ids_off),
+            (0x0003, len(self.protos), proto_ids_off),
+            (0x0004, len(self.fields), field_ids_off),
+            (0x0005, len(self.methods), method_ids_off),
+            (0x0006, len(self.classes), class_defs_off),
+            (0x2001, code_count, code_start),
+            (0x1001, len(typelist_offs), typelist_start),
+            (0x2002, len(self.strings), string_data_start),
+            (0x2000, len(self.classes), class_data_start),
+            (0x1000, 1, map_off),
+        ]
+        items = [i for i in items if i[1]]
+        data += struct.pack('<I', len(items))
+        for kind, size, offset in items:
+            data += struct.pack('<HHII', kind, 0, size, offset)
+
+        body = bytearray()
+        for o in string_offs:
+            body += struct.pack('<I', o)
+        for t in self.types:
+            body += struct.pack('<I', self._index['string'][t])
+        for shorty, ret, params in self.protos:
+            body += struct.pack('<III', self._index['string'][shorty], self._index['type'][ret],
+                                typelist_offs.get(params, 0))
+        for cls_name, name, desc in self.fields:
+            body += struct.pack('<HHI', self._index['type'][cls_name], self._index['type'][desc],
+                                self._index['string'][name])
+        for cls_name, name, desc in self.methods:
+            body += struct.pack('<HHI', self._index['type'][cls_name], self._proto_of(desc),
+                                self._index['string'][name])
+        for cls, cd_off in zip(self.classes, class_data_offs):
+            body += struct.pack('<IIIIIIII', self._index['type'][cls['name']], cls['access'],
+                                self._index['type'][cls['super']] if cls['super'] else NO_INDEX,
+                                0, NO_INDEX, 0, cd_off, 0)
+
+        file_size = header_size + len(body) + len(data)
+        header = bytearray(b'dex\n035\x00')
+        header += b'\x00' * 4 + b'\x00' * 20
+        header += struct.pack('<IIIIII', file_size, header_size, 0x12345678, 0, 0, map_off)
+        for size, offset in ((len(self.strings), string_ids_off), (len(self.types), type_ids_off),
+                             (len(self.protos), proto_ids_off), (len(self.fields), field_ids_off),
+                             (len(self.methods), method_ids_off), (len(self.classes), class_defs_off)):
+            header += struct.pack('<II', size, offset if size else 0)
+        header += struct.pack('<II', len(data), data_off)
+        raw = bytearray(header + body + data)
+        raw[12:32] = hashlib.sha1(raw[32:]).digest()
+        raw[8:12] = struct.pack('<I', zlib.adler32(bytes(raw[12:])))
+        return bytes(raw)
@@ -0,0 +1,320 @@
+"""
+运行基准测试并保存为 JSON，或与之前的结果比较
+    python -m benchmarks.run -o results.json                 运行全部基准测试
+    python -m benchmarks.run --only convert_method ast_tokenizer
+    python -m benchmarks.run --compare baseline.json           运行后与 baseline.json 比较
+    python -m benchmarks.run --compare baseline.json new.json  只比较两个结果文件
+每项基准测试报告每个元素（描述符、指令、方法、文档）的耗时，比较时使用各轮的中位数，
+变慢超过阈值的项记为回归，命令以状态码 1 退出。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+from sys import stdout
+
+import androguard
+import gensim
+from androguard.core.bytecodes.dvm import DalvikVMFormat
+from loguru import logger
+
+from benchmarks.synthetic import FIXTURES, fixture_path
+from code_parse import handler
+from code_parse.ast2vec import ast_tokenizer, ast_tokens, load_model, train_model, write_corpus_file
+from code_parse.node2ast import convert_method
+
+RESULT_VERSION = 1
+# 没有训练好的模型时在样本上训练一个，参数与 ast2vec 的训练参数相同
+FIXTURE_MODEL_ARGS = {'vector_size': 200, 'window': 5, 'min_count': 1, 'epochs': 50}
+
+
+def load_methods(dex_path):
+    """
+    解析样本中的方法
+    :return: 有代码的 EncodedMethod 列表
+    """
+    with open(dex_path, 'rb') as f:
+        dex = DalvikVMFormat(f.read())
+    methods = []
+    for method in dex.get_methods():
+        # get_code 会加载方法，之后 get_instructions 才有结果
+        if method.get_code() is not None:
+            methods.append(method)
+    return methods
+
+
+def _is_static(method):
+    return 'static' in method.get_access_flags_string().split(' ')
+
+
+def bench_parse_method_descriptor(context):
+    descriptors = [method.get_descriptor() for method in context['methods']]
+
+    def run():
+        for descriptor in descriptors:
+            handler.parse_method_descriptor(descriptor)
+    return run, len(descriptors)
+
+
+def bench_parse_method_descriptor_uncached(context):
+    """不经过缓存的解析，与 parse_method_descriptor 比较得到缓存节省的时间"""
+    descriptors = [method.get_descriptor() for method in context['methods']]
+    parse = handler.parse_method_descriptor.__wrapped__
+
+    def run():
+        for descriptor in descriptors:
+            parse(descriptor)
+    return run, len(descriptors)
+
+
+def bench_dispatch_instruction(context):
+    instructions = []
+    for method in context['methods']:
+        registers = dict(handler.parse_parameters(method, _is_static(method)))
+        instructions += [(ins.get_name(), ins, registers) for ins in method.get_instructions()]
+
+    def run():
+        for op, ins, registers in instructions:
+            handler.dispatch_instruction(op, ins, registers)
+    return run, len(instructions)
+
+
+def bench_build_body(context):
+    methods = [(method, _is_static(method)) for method in context['methods']]
+
+    def run():
+        for method, is_static in methods:
+            handler.build_body(method, is_static)
+    return run, len(methods)
+
+
+def bench_convert_method(context):
+    methods = context['methods']
+
+    def run():
+        for method in methods:
+            convert_method(method)
+    return run, len(methods)
+
+
+def bench_ast_tokenizer(context):
+    asts = context['asts']
+
+    # 旧路径的 str(ast) 也计入，与 bench_ast_tokens 处理同样的输入
+    def run():
+        for ast in asts:
+            ast_tokenizer(str(ast))
+    return run, len(asts)
+
+
+def bench_ast_tokens(context):
+    asts = context['asts']
+
+    def run():
+        for ast in asts:
+            ast_tokens(ast)
+    return run, len(asts)
+
+
+def bench_infer_vector(context):
+    model = context['model']
+    token_lists = [ast_tokens(ast) for ast in context['asts']]
+
+    def run():
+        for tokens in token_lists:
+            model.infer_vector(tokens)
+    return run, len(token_lists)
+
+
+def bench_dex2feature(context):
+    import feature_fusion
+    from code_parse.feature import AstFeatureClass
+    # 使用局部实例，只在调用期间替换 feature_fusion 使用的 AstFeature，不修改全局的模型和缓存
+    feature = AstFeatureClass()
+    feature.model = context['model']
+    dex_path = context['dex_path']
+
+    def run():
+        saved, feature_fusion.AstFeature = feature_fusion.AstFeature, feature
+        try:
+            return feature_fusion.dex2feature(dex_path)
+        finally:
+            feature_fusion.AstFeature = saved
+    return run, len(run())
+
+
+# 名称 -> 准备函数，准备函数返回 (每轮调用的函数, 每次调用处理的元素数)
+BENCHMARKS = {
+    'parse_method_descriptor': bench_parse_method_descriptor,
+    'parse_method_descriptor_uncached': bench_parse_method_descriptor_uncached,
+    'dispatch_instruction': bench_dispatch_instruction,
+    'build_body': bench_build_body,
+    'convert_method': bench_convert_method,
+    'ast_tokenizer': bench_ast_tokenizer,
+    'ast_tokens': bench_ast_tokens,
+    'infer_vector': bench_infer_vector,
+    'dex2feature': bench_dex2feature,
+}
+_MODEL_BENCHMARKS = ('infer_vector', 'dex2feature')
+
+
+def _fixture_model(asts, work_dir):
+    """在样本的AST上训练模型，只用于测量推理耗时"""
+    corpus_path = os.path.join(work_dir, 'corpus.txt')
+    write_corpus_file((ast_tokens(ast) for ast in asts), corpus_path)
+    return train_model(corpus_path, workers=1, **FIXTURE_MODEL_ARGS)
+
+
+def measure(func, items, rounds):
+    """
+    先用 timeit 的 autorange 确定每轮调用次数，使每轮至少 0.2 秒，再测量 rounds 轮
+    :return: 结果字典，时间单位为秒
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [elapsed / number for elapsed in timer.repeat(rounds, number)]
+    median = statistics.median(times)
+    return {
+        'items': items,
+        'number': number,
+        'rounds': times,
+        'best': min(times),
+        'median': median,
+        'per_item_us': median / items * 1e6 if items else None,
+        'items_per_second': items / median if median else None,
+    }
+
+
+def _format(value, width, precision=2, percent=False):
+    """元素数为 0 时没有每元素耗时，显示为 n/a"""
+    if value is None:
+        return f'{"n/a":>{width}}'
+    return f'{value:>+{width}.{precision}%}' if percent else f'{value:>{width}.{precision}f}'
+
+
+def run_benchmarks(fixture='medium', names=None, rounds=5, model_path=None):
+    """
+    :param fixture: 样本名，见 synthetic.FIXTURES
+    :param names: 要运行的基准测试，为 None 时全部运行
+    :param rounds: 每项测量的轮数
+    :param model_path: ast2vec 模型路径，为 None 时在样本上训练一个临时模型
+    :return: 可以保存为 JSON 的结果
+    """
+    names = list(names or BENCHMARKS)
+    dex_path = fixture_path(fixture)
+    methods = load_methods(dex_path)
+    context = {'dex_path': dex_path, 'methods': methods, 'asts': [convert_method(method) for method in methods]}
+    model_name = None
+    with tempfile.TemporaryDirectory() as work_dir:
+        if any(name in _MODEL_BENCHMARKS for name in names):
+            if model_path is not None:
+                context['model'] = load_model(model_path)
+                model_name = os.path.abspath(model_path)
+            else:
+                context['model'] = _fixture_model(context['asts'], work_dir)
+                model_name = f'fixture:{fixture}:' + ','.join(f'{k}={v}' for k, v in FIXTURE_MODEL_ARGS.items())
+
+        results = {}
+        for name in names:
+            func, items = BENCHMARKS[name](context)
+            results[name] = measure(func, items, rounds)
+            logger.info(f'{name:24}{_format(results[name]["per_item_us"], 12)} us/item'
+                        f'{_format(results[name]["items_per_second"], 14, 0)} items/s')
+
+    return {
+        'version': RESULT_VERSION,
+        'meta': {
+            'fixture': fixture,
+            'fixture_args': FIXTURES[fixture],
+            'model': model_name,
+            'python': platform.python_version(),
+            'androguard': androguard.__version__,
+            'gensim': gensim.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'benchmarks': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    比较两次结果中同名基准测试的每元素耗时中位数
+    :param baseline: 基准结果
+    :param current: 当前结果
+    :param threshold: 变慢超过该比例记为回归
+    :return: [(名称, 基准 us, 当前 us, 变化比例, 是否回归)]，任一方没有每元素耗时的项变化比例为 None，不记为回归
+    """
+    models = {baseline['meta'].get('model'), current['meta'].get('model')} - {None}
+    if baseline['meta'].get('fixture') != current['meta'].get('fixture') or len(models) > 1:
+        logger.warning('两次结果的样本或模型不同，比较结果仅供参考')
+    rows = []
+    for name, result in current['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        if result['per_item_us'] is None or base['per_item_us'] is None:
+            rows.append((name, base['per_item_us'], result['per_item_us'], None, False))
+            continue
+        change = result['per_item_us'] / base['per_item_us'] - 1
+        rows.append((name, base['per_item_us'], result['per_item_us'], change, change > threshold))
+    return rows
+
+
+def print_comparison(rows):
+    logger.info(f'{"":24}{"baseline us":>14}{"current us":>14}{"change":>10}')
+    for name, base, current, change, regression in rows:
+        log = logger.warning if regression else logger.info
+        log(f'{name:24}{_format(base, 14)}{_format(current, 14)}{_format(change, 10, 1, percent=True)}'
+            + ('  REGRESSION' if regression else ''))
+
+
+def _load(path):
+    with open(path, encoding='utf-8') as f:
+        result = json.load(f)
+    if result.get('version') != RESULT_VERSION:
+        raise ValueError(f'{path}: 结果文件版本不一致')
+    return result
+
+
+def main(argv=None):
+    logger.remove(0)
+    logger.add(stdout, colorize=True, level='INFO')
+    parser = argparse.ArgumentParser(description='解析 → AST → 向量 热路径的基准测试')
+    parser.add_argument('current', nargs='?', help='与 --compare 一起使用：已有的结果文件，不再重新运行')
+    parser.add_argument('--fixture', default='medium', choices=sorted(FIXTURES))
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='只运行这些基准测试')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--model', help='ast2vec 模型路径，默认在样本上训练临时模型')
+    parser.add_argument('-o', '--output', help='结果保存路径')
+    parser.add_argument('--compare', metavar='BASELINE', help='与该结果文件比较')
+    parser.add_argument('--threshold', type=float, default=0.1, help='变慢超过该比例记为回归')
+    args = parser.parse_args(argv)
+
+    if args.current is not None:
+        if args.compare is None:
+            parser.error('指定结果文件时需要 --compare')
+        current = _load(args.current)
+    else:
+        current = run_benchmarks(args.fixture, args.only, args.rounds, args.model)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(current, f, indent=2)
+            logger.info(f'结果已保存到 {args.output}')
+
+    if args.compare is not None:
+        rows = compare(_load(args.compare), current, args.threshold)
+        print_comparison(rows)
+        if any(regression for *_, regression in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+合成指令生成器
+按固定的随机种子生成覆盖 handler 各个处理函数的指令序列（返回、运算、调用、字段和数组访问、
+比较跳转、类型转换、对象创建），以及 handler 不处理的 const、move、sget、check-cast 等指令，打包成dex。
+同样的参数总是生成同样的字节，checked-in 的样本可以随时重新生成。
+"""
+import os
+import random
+import sys
+
+from benchmarks.dexgen import (ACC_PUBLIC, ACC_STATIC, DexBuilder, field, invoke, invoke_range, method,
+                               op_10x, op_11n, op_11x, op_12x, op_21c, op_21t, op_22b, op_22c, op_22t, op_23x,
+                               string, type_)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# 样本名 -> build_dex 的参数
+FIXTURES = {
+    'small': {'classes': 2, 'methods': 6, 'instructions': 60, 'seed': 1},
+    'medium': {'classes': 6, 'methods': 16, 'instructions': 120, 'seed': 2},
+}
+
+_DESCRIPTORS = ('(I)I', '(IJLjava/lang/String;[I)V', '()V', '(DZ[[Ljava/lang/Object;)J')
+
+
+def random_instruction(rng, class_name, class_names):
+    """
+    生成一条随机指令
+    :param rng: random.Random
+    :param class_name: 当前类，字段访问和调用以它为主
+    :param class_names: dex 中所有类，用于跨类调用
+    :return: 16 位代码单元列表，常量池引用由 DexBuilder 解析
+    """
+    kind = rng.randrange(20)
+    r4 = lambda: rng.randrange(16)
+    r8 = lambda: rng.randrange(256)
+    if kind == 0:
+        # return-void / return / return-wide / return-object
+        return rng.choice([op_10x(0x0e), op_11x(rng.choice([0x0f, 0x10, 0x11]), r8())])
+    if kind == 1:
+        # int-to-long ... double-to-float
+        return op_12x(rng.randrange(0x81, 0x90), r4(), r4())
+    if kind == 2:
+        count = rng.randrange(6)
+        target = rng.choice([
+            method(rng.choice(class_names), 'helper', '(' + 'I' * max(0, count - 1) + ')V'),
+            method('Ljava/lang/Object;', 'toString', '()Ljava/lang/String;'),
+            method('[Ljava/lang/Object;', 'clone', '()Ljava/lang/Object;'),
+        ])
+        return invoke(rng.randrange(0x6e, 0x73), target, [r4() for _ in range(count)])
+    if kind == 3:
+        return invoke_range(rng.randrange(0x74, 0x79), method(class_name, 'helper', '(I)V'),
+                            rng.randrange(300), rng.choice([0, 1, 1, 2, 5]))
+    if kind == 4:
+        target = rng.choice([field(class_name, 'count', 'I'), field(class_name, 'name', 'Ljava/lang/String;'),
+                             field('Lother/Pkg;', 'arr', '[J')])
+        # iget / iput
+        return op_22c(rng.randrange(0x52, 0x60), r4(), r4(), target)
+    if kind == 5:
+        # aget / aput
+        return op_23x(rng.randrange(0x44, 0x52), r8(), r8(), r8())
+    if kind == 6:
+        # 三地址运算
+        return op_23x(rng.randrange(0x90, 0xb0), r8(), r8(), r8())
+    if kind == 7:
+        # 二地址运算
+        return op_12x(rng.randrange(0xb0, 0xd0), r4(), r4())
+    if kind == 8:
+        literal = rng.choice([0, 1, 7, -1, -128, 32767, -32768, rng.randrange(-32768, 32768)])
+        # lit16 运算
+        return [(r4() << 12) | (r4() << 8) | rng.randrange(0xd0, 0xd8), literal & 0xffff]
+    if kind == 9:
+        # lit8 运算
+        return op_22b(rng.randrange(0xd8, 0xe3), r8(), r8(), rng.randrange(-128, 128))
+    if kind == 10:
+        return op_22t(rng.randrange(0x32, 0x38), r4(), r4(), rng.randrange(-40, 40))
+    if kind == 11:
+        return op_21t(rng.randrange(0x38, 0x3e), r8(), rng.choice([rng.randrange(-300, 300), 16, -16, 0x7fff]))
+    if kind == 12:
+        return op_21c(0x22, r8(), type_(rng.choice(['Ljava/lang/StringBuilder;', 'Lcom/a/B$Inner;'])))
+    if kind == 13:
+        return op_22c(0x23, r4(), r4(), type_(rng.choice(['[I', '[Ljava/lang/String;'])))
+    # 以下是 handler 不处理的指令
+    if kind == 14:
+        return op_11n(0x12, r4(), rng.randrange(-8, 8))
+    if kind == 15:
+        return op_21c(0x60, r8(), field('Lother/Pkg;', 'S', 'Ljava/lang/Object;'))
+    if kind == 16:
+        return op_21c(0x1a, r8(), string(rng.choice(['hi', 'a, b', '"q"', 'x\ny'])))
+    if kind == 17:
+        # move / neg-int / not-long / neg-long
+        return op_12x(rng.choice([0x01, 0x7b, 0x7c, 0x7d]), r4(), r4())
+    if kind == 18:
+        return op_21c(0x1f, r8(), type_('Ljava/lang/String;'))
+    # monitor-exit
+    return op_11x(0x1d, r8())
+
+
+def build_dex(classes=4, methods=16, instructions=100, seed=1):
+    """
+    生成合成dex
+    :param classes: 类数
+    :param methods: 每个类的方法数，另外每个类还有一个 helper 方法
+    :param instructions: 每个方法的指令数
+    :param seed: 随机种子
+    :return: dex 文件内容
+    """
+    rng = random.Random(seed)
+    builder = DexBuilder()
+    class_names = [f'Lcom/bench/pkg{i % 3}/C{i};' for i in range(classes)]
+    for class_name in class_names:
+        cls = builder.add_class(class_name, instance_fields=[('count', 'I'), ('name', 'Ljava/lang/String;')])
+        for i in range(methods):
+            units = []
+            for _ in range(instructions):
+                units += random_instruction(rng, class_name, class_names)
+            builder.add_method(cls, f'm{i}', rng.choice(_DESCRIPTORS), units, registers=256, ins=4, outs=5,
+                               access=rng.choice([ACC_PUBLIC, ACC_PUBLIC | ACC_STATIC]))
+        builder.add_method(cls, 'helper', '(I)V', op_10x(0x0e), registers=1, ins=1, access=ACC_PUBLIC | ACC_STATIC)
+    return builder.build()
+
+
+def fixture_path(name):
+    return os.path.join(FIXTURES_DIR, f'{name}.dex')
+
+
+def golden_ast_path(name):
+    """
+    样本的 AST 基准，每行一个方法，按 (类名, 方法名, 描述符) 排序
+    由重写 handler 之前的 dex_to_ast 生成，AST 的输出必须与之一致，不随 write_fixtures 重新生成
+    """
+    return os.path.join(FIXTURES_DIR, f'{name}.ast.jsonl')
+
+
+def write_fixtures(names=None):
+    """
+    重新生成 checked-in 的样本
+    :param names: 样本名列表，为 None 时全部生成
+    """
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for name in names or FIXTURES:
+        with open(fixture_path(name), 'wb') as f:
+            f.write(build_dex(**FIXTURES[name]))
+
+
+if __name__ == '__main__':
+    write_fixtures(sys.argv[1:])
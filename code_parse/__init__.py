@@ -1,3 +1,10 @@
-from .feature import AstFeature
+from importlib import import_module
 
-__all__ = ['AstFeature']
\ No newline at end of file
+__all__ = ['AstFeature']
+
+
+def __getattr__(name):
+    # 延迟导入 feature，只用 node2ast / handler 的工具不必加载 gensim
+    if name == 'AstFeature':
+        return import_module('.feature', __name__).AstFeature
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,8 +1,19 @@
+import copy
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
 from gensim.models import Doc2Vec
+from gensim.models.callbacks import CallbackAny2Vec
 from gensim.models.doc2vec import TaggedDocument
 import re
 from loguru import logger
 
+from .normalize import normalizer_path
+
 
 def ast_tokenizer(ast_text):
     """
@@ -17,6 +28,157 @@ def ast_tokenizer(ast_text):
     return tokens
 
 
+# 与 ast_tokenizer 相同的切分规则：'[' 和 ']' 单独成词，其余按空白切分
+_TOKEN_PATTERN = re.compile(r'\[|]|[^\[\]\s]+|\s+')
+_SEPARATOR_PATTERN = re.compile(r'[\[\]\s]')
+_CONTAINER_TYPES = (list, tuple, dict)
+# 元素数不少于该值的容器逐个子节点产出词，较小的子树整体写入缓冲区
+_STREAM_MIN_SIZE = 64
+# 字符串常量 repr 的缓存，寄存器名、类型名、节点名在方法之间大量重复
+_REPR_CACHE = {}
+_REPR_CACHE_SIZE = 65536
+
+
+def _emit_text(text, out, pending):
+    """
+    切分含有空白或括号的文本
+    :param text: 文本片段
+    :param out: 已完成的词
+    :param pending: 尚未结束的词，与下一个片段之间没有分隔时会拼在一起
+    :return: 新的 pending
+    """
+    for match in _TOKEN_PATTERN.finditer(text):
+        token = match.group()
+        if token == '[' or token == ']':
+            if pending:
+                out.append(pending)
+                pending = ''
+            out.append(token)
+        elif token.isspace():
+            if pending:
+                out.append(pending)
+                pending = ''
+        else:
+            pending += token
+    return pending
+
+
+def _emit_node(node, out, pending):
+    """按 repr 的顺序把节点切分成词，返回新的 pending"""
+    node_type = type(node)
+    if node_type in _CONTAINER_TYPES:
+        return _emit_container(node, out, pending)
+
+    text = _REPR_CACHE.get(node) if node_type is str else None
+    if text is None:
+        text = repr(node)
+        if _SEPARATOR_PATTERN.search(text) is not None:
+            return _emit_text(text, out, pending)
+        if node_type is str:
+            if len(_REPR_CACHE) >= _REPR_CACHE_SIZE:
+                _REPR_CACHE.clear()
+            _REPR_CACHE[node] = text
+    return pending + text
+
+
+def _open_container(node_type, out, pending):
+    if node_type is list:
+        if pending:
+            out.append(pending)
+        out.append('[')
+        return ''
+    return pending + ('(' if node_type is tuple else '{')
+
+
+def _close_container(node, out, pending):
+    node_type = type(node)
+    if node_type is list:
+        if pending:
+            out.append(pending)
+        out.append(']')
+        return ''
+    if node_type is tuple:
+        return pending + (',)' if len(node) == 1 else ')')
+    return pending + '}'
+
+
+def _emit_container(node, out, pending):
+    node_type = type(node)
+    pending = _open_container(node_type, out, pending)
+    first = True
+    for item in (node.items() if node_type is dict else node):
+        if first:
+            first = False
+        else:
+            out.append(pending + ',')
+            pending = ''
+        if node_type is dict:
+            key, item = item
+            out.append(_emit_node(key, out, pending) + ':')
+            pending = ''
+        pending = _emit_node(item, out, pending)
+    return _close_container(node, out, pending)
+
+
+def _iter_container_tokens(node, pending):
+    """_emit_container 的生成器版本，大容器的子节点切分完即产出"""
+    node_type = type(node)
+    out = []
+    pending = _open_container(node_type, out, pending)
+    first = True
+    for item in (node.items() if node_type is dict else node):
+        if first:
+            first = False
+        else:
+            out.append(pending + ',')
+            pending = ''
+        if node_type is dict:
+            key, item = item
+            out.append(_emit_node(key, out, pending) + ':')
+            pending = ''
+        if type(item) in _CONTAINER_TYPES and len(item) >= _STREAM_MIN_SIZE:
+            yield from out
+            out.clear()
+            pending = yield from _iter_container_tokens(item, pending)
+        else:
+            pending = _emit_node(item, out, pending)
+            if len(out) >= _STREAM_MIN_SIZE:
+                yield from out
+                out.clear()
+    pending = _close_container(node, out, pending)
+    yield from out
+    return pending
+
+
+def iter_ast_tokens(ast):
+    """
+    直接从AST生成分词结果，不再先 str(ast) 拼成整段文本再用正则切分
+    :param ast: convert_method 生成的AST
+    :return: 生成器，产出的词与 ast_tokenizer(str(ast)) 完全相同
+    """
+    if type(ast) not in _CONTAINER_TYPES:
+        yield from ast_tokenizer(str(ast))
+        return
+    pending = yield from _iter_container_tokens(ast, '')
+    if pending:
+        yield pending
+
+
+def ast_tokens(ast):
+    """
+    iter_ast_tokens 的列表版本，infer_vector 需要完整的词列表时使用，省去生成器的开销
+    :param ast: convert_method 生成的AST
+    :return: 与 ast_tokenizer(str(ast)) 相同的词列表
+    """
+    if type(ast) not in _CONTAINER_TYPES:
+        return ast_tokenizer(str(ast))
+    tokens = []
+    pending = _emit_container(ast, tokens, '')
+    if pending:
+        tokens.append(pending)
+    return tokens
+
+
 def prepare_ast_corpus(ast_texts):
     """将AST文本转换为TaggedDocument格式"""
     corpus = []
@@ -26,13 +188,230 @@ def prepare_ast_corpus(ast_texts):
     return corpus
 
 
-def ast_to_vector(ast_text, model):
-    """生成AST向量表示"""
+def load_model(model_path, mmap='r'):
+    """
+    加载 Doc2Vec 模型
+    单独保存的大数组（词向量、syn1neg 等）以只读方式内存映射，
+    多个工作进程加载同一个模型时共享同一份物理内存
+    :param model_path: 模型路径
+    :param mmap: 传给 gensim 的内存映射模式，None 表示完整读入内存
+    :return: Doc2Vec 模型
+    """
+    logger.debug(f'加载模型 {model_path}')
+    return Doc2Vec.load(model_path, mmap=mmap)
+
+
+def ast_to_vector(ast_text, model, normalizer=None):
+    """
+    生成AST向量表示
+    :param normalizer: 训练模型时使用的 normalize.TokenNormalizer，为 None 时不归一化
+    """
     tokens = ast_tokenizer(ast_text)
-    vector = model.infer_vector(tokens)
+    if normalizer is not None:
+        tokens = normalizer(tokens)
+    vector = infer_vectors([tokens], model, workers=1)[0]
     return vector
 
 
+def _document_seed(tokens):
+    return zlib.crc32(' '.join(tokens).encode('utf-8', 'surrogatepass'))
+
+
+def infer_vectors(token_lists, model, workers=None, chunk_size=64):
+    """
+    批量生成向量表示，workers 大于 1 时分块在线程池中推理
+    infer_vector 的负采样使用模型共享的随机数状态，直接调用时结果取决于之前推理过哪些文档和线程的调度顺序；
+    这里每个文档推理前按文档内容重新设置随机数种子，同一文档的结果与批次组成、顺序和线程数无关
+    :param token_lists: 每个方法的分词结果
+    :param model: Doc2Vec 模型
+    :param workers: 线程数，默认为 CPU 核数
+    :param chunk_size: 每个线程任务处理的方法数
+    :return: float32 矩阵，形状为 (len(token_lists), vector_size)，行顺序与输入一致
+    """
+    token_lists = list(token_lists)
+    matrix = np.zeros((len(token_lists), model.vector_size), dtype=np.float32)
+
+    def infer_chunk(start):
+        # 浅拷贝只替换随机数状态，词向量等大数组仍然共享，推理不会修改这些数组
+        local = copy.copy(model)
+        local.random = np.random.RandomState()
+        for i in range(start, min(start + chunk_size, len(token_lists))):
+            local.random.seed(_document_seed(token_lists[i]))
+            matrix[i] = local.infer_vector(token_lists[i])
+
+    starts = range(0, len(token_lists), chunk_size)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(starts) <= 1:
+        for start in starts:
+            infer_chunk(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # 取出结果以便抛出线程中的异常
+            list(executor.map(infer_chunk, starts))
+    return matrix
+
+
+def write_corpus_file(token_lists, corpus_path):
+    """
+    把分词结果写成 gensim corpus_file 模式的语料文件：每行一个文档，词之间用空格分隔，
+    文档的标签为行号。词中不含空白字符，可以直接拼接
+    :param token_lists: 可迭代对象，每项为一个方法的词列表
+    :param corpus_path: 语料文件路径
+    :return: (文档数, 词数)
+    """
+    documents = 0
+    words = 0
+    with open(corpus_path, 'w', encoding='utf-8', errors='backslashreplace') as f:
+        for tokens in token_lists:
+            if not tokens:
+                continue
+            f.write(' '.join(tokens))
+            f.write('\n')
+            documents += 1
+            words += len(tokens)
+    return documents, words
+
+
+def _dex_corpus_lines(args):
+    """
+    在工作进程中把一个dex的全部方法转换为语料文本，无法解析的dex记为错误并跳过
+    :param args: (dex文件路径, dex_cache 目录或 None)
+    :return: (语料文本, 文档数, 词数, 错误数)
+    """
+    dex_path, cache_dir = args
+    # 只做推理时不需要导入 androguard
+    from .node2ast import iter_dex_ast
+    dex_cache = None
+    if cache_dir is not None:
+        from dex_cache import DexCache
+        dex_cache = DexCache(cache_dir)
+    lines = []
+    words = 0
+    try:
+        for ast in iter_dex_ast(dex_path, dex_cache=dex_cache):
+            tokens = ast_tokens(ast)
+            if tokens:
+                lines.append(' '.join(tokens))
+                words += len(tokens)
+    except Exception as e:
+        logger.error(f'跳过无法转换的dex {dex_path}: {e!r}')
+        return '', 0, 0, 1
+    return ''.join(line + '\n' for line in lines), len(lines), words, 0
+
+
+def _ordered_map(executor, func, iterable, window):
+    """
+    与 executor.map 相同，按输入顺序返回结果，但最多只提交 window 个未取走的任务
+    :return: 生成 func 的返回值
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def build_corpus_file(dex_dir, corpus_path, workers=None, cache_dir=None):
+    """
+    把目录中所有dex的方法AST分词后写入语料文件，每个进程处理一个dex，
+    转换结果按文件名顺序依次写出，内存中只保留正在处理的dex
+    :param dex_dir: dex 目录，递归查找 .dex 文件
+    :param corpus_path: 语料文件路径，先写临时文件，完成后替换，失败时删除临时文件
+    :param workers: 进程数，默认为 CPU 核数
+    :param cache_dir: dex_cache 的缓存目录，已缓存的dex不再运行 androguard
+    :return: (文档数, 词数)
+    """
+    dex_paths = sorted(os.path.join(root, name)
+                       for root, _, names in os.walk(dex_dir)
+                       for name in names if name.endswith('.dex'))
+    workers = workers or os.cpu_count() or 1
+    tmp_path = f'{corpus_path}.{os.getpid()}.tmp'
+    documents = 0
+    words = 0
+    errors = 0
+    start = time.perf_counter()
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', errors='backslashreplace') as f, \
+                ProcessPoolExecutor(max_workers=workers) as executor:
+            tasks = ((dex_path, cache_dir) for dex_path in dex_paths)
+            results = _ordered_map(executor, _dex_corpus_lines, tasks, workers * 2)
+            for i, (text, dex_documents, dex_words, dex_errors) in enumerate(results, 1):
+                f.write(text)
+                documents += dex_documents
+                words += dex_words
+                errors += dex_errors
+                elapsed = time.perf_counter() - start
+                logger.info(f'语料 {i}/{len(dex_paths)}: {documents} 个文档, {words} 个词, '
+                            f'{words / elapsed:.0f} words/s')
+        os.replace(tmp_path, corpus_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if errors:
+        logger.warning(f'{errors} 个dex无法转换，已跳过')
+    return documents, words
+
+
+class ThroughputLogger(CallbackAny2Vec):
+    """每轮训练结束时输出耗时和每秒处理的词数"""
+
+    def __init__(self):
+        self.epoch = 0
+        self._train_start = None
+        self._epoch_start = None
+
+    def on_train_begin(self, model):
+        self._train_start = time.perf_counter()
+
+    def on_epoch_begin(self, model):
+        self._epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, model):
+        self.epoch += 1
+        elapsed = time.perf_counter() - self._epoch_start
+        logger.info(f'第 {self.epoch}/{model.epochs} 轮: {elapsed:.1f}s, '
+                    f'{model.corpus_total_words / elapsed:.0f} words/s')
+
+    def on_train_end(self, model):
+        elapsed = time.perf_counter() - self._train_start
+        logger.info(f'训练完成: {self.epoch} 轮, {elapsed:.1f}s, '
+                    f'{model.corpus_total_words * self.epoch / elapsed:.0f} words/s')
+
+
+def train_model(corpus_path, model_path=None, vector_size=200, window=5, min_count=1, epochs=50, workers=None,
+                normalizer=None):
+    """
+    使用 corpus_file 模式训练 Doc2Vec，每个工作线程读取语料文件的一段，
+    训练不受 GIL 限制，也不需要把语料读入内存
+    :param corpus_path: write_corpus_file 或 build_corpus_file 生成的语料文件
+    :param model_path: 模型保存路径，为 None 时不保存
+    :param vector_size: 向量维度（论文参数）
+    :param window: 上下文窗口
+    :param min_count: 忽略出现次数低于该值的词
+    :param epochs: 训练轮次
+    :param workers: 训练线程数，默认为 CPU 核数
+    :param normalizer: 生成语料时使用的 normalize.TokenNormalizer，与模型一起保存，推理时使用同一份配置
+    :return: Doc2Vec 模型，文档标签为语料文件的行号
+    """
+    model = Doc2Vec(
+        corpus_file=corpus_path,
+        vector_size=vector_size,
+        window=window,
+        min_count=min_count,
+        workers=workers or os.cpu_count() or 1,
+        epochs=epochs,
+        callbacks=[ThroughputLogger()],
+    )
+    if model_path is not None:
+        # 大数组单独保存，load_model 可以内存映射
+        model.save(model_path)
+        if normalizer is not None:
+            normalizer.save(normalizer_path(model_path))
+    return model
+
+
 def main():
     # 示例AST文本（模拟论文中的Listing 2）
     example_ast = """
@@ -44,28 +423,20 @@ def main():
         ['Local', 'p1']],
         'ReturnStatement', None]
     """
-    #
-    # # 假设有多个AST文本（示例数据）
-    # ast_texts = [example_ast] * 1000  # 实际需替换为真实AST数据集
-    # corpus = prepare_ast_corpus(ast_texts)
-    #
-    # # 训练Doc2Vec模型
-    # model = Doc2Vec(
-    #     documents=corpus,
-    #     vector_size=200,  # 向量维度（论文参数）
-    #     window=5,  # 上下文窗口
-    #     min_count=1,  # 忽略低频词
-    #     workers=8,  # 并行线程数
-    #     epochs=50  # 训练轮次
-    # )
-
-    # 保存模型
-    # model.save("../models/ast2vec_model.model")
+
+    # 训练Doc2Vec模型：先把全部dex的AST分词写入语料文件，再多线程训练
+    # build_corpus_file("../dex_output", "../models/ast_corpus.txt", cache_dir="../cache/dex")
+    # train_model("../models/ast_corpus.txt", "../models/ast2vec_model.model")
+    # 归一化后训练，词表和模型更小：
+    # normalizer = TokenNormalizer()
+    # normalize_corpus_file(normalizer, "../models/ast_corpus.txt", "../models/ast_corpus.norm.txt")
+    # train_model("../models/ast_corpus.norm.txt", "../models/ast2vec_model.model", normalizer=normalizer)
+
     # 加载模型（推理时）
-    model = Doc2Vec.load("../models/ast2vec_model.model")
+    model = load_model("../models/ast2vec_model.model")
 
     # 示例：生成单个AST的向量
-    logger.info(f"\n{model.dv['ast_1']}")
+    logger.info(f"\n{model.dv[1]}")
     ast_vector = ast_to_vector(example_ast, model)
     logger.info(f"\n{ast_vector}")
 
@@ -0,0 +1,138 @@
+"""
+方法特征缓存
+同一个第三方库（androidx、okhttp、广告 SDK 等）的方法会出现在大量 apk 中，
+按方法的指令流和描述符计算哈希，命中时跳过 convert_method 和 infer_vector
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from androguard.core.analysis.analysis import ExternalMethod
+
+from .handler import get_operands, operand_text
+
+
+def method_key(method):
+    """
+    计算方法的缓存键
+    AST 由类名、方法名、描述符、修饰符和每条指令的名称与操作数决定，
+    操作数使用解析后的文本，不同 dex 中常量池下标不同也能得到相同的键；
+    文本由 handler 解码的操作数生成，dex_cache 中缓存的指令流得到的键与原始指令相同
+    :param method: androguard 方法对象
+    :return: 十六进制摘要，外部方法返回 None
+    """
+    if isinstance(method, ExternalMethod):
+        return None
+    sha1 = hashlib.sha1()
+    sha1.update(f'{method.get_class_name()}->{method.get_name()}{method.get_descriptor()}'
+                f' {method.get_access_flags_string()}\n'.encode('utf-8', 'surrogatepass'))
+    for ins in method.get_instructions():
+        name = ins.get_name()
+        text = ', '.join(operand_text(operand) for operand in get_operands(name, ins))
+        sha1.update(f'{name} {text}\n'.encode('utf-8', 'surrogatepass'))
+    return sha1.hexdigest()
+
+
+class MethodFeatureCache:
+    """
+    两级方法特征缓存：内存中的 LRU 在前，磁盘上的 sqlite 在后
+    """
+
+    def __init__(self, path=None, capacity=100000, namespace='', commit_interval=256):
+        """
+        :param path: sqlite 文件路径，为 None 时只使用内存缓存
+        :param capacity: 内存中最多保留的方法数
+        :param namespace: 键的前缀，用来区分不同模型产生的特征
+        :param commit_interval: 每写入多少条提交一次
+        """
+        self.path = path
+        self.capacity = capacity
+        self.namespace = namespace
+        self.commit_interval = commit_interval
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            # WAL 模式下多个进程可以同时读写
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS features '
+                             '(key TEXT PRIMARY KEY, flag INTEGER, vector BLOB)')
+            self._db.commit()
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        :param key: method_key 的返回值
+        :return: (是否提取成功, float32 向量)，未命中返回 None
+        """
+        key = self.namespace + key
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return value
+            if self._db is not None:
+                row = self._db.execute('SELECT flag, vector FROM features WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = (bool(row[0]), np.frombuffer(row[1], dtype=np.float32))
+                    self._remember(key, value)
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, flag, vector):
+        """写入缓存"""
+        key = self.namespace + key
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, (flag, vector))
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO features VALUES (?, ?, ?)',
+                                 (key, int(flag), vector.tobytes()))
+                self._uncommitted += 1
+                if self._uncommitted >= self.commit_interval:
+                    self._db.commit()
+                    self._uncommitted = 0
+
+    def stats(self):
+        """命中统计"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_size': len(self._memory),
+        }
+
+    def flush(self):
+        """提交尚未写入磁盘的数据"""
+        with self._lock:
+            if self._db is not None and self._uncommitted:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
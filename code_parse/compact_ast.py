@@ -0,0 +1,199 @@
+"""
+紧凑的AST表示
+convert_method 生成的AST由嵌套的 list/tuple/dict 组成，每个节点都是独立的 Python 对象，
+类名、方法名、寄存器名在不同语句中重复保存。整个应用的AST放在内存中时会占用数 GB。
+这里把AST按先序展开成一个 int 数组：节点类型是小整数，字符串放入共享的字符串池，
+与原来的列表形式可以无损地互相转换。
+"""
+from array import array
+
+# 节点类型名，出现时按下标保存，不进入字符串池
+NODE_KINDS = (
+    'ArrayAccess', 'Assignment', 'BinaryExpression', 'BlockStatement', 'CastExpression',
+    'ExpressionStatement', 'FieldAccess', 'GotoStatement', 'IfStatement', 'Literal', 'Local',
+    'MethodInvocation', 'NewInstance', 'Parameter', 'ReturnStatement', 'StaticFieldAccess',
+    'ThisReference', 'TypeName', 'UnaryExpression', 'Unknown',
+)
+_KIND_IDS = {kind: i for i, kind in enumerate(NODE_KINDS)}
+
+# 每个元素占一个 int：低 4 位是标记，其余位是数据（容器的长度、字符串编号、整数值等）
+TAG_LIST = 0
+TAG_TUPLE = 1
+TAG_DICT = 2
+TAG_STR = 3
+TAG_KIND = 4
+TAG_INT = 5
+TAG_NONE = 6
+TAG_TRUE = 7
+TAG_FALSE = 8
+# 其余无法放进数组的值（浮点数、超出范围的整数等）原样保存在 objects 中
+TAG_OBJECT = 9
+
+_TAG_BITS = 4
+_TAG_MASK = (1 << _TAG_BITS) - 1
+_CODE_TYPE = 'i'
+_PAYLOAD_MIN = -(1 << (array(_CODE_TYPE).itemsize * 8 - 1 - _TAG_BITS))
+_PAYLOAD_MAX = -_PAYLOAD_MIN - 1
+
+
+class StringPool:
+    """字符串池，同一个字符串只保存一次，多个AST可以共享"""
+    __slots__ = ('strings', '_ids')
+
+    def __init__(self):
+        self.strings = []
+        self._ids = {}
+
+    def intern(self, value):
+        """
+        :param value: 字符串
+        :return: 字符串在池中的编号
+        """
+        string_id = self._ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(value)
+            self._ids[value] = string_id
+        return string_id
+
+    def __getitem__(self, string_id):
+        return self.strings[string_id]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class CompactAst:
+    """先序展开的AST"""
+    __slots__ = ('codes', 'pool', 'objects')
+
+    def __init__(self, codes, pool, objects=None):
+        """
+        :param codes: array，每个元素是 (数据 << 4) | 标记
+        :param pool: StringPool
+        :param objects: TAG_OBJECT 引用的值
+        """
+        self.codes = codes
+        self.pool = pool
+        self.objects = objects
+
+    @classmethod
+    def from_ast(cls, ast, pool=None):
+        """
+        从列表形式的AST构建
+        :param ast: convert_method 生成的AST
+        :param pool: 共享的字符串池，为 None 时新建
+        :return: CompactAst
+        """
+        if pool is None:
+            pool = StringPool()
+        codes = array(_CODE_TYPE)
+        objects = []
+        _encode(ast, codes.append, pool, objects)
+        return cls(codes, pool, objects or None)
+
+    def to_ast(self):
+        """
+        还原为列表形式的AST
+        :return: 与 from_ast 的输入相等的AST
+        """
+        return _decode(self.codes, self.pool.strings, self.objects)
+
+    @property
+    def nbytes(self):
+        """展开数组占用的字节数，不含共享的字符串池"""
+        return self.codes.itemsize * len(self.codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __eq__(self, other):
+        if isinstance(other, CompactAst):
+            return self.to_ast() == other.to_ast()
+        return NotImplemented
+
+    def __str__(self):
+        # 分词等下游代码通过 str(ast) 使用AST
+        return str(self.to_ast())
+
+
+def _encode(node, emit, pool, objects):
+    """先序写入节点"""
+    node_type = type(node)
+    if node_type is list or node_type is tuple or node_type is dict:
+        tag = TAG_LIST if node_type is list else TAG_TUPLE if node_type is tuple else TAG_DICT
+        emit((len(node) << _TAG_BITS) | tag)
+        if node_type is dict:
+            for key, value in node.items():
+                _encode(key, emit, pool, objects)
+                _encode(value, emit, pool, objects)
+        else:
+            for child in node:
+                _encode(child, emit, pool, objects)
+    elif node_type is str:
+        kind = _KIND_IDS.get(node)
+        if kind is not None:
+            emit((kind << _TAG_BITS) | TAG_KIND)
+        else:
+            emit((pool.intern(node) << _TAG_BITS) | TAG_STR)
+    elif node is None:
+        emit(TAG_NONE)
+    elif node is True:
+        emit(TAG_TRUE)
+    elif node is False:
+        emit(TAG_FALSE)
+    elif node_type is int and _PAYLOAD_MIN <= node <= _PAYLOAD_MAX:
+        emit((node << _TAG_BITS) | TAG_INT)
+    else:
+        emit((len(objects) << _TAG_BITS) | TAG_OBJECT)
+        objects.append(node)
+
+
+def _decode(codes, strings, objects):
+    """按先序读出AST，用显式栈代替递归"""
+    root = []
+    # 栈中每项为 [已读出的元素, 还需读出的元素数, 容器标记]，字典的键和值依次放入元素列表
+    stack = [[root, 1, TAG_LIST]]
+    items = root
+    remaining = 1
+    for code in codes:
+        tag = code & _TAG_MASK
+        payload = code >> _TAG_BITS
+        if tag == TAG_STR:
+            items.append(strings[payload])
+        elif tag == TAG_KIND:
+            items.append(NODE_KINDS[payload])
+        elif tag <= TAG_DICT:
+            if payload:
+                stack[-1][1] = remaining
+                items = []
+                remaining = payload * 2 if tag == TAG_DICT else payload
+                stack.append([items, remaining, tag])
+                continue
+            items.append([] if tag == TAG_LIST else () if tag == TAG_TUPLE else {})
+        elif tag == TAG_INT:
+            items.append(payload)
+        elif tag == TAG_NONE:
+            items.append(None)
+        elif tag == TAG_TRUE:
+            items.append(True)
+        elif tag == TAG_FALSE:
+            items.append(False)
+        else:
+            items.append(objects[payload])
+        remaining -= 1
+        # 容器读完后放入上一层
+        while not remaining:
+            done, _, done_tag = stack.pop()
+            if not stack:
+                return root[0]
+            parent = stack[-1]
+            items = parent[0]
+            remaining = parent[1] - 1
+            if done_tag == TAG_LIST:
+                items.append(done)
+            elif done_tag == TAG_TUPLE:
+                items.append(tuple(done))
+            else:
+                items.append(dict(zip(done[::2], done[1::2])))
+    return root[0]
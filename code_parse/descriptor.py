@@ -0,0 +1,150 @@
+"""
+类型、方法和字段描述符的解析
+同一个描述符（如 Ljava/lang/String;、(Landroid/content/Context;)V）在语料中会出现上百万次，
+这里的解析结果按描述符缓存，结果都是不可变的元组，类型名、类名和成员名经过 sys.intern，
+handler 和 node2ast 共用同一份缓存，多个方法、多个线程之间可以直接共享。
+"""
+import sys
+from collections import namedtuple
+from functools import lru_cache
+
+PRIMITIVE_TYPES = {
+    'V': 'void', 'Z': 'boolean', 'B': 'byte',
+    'S': 'short', 'C': 'char', 'I': 'int',
+    'J': 'long', 'F': 'float', 'D': 'double'
+}
+# long/double 参数占两个寄存器
+WIDE_TYPES = ('long', 'double')
+
+# 描述符的种类远少于出现次数，缓存满后淘汰最久未用的
+_DESCRIPTOR_CACHE_SIZE = 1 << 16
+_REFERENCE_CACHE_SIZE = 1 << 17
+
+TypeInfo = namedtuple('TypeInfo', ['type', 'dim'])
+TypeInfo.__doc__ = '寄存器或参数的类型，type 为 Java 类型名，dim 为数组维数'
+
+THIS_TYPE = TypeInfo('this', 0)
+VOID_TYPE = TypeInfo('void', 0)
+
+
+def _parse_type(text, i):
+    """
+    从 text[i] 开始解析一个类型描述符
+    :return: (TypeInfo, 下一个类型的起始位置)
+    """
+    dim = 0
+    while text[i] == '[':
+        dim += 1
+        i += 1
+    if text[i] == 'L':
+        end = text.index(';', i)
+        return TypeInfo(sys.intern(text[i + 1:end].replace('/', '.')), dim), end + 1
+    return TypeInfo(PRIMITIVE_TYPES.get(text[i], 'unknown'), dim), i + 1
+
+
+@lru_cache(maxsize=_DESCRIPTOR_CACHE_SIZE)
+def parse_method_descriptor(descriptor):
+    """
+    解析方法描述符，返回参数类型和返回类型
+    :param descriptor: 方法描述符，如 "(Ljava/lang/String;IZ)V"
+    :return: (参数 TypeInfo 元组, 返回值 TypeInfo)，格式不正确时为 ((), VOID_TYPE)
+    """
+    if not descriptor.startswith('(') or ')' not in descriptor:
+        return (), VOID_TYPE
+    end = descriptor.index(')')
+    params = []
+    i = 1
+    while i < end:
+        type_info, i = _parse_type(descriptor, i)
+        params.append(type_info)
+    if end + 1 >= len(descriptor):
+        return tuple(params), VOID_TYPE
+    return tuple(params), _parse_type(descriptor, end + 1)[0]
+
+
+@lru_cache(maxsize=_DESCRIPTOR_CACHE_SIZE)
+def parameter_registers(descriptor, is_static):
+    """
+    参数的寄存器分配
+    :param descriptor: 方法描述符
+    :param is_static: 是否是静态方法，非静态方法 p0 为 this
+    :return: ((寄存器名, TypeInfo), ...)，可以直接用 dict() 转为寄存器表
+    """
+    params, _ = parse_method_descriptor(descriptor)
+    registers = [] if is_static else [('p0', THIS_TYPE)]
+    reg_idx = 0 if is_static else 1
+    for type_info in params:
+        registers.append((f'p{reg_idx}', type_info))
+        reg_idx += 2 if type_info.type in WIDE_TYPES and type_info.dim == 0 else 1
+    return tuple(registers)
+
+
+@lru_cache(maxsize=_DESCRIPTOR_CACHE_SIZE)
+def ast_signature(descriptor, is_static):
+    """
+    convert_method 使用的参数和返回类型
+    参数按 ; 分割，类型文本保留描述符的原样（基本类型与下一个参数连在一起），
+    与已训练模型的语料一致，不能改为 parse_method_descriptor 的结果
+    :param descriptor: 方法描述符
+    :param is_static: 是否是静态方法
+    :return: (((类型文本, 数组维数), 寄存器名), ...), (返回类型文本, 数组维数)
+    """
+    parts = descriptor[1:].split(')')
+    params_text = parts[0]
+    return_type = sys.intern(parts[1].removesuffix(';'))
+    params = [] if is_static else [(('this', 0), 'p0')]
+    reg_index = 0 if is_static else 1
+    for param in params_text.split(';')[:-1]:
+        param = sys.intern(param.strip())
+        params.append(((param, param.count('[')), f'p{reg_index}'))
+        # 宽类型（long/double）占两个寄存器
+        reg_index += 2 if param in ('J', 'D') else 1
+    return tuple(params), (return_type, return_type.count('['))
+
+
+@lru_cache(maxsize=_REFERENCE_CACHE_SIZE)
+def class_name(type_descriptor):
+    """
+    :param type_descriptor: 类的类型描述符，如 "Lcom/Class;"
+    :return: 去掉 L 和 ; 的点分类名，如 "com.Class"
+    """
+    return sys.intern(type_descriptor[1:-1].replace('/', '.'))
+
+
+@lru_cache(maxsize=_REFERENCE_CACHE_SIZE)
+def parse_field_desc(field_desc):
+    """
+    解析字段引用，返回类名和字段名
+    :param field_desc: 如 "Lcom/Class;->field:Ljava/lang/Object;"
+    :return: (class_name, field_name)，类名保留结尾的 ;
+    """
+    class_part, field_part = field_desc.split('->')
+    return sys.intern(class_part[1:].split(':')[0].replace('/', '.')), sys.intern(field_part.split(':')[0])
+
+
+@lru_cache(maxsize=_REFERENCE_CACHE_SIZE)
+def parse_method_desc(method_desc):
+    """
+    解析方法引用，如 "Lcom/Class;->method(Ljava/lang/String;)V"
+    :return: (class_name, method_name)，类名保留结尾的 ;，不是方法引用时为 (None, None)
+    """
+    if '->' not in method_desc:
+        return None, None
+    class_part, rest = method_desc.split('->')
+    return sys.intern(class_part[1:].replace('/', '.')), sys.intern(rest.split('(')[0])
+
+
+_CACHED_FUNCTIONS = (parse_method_descriptor, parameter_registers, ast_signature,
+                     class_name, parse_field_desc, parse_method_desc)
+
+
+def cache_info():
+    """
+    :return: {函数名: functools 的 CacheInfo}，用于查看命中率
+    """
+    return {func.__name__: func.cache_info() for func in _CACHED_FUNCTIONS}
+
+
+def cache_clear():
+    for func in _CACHED_FUNCTIONS:
+        func.cache_clear()
@@ -1,28 +1,139 @@
 """
 提供对外接口
 """
-from gensim.models import Doc2Vec
+import os
+import threading
+
+import numpy as np
 from loguru import logger
 from .node2ast import convert_method
-from .ast2vec import ast_to_vector
+from .ast2vec import ast_tokens, infer_vectors, load_model
+from . import instrument
+from .cache import MethodFeatureCache, method_key
+from .handler import HANDLER_VERSION
+from .normalize import NORMALIZER_VERSION, load_normalizer
+
+# 默认模型路径，可通过环境变量 AST2VEC_MODEL 覆盖，不再依赖当前工作目录
+DEFAULT_MODEL_PATH = os.environ.get(
+    'AST2VEC_MODEL',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models', 'ast2vec_model.model')
+)
 
 
 class AstFeatureClass:
-    def __init__(self, method=None):
+    def __init__(self, method=None, model_path=None, cache=None):
         self.method = method
-        self.model = Doc2Vec.load("models/ast2vec_model.model")
+        # 在第一次使用 model 之前修改才会生效
+        self.model_path = model_path or DEFAULT_MODEL_PATH
+        self._model = None
+        self._normalizer = None
+        self._model_lock = threading.Lock()
+        # 方法特征缓存，为 None 时不使用
+        self.cache = cache
+
+    @property
+    def model(self):
+        """第一次使用时才加载模型"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._normalizer = load_normalizer(self.model_path)
+                    self._model = load_model(self.model_path)
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    @property
+    def normalizer(self):
+        """模型训练时使用的分词归一化，与模型一起加载，没有时为 None"""
+        self.model
+        return self._normalizer
+
+    @normalizer.setter
+    def normalizer(self, normalizer):
+        self._normalizer = normalizer
+
+    def _tokens(self, ast):
+        tokens = ast_tokens(ast)
+        normalizer = self.normalizer
+        return tokens if normalizer is None else normalizer(tokens)
+
+    def enable_cache(self, path=None, capacity=100000):
+        """
+        启用方法特征缓存，用模型文件的大小和修改时间区分不同模型的特征，
+        handler 或分词归一化的版本改变时特征也不同，版本号一并计入
+        :param path: sqlite 文件路径，为 None 时只使用内存缓存
+        :param capacity: 内存中最多保留的方法数
+        :return: MethodFeatureCache
+        """
+        stat = os.stat(self.model_path)
+        namespace = (f'{os.path.basename(self.model_path)}:{stat.st_size}:{int(stat.st_mtime)}:'
+                     f'h{HANDLER_VERSION}:n{NORMALIZER_VERSION}:')
+        self.cache = MethodFeatureCache(path, capacity, namespace)
+        return self.cache
+
+    def _cached(self, method):
+        """查询缓存，返回 (缓存键, 缓存值)"""
+        if self.cache is None:
+            return None, None
+        key = method_key(method)
+        if key is None:
+            return None, None
+        return key, self.cache.get(key)
 
     def extract_feature(self):
         """
         提取特征
         :return: 返回特征值
         """
+        key, cached = self._cached(self.method)
+        if cached is not None:
+            return cached
         ast = convert_method(self.method)
         if ast is None:
             return False, [0] * 200
-        vector = ast_to_vector(str(ast), self.model)
+        vector = self.model.infer_vector(self._tokens(ast))
+        if key is not None:
+            self.cache.put(key, True, vector)
         return True, vector
 
+    def extract_features(self, methods, workers=None):
+        """
+        批量提取特征，一次推理一个 dex 中的所有方法
+        :param methods: 方法列表
+        :param workers: 推理线程数，默认为 CPU 核数
+        :return: (是否提取成功的列表, float32 特征矩阵)，行顺序与 methods 一致，失败的行为 0
+        """
+        methods = list(methods)
+        matrix = np.zeros((len(methods), self.model.vector_size), dtype=np.float32)
+        flags = []
+        token_lists = []
+        # 需要推理的 (行号, 缓存键)
+        pending = []
+        with instrument.stage('convert_method', methods=len(methods)):
+            for i, method in enumerate(methods):
+                key, cached = self._cached(method)
+                if cached is not None:
+                    flags.append(cached[0])
+                    matrix[i] = cached[1]
+                    continue
+                ast = convert_method(method)
+                flags.append(ast is not None)
+                if ast is not None:
+                    token_lists.append(self._tokens(ast))
+                    pending.append((i, key))
+
+        with instrument.stage('infer_vector', inferred=len(token_lists),
+                              words=sum(map(len, token_lists)) if instrument.enabled() else 0):
+            vectors = infer_vectors(token_lists, self.model, workers)
+        for (i, key), vector in zip(pending, vectors):
+            matrix[i] = vector
+            if key is not None:
+                self.cache.put(key, True, vector)
+        return flags, matrix
+
     def print(self):
         """输出方法"""
         logger.debug(self.method)
@@ -1,136 +1,164 @@
 """
 指令处理器
 """
-import re
+import weakref
+from time import perf_counter
 
+from . import descriptor, instrument
+from androguard.core.bytecodes import dvm
+from androguard.core.bytecodes.dvm import OPERAND_REGISTER, OPERAND_LITERAL, OPERAND_OFFSET, OPERAND_KIND
+# 描述符解析在 descriptor 中统一实现并缓存，这里保留原有的函数名
+from .descriptor import TypeInfo, parameter_registers, parse_field_desc, parse_method_desc, parse_method_descriptor
 
-def parse_field_desc(field_desc):
+# 文本操作数，用于 get_operands() 与 get_output() 格式不一致的指令
+OPERAND_TEXT = -1
+# 指令处理的版本，修改操作数解码方式或生成的 AST 时加一，方法特征缓存和 dex 缓存随之失效
+HANDLER_VERSION = 1
+
+
+def parse_parameters(encoded_method, is_static):
     """
-    解析字段描述符，返回类名和字段名
-    :param field_desc: 如 "Lcom/Class;->field:Ljava/lang/Object;"
-    :return: (class_name, field_name)
+    解析方法的参数列表（寄存器分配 + 类型信息），结果按描述符缓存
+    :return: (
+        ('p0', TypeInfo(type='this', dim=0)),
+        ('p1', TypeInfo(type='int', dim=0)),
+        ...
+    )
     """
-    # 分割类和字段部分
-    class_part, field_part = field_desc.split('->')
-    # 提取类名（去除开头的L和结尾的;）
-    class_name = class_part[1:].split(':')[0].replace('/', '.')
-    # 提取字段名（去除类型描述）
-    field_name = field_part.split(':')[0]
-    return class_name, field_name
+    return parameter_registers(encoded_method.get_descriptor(), is_static)
 
 
-def parse_method_descriptor(descriptor):
+def parse_two_operands(ins):
     """
-    解析方法描述符，返回参数类型列表和返回类型
-    :param descriptor: 方法描述符，如 "(Ljava/lang/String;IZ)V"
-    :return: (params, ret_type)
+    解析双操作数指令，如 "int-to-long v0, v1"
+    :return: (dest_reg, src_reg)
     """
-    # 提取参数部分和返回类型
-    basic_map = {}
-    match = re.match(r'^\((.*?)\)(.*)$', descriptor)
-    if not match:
-        return [], {'type': 'void', 'dim': 0}
-
-    params_str, ret_str = match.groups()
-    params = []
-    i = 0
-
-    # 解析参数类型
-    while i < len(params_str):
-        dim = 0
-        while params_str[i] == '[':
-            dim += 1
-            i += 1
-
-        if params_str[i] == 'L':
-            end = params_str.index(';', i)
-            type_name = params_str[i + 1:end].replace('/', '.')
-            i = end + 1
-        else:
-            basic_map = {
-                'V': 'void', 'Z': 'boolean', 'B': 'byte',
-                'S': 'short', 'C': 'char', 'I': 'int',
-                'J': 'long', 'F': 'float', 'D': 'double'
-            }
-            type_name = basic_map.get(params_str[i], 'unknown')
-            i += 1
-
-        params.append({'type': type_name, 'dim': dim})
-
-    # 解析返回类型
-    ret_dim = 0
-    ret_char = ret_str[0]
-    while ret_char == '[':
-        ret_dim += 1
-        ret_str = ret_str[1:]
-        ret_char = ret_str[0]
-
-    if ret_char == 'L':
-        ret_type = ret_str[1:-1].replace('/', '.')
-    else:
-        ret_type = basic_map.get(ret_char, 'unknown')
-
-    return params, {'type': ret_type, 'dim': ret_dim}
+    operands = get_operands(ins.get_name(), ins)
+    return operand_text(operands[0]), operand_text(operands[1])
 
 
-def parse_parameters(encoded_method, is_static):
+def get_operands(op, ins):
     """
-    解析方法的参数列表（寄存器分配 + 类型信息）
-    :return: [
-        {'reg': 'p0', 'type_info': {'type': 'this', 'dim': 0}},
-        {'reg': 'p1', 'type_info': {'type': 'int', 'dim': 0}},
-        ...
-    ]
+    获取指令的结构化操作数，不再格式化后重新切分 get_output() 的文本
+    格式未经验证的指令（odex 专用指令等）退回到按 get_output() 切分的文本操作数
+    已经解码的 DecodedInstruction 直接返回保存的操作数
+    :return: [(kind, value, ...), ...]，与 ins.get_operands() 相同
     """
-    descriptor = encoded_method.get_descriptor()
-    param_types, _ = parse_method_descriptor(descriptor)
-
-    params = []
-    reg_idx = 0 if is_static else 1  # 非静态方法 p0=this
+    if type(ins) is DecodedInstruction:
+        return ins.operands
+    decode = OPERAND_DECODERS.get(op)
+    if decode is not None:
+        operands = decode(ins)
+        # 空的寄存器范围在 get_output() 中仍然输出为 "vC ... vN"，这种情况使用文本操作数
+        if len(operands) > 1 or not op.endswith('/range'):
+            return operands
+    return [(OPERAND_TEXT, part) for part in ins.get_output().split(', ')]
+
+
+class DecodedInstruction:
+    """
+    已经解码的指令，保存指令名和 get_operands 的结果，
+    可以代替 androguard 的指令对象交给各处理函数，不再需要 ClassManager
+    """
+    __slots__ = ('name', 'operands')
 
-    # 添加隐含的 this 参数
-    if not is_static:
-        params.append({
-            'reg': 'p0',
-            'type_info': {'type': 'this', 'dim': 0}
-        })
+    def __init__(self, name, operands):
+        self.name = name
+        self.operands = operands
 
-    # 分配显式参数
-    for p_type in param_types:
-        reg = f'p{reg_idx}'
-        params.append({
-            'reg': reg,
-            'type_info': {'type': p_type['type'], 'dim': p_type['dim']}
-        })
+    def get_name(self):
+        return self.name
 
-        # 处理宽类型（long/double）
-        if p_type['type'] in ('long', 'double') and p_type['dim'] == 0:
-            reg_idx += 2
-        else:
-            reg_idx += 1
+    def get_operands(self):
+        return self.operands
 
-    return params
+    def get_output(self):
+        return ', '.join(operand_text(operand) for operand in self.operands)
 
 
-def parse_method_desc(method_desc):
+def decode_instruction(ins):
     """
-    解析方法描述符，如 "Lcom/Class;->method(Ljava/lang/String;)V"
-    :return: (class_name, method_name)
+    :param ins: androguard 指令对象
+    :return: (指令名, 操作数列表)，可以直接序列化
     """
-    if '->' not in method_desc:
-        return None, None
-    class_part, rest = method_desc.split('->')
-    method_name = rest.split('(')[0]
-    return class_part[1:].replace('/', '.'), method_name
+    name = ins.get_name()
+    return name, get_operands(name, ins)
 
 
-def parse_two_operands(ins):
+# 每个 dex 的 ClassManager -> {(kind, index): 文本}
+_KIND_TEXT_CACHE = weakref.WeakKeyDictionary()
+
+
+def kind_text(cm, kind, index):
     """
-    解析双操作数指令，如 "int-to-long v0, v1"
-    :return: (dest_reg, src_reg)
+    方法、字段、类型等引用的文本，同一个 dex 中的引用只解析一次
+    androguard 每次调用 get_operands() 都会重新解码 MUTF-8 字符串
     """
-    parts = ins.get_output().split(', ')
-    return parts[0].split()[-1].strip(), parts[1].strip()
+    try:
+        cache = _KIND_TEXT_CACHE[cm]
+    except KeyError:
+        cache = _KIND_TEXT_CACHE[cm] = {}
+    key = (kind, index)
+    text = cache.get(key)
+    if text is None:
+        text = cache[key] = dvm.get_kind(cm, kind, index)
+    return text
+
+
+def decode_35c(ins):
+    kind = ins.get_kind()
+    registers = (ins.C, ins.D, ins.E, ins.F, ins.G)[:ins.A]
+    operands = [(OPERAND_REGISTER, reg) for reg in registers]
+    operands.append((kind + OPERAND_KIND, ins.BBBB, kind_text(ins.cm, kind, ins.BBBB)))
+    return operands
+
+
+def decode_3rc(ins):
+    kind = ins.get_kind()
+    if ins.CCCC == ins.NNNN:
+        operands = [(OPERAND_REGISTER, ins.CCCC)]
+    else:
+        operands = [(OPERAND_REGISTER, reg) for reg in range(ins.CCCC, ins.NNNN + 1)]
+    operands.append((kind + OPERAND_KIND, ins.BBBB, kind_text(ins.cm, kind, ins.BBBB)))
+    return operands
+
+
+def decode_22c(ins):
+    kind = ins.get_kind()
+    return [(OPERAND_REGISTER, ins.A), (OPERAND_REGISTER, ins.B),
+            (kind + OPERAND_KIND, ins.CCCC, kind_text(ins.cm, kind, ins.CCCC))]
+
+
+def decode_21c(ins):
+    kind = ins.get_kind()
+    return [(OPERAND_REGISTER, ins.AA),
+            (kind + OPERAND_KIND, ins.BBBB, kind_text(ins.cm, kind, ins.BBBB))]
+
+
+def operand_text(operand):
+    """还原操作数在 get_output() 中的文本"""
+    kind = operand[0]
+    if kind == OPERAND_REGISTER:
+        return f'v{operand[1]}'
+    elif kind == OPERAND_LITERAL:
+        return '%d' % operand[1]
+    elif kind == OPERAND_OFFSET:
+        return '%+x' % operand[1]
+    elif kind >= OPERAND_KIND:
+        return operand[2]
+    elif kind == OPERAND_TEXT:
+        return operand[1].strip()
+    return str(operand[1])
+
+
+def operand_node(operand):
+    """ 将结构化操作数转换为AST节点，结果与 parse_operand(operand_text(operand)) 相同 """
+    kind = operand[0]
+    if kind == OPERAND_REGISTER:
+        return ['Local', f'v{operand[1]}']
+    elif kind == OPERAND_LITERAL and operand[1] >= 0:
+        return ['Literal', operand[1]]
+    return parse_operand(operand_text(operand))
 
 
 def parse_operand(operand):
@@ -140,8 +168,7 @@ def parse_operand(operand):
     elif operand.startswith('p'):
         return ['Parameter', operand]
     elif '->' in operand:
-        class_part, field = operand.split('->')
-        return ['StaticFieldAccess', class_part[1:].replace('/', '.'), field.split(':')[0]]
+        return ['StaticFieldAccess', *parse_field_desc(operand)]
     elif operand == 'this':
         return ['ThisReference']
     elif operand.isdigit():
@@ -155,25 +182,27 @@ def parse_operand(operand):
 def handle_return(op, ins):
     if op == 'return-void':
         return ['ReturnStatement', None]
-    else:
-        operand = parse_operand(ins.get_output().split()[-1])
-        return ['ReturnStatement', operand]
+    operands = get_operands(op, ins)
+    if not operands:
+        return ['ReturnStatement', None]
+    return ['ReturnStatement', operand_node(operands[-1])]
 
 
 def handle_cast(op, ins, regs):
     # 示例指令: int-to-long v0, v1
-    dest_reg, src_reg = parse_two_operands(ins)
+    operands = get_operands(op, ins)
+    dest_reg = operand_text(operands[0])
     from_type, to_type = op.split('-to-')
 
     # 更新寄存器类型
-    regs[dest_reg] = {'type': to_type, 'dim': 0}
+    regs[dest_reg] = TypeInfo(to_type, 0)
 
     return ['ExpressionStatement',
             ['Assignment',
              ['Local', dest_reg],
              ['CastExpression',
               to_type.upper(),
-              parse_operand(src_reg)
+              operand_node(operands[1])
               ]
              ]
             ]
@@ -181,17 +210,24 @@ def handle_cast(op, ins, regs):
 
 def handle_invoke(op, ins):
     # 示例指令: invoke-virtual {v0}, Lcom/Class;->method()V
-    parts = ins.get_output().split(', ')
-    args_part = parts[0][parts[0].find('{') + 1:].split(', ')
-    method_desc = parts[-1].strip()
+    operands = get_operands(op, ins)
+    kind_text = operand_text(operands[-1])
+    method_desc = kind_text.rsplit(', ', 1)[-1].strip()
 
     # 解析方法信息
     class_name, method_name = parse_method_desc(method_desc)
     if class_name is None:
         return None
 
-    # 解析参数
-    args = [parse_operand(arg.strip()) for arg in args_part]
+    # 解析参数：保持原有行为，只取第一个参数
+    if len(operands) == 1:
+        # 没有寄存器参数时第一个参数就是方法描述符
+        first = kind_text.split(', ', 1)[0]
+        args = [parse_operand(first[first.find('{') + 1:].strip())]
+    elif op.endswith('/range') and len(operands) > 2:
+        args = [['Local', f'v{operands[0][1]} ... v{operands[-2][1]}']]
+    else:
+        args = [operand_node(operands[0])]
 
     # 目标对象（非静态方法第一个参数为this）
     target = args[0] if 'static' not in op else None
@@ -210,8 +246,8 @@ def handle_arithmetic(op, ins):
     处理算术运算指令：add-*, sub-*, mul-*, div-*, rem-*
     :param op: 指令名称（如 "add-int/2addr"）
     """
-    # 解析指令输出（示例："v0, v1, v2" 或 "v0, v1"）
-    operands = [o.strip() for o in ins.get_output().split(',')]
+    # 操作数（示例："v0, v1, v2" 或 "v0, v1"）
+    operands = get_operands(op, ins)
 
     # 处理不同指令格式
     if '/2addr' in op:  # 如 add-int/2addr v0, v1
@@ -219,11 +255,11 @@ def handle_arithmetic(op, ins):
         src = operands[1]
         return ['ExpressionStatement',
                 ['Assignment',
-                 parse_operand(dest),
+                 operand_node(dest),
                  ['BinaryExpression',
                   op.split('-')[0].upper(),
-                  parse_operand(dest),
-                  parse_operand(src)
+                  operand_node(dest),
+                  operand_node(src)
                   ]
                  ]
                 ]
@@ -231,11 +267,11 @@ def handle_arithmetic(op, ins):
         dest, src1, src2 = operands
         return ['ExpressionStatement',
                 ['Assignment',
-                 parse_operand(dest),
+                 operand_node(dest),
                  ['BinaryExpression',
                   op.split('-')[0].upper(),
-                  parse_operand(src1),
-                  parse_operand(src2)
+                  operand_node(src1),
+                  operand_node(src2)
                   ]
                  ]
                 ]
@@ -245,19 +281,19 @@ def handle_bitwise(op, ins):
     """
     处理位运算指令：shl-*, shr-*, and-*, or-*, xor-*
     """
-    # 分割操作数（示例："v0, v1, 0x1" 或 "v0, v1"）
-    operands = [o.strip() for o in ins.get_output().split(',')]
+    # 操作数（示例："v0, v1, 0x1" 或 "v0, v1"）
+    operands = get_operands(op, ins)
 
     # 处理移位指令的特殊情况（含立即数）
     if any(c in op for c in ['lit8', 'lit16']):  # 如 shl-int/lit8 v0, v1, 0x3
         dest, src, imm = operands
         return ['ExpressionStatement',
                 ['Assignment',
-                 parse_operand(dest),
+                 operand_node(dest),
                  ['BinaryExpression',
                   op.split('-')[0].upper(),
-                  parse_operand(src),
-                  ['Literal', int(imm, 0)]
+                  operand_node(src),
+                  ['Literal', imm[1] if imm[0] == OPERAND_LITERAL else int(operand_text(imm), 0)]
                   ]
                  ]
                 ]
@@ -271,11 +307,11 @@ def handle_bitwise(op, ins):
 
         return ['ExpressionStatement',
                 ['Assignment',
-                 parse_operand(dest),
+                 operand_node(dest),
                  ['BinaryExpression',
                   op.split('-')[0].upper(),
-                  parse_operand(src1),
-                  parse_operand(src2)
+                  operand_node(src1),
+                  operand_node(src2)
                   ]
                  ]
                 ]
@@ -287,27 +323,27 @@ def handle_control_flow(op, ins):
     """
     # 解析条件类型（如 "eq", "nez"）
     cond_type = op.split('-')[1]
-    # 分割操作数（示例："v0, :label_123" 或 "v0, v1, :label_456"）
-    parts = [p.strip() for p in ins.get_output().split(',')]
+    # 操作数（示例："v0, +12" 或 "v0, v1, -5"）
+    operands = get_operands(op, ins)
 
     # 处理不同条件格式
     if cond_type.endswith('z'):  # 单操作数条件（如 if-eqz）
-        reg, label = parts[0].split()[-1], parts[1]
+        reg, label = operands[0], operands[1]
         condition = ['UnaryExpression',
                      CONDITION_MAP[cond_type],
-                     parse_operand(reg)
+                     operand_node(reg)
                      ]
     else:  # 双操作数条件（如 if-ge）
-        reg1, reg2, label = parts[0].split()[-1], parts[1], parts[2]
+        reg1, reg2, label = operands[0], operands[1], operands[2]
         condition = ['BinaryExpression',
                      CONDITION_MAP[cond_type],
-                     parse_operand(reg1),
-                     parse_operand(reg2)
+                     operand_node(reg1),
+                     operand_node(reg2)
                      ]
 
     return ['IfStatement',
             condition,
-            ['GotoStatement', label.strip(':')]
+            ['GotoStatement', operand_text(label).strip(':')]
             ]
 
 
@@ -315,16 +351,16 @@ def handle_array_access(op, ins):
     """
     处理数组访问指令：aget-*, aput-*
     """
-    operands = [o.strip() for o in ins.get_output().split(',')]
+    operands = get_operands(op, ins)
 
     if op.startswith('aget'):  # 数组读取
         dest, array, index = operands
         return ['ExpressionStatement',
                 ['Assignment',
-                 parse_operand(dest),
+                 operand_node(dest),
                  ['ArrayAccess',
-                  parse_operand(array),
-                  parse_operand(index)
+                  operand_node(array),
+                  operand_node(index)
                   ]
                  ]
                 ]
@@ -333,10 +369,10 @@ def handle_array_access(op, ins):
         return ['ExpressionStatement',
                 ['Assignment',
                  ['ArrayAccess',
-                  parse_operand(array),
-                  parse_operand(index)
+                  operand_node(array),
+                  operand_node(index)
                   ],
-                 parse_operand(value)
+                 operand_node(value)
                  ]
                 ]
 
@@ -346,15 +382,16 @@ def handle_object_creation(ins, regs):
     处理对象创建指令：new-instance
     """
     # 示例指令："new-instance v0, Ljava/lang/Object;"
-    parts = [p.strip() for p in ins.get_output().split(',')]
-    dest_reg = parts[0].split()[-1]
-    class_desc = parts[1]
+    operands = get_operands(ins.get_name(), ins)
+    dest_reg = operand_text(operands[0])
+    # new-array 的第二个操作数是长度寄存器，沿用原有的取值方式
+    class_desc = operand_text(operands[1])
 
     # 解析类名（去除开头的L和结尾的;）
-    class_name = class_desc[1:-1].replace('/', '.')
+    class_name = descriptor.class_name(class_desc)
 
     # 更新寄存器类型
-    regs[dest_reg] = {'type': class_name, 'dim': 0}
+    regs[dest_reg] = TypeInfo(class_name, 0)
 
     return ['ExpressionStatement',
             ['Assignment',
@@ -377,60 +414,160 @@ CONDITION_MAP = {
 
 def handle_field_access(ins):
     # 示例指令: iget-object v0, p0, Lcom/Class;->field:Ljava/lang/Object;
-    parts = ins.get_output().split(', ')
-    dest_reg = parts[0].split()[-1]
-    obj_reg = parts[1]
-    field_desc = parts[2]
+    operands = get_operands(ins.get_name(), ins)
+    field_desc = operand_text(operands[2])
 
     # 解析字段信息
     class_name, field_name = parse_field_desc(field_desc)
 
     return ['ExpressionStatement',
             ['Assignment',
-             parse_operand(dest_reg),
+             operand_node(operands[0]),
              ['FieldAccess',
-              parse_operand(obj_reg),
+              operand_node(operands[1]),
               (class_name, field_name)
               ]
              ]
             ]
 
 
-def dispatch_instruction(op, ins, regs):
-    """ 指令分派 """
+def select_handler(op):
+    """
+    按指令名前缀选择处理函数，只在建表时调用
+    :return: handler(op, ins, regs)，不处理的指令返回 None
+    """
     if op.startswith('return'):
-        return handle_return(op, ins)
+        return lambda op, ins, regs: handle_return(op, ins)
     elif '-to-' in op:
-        return handle_cast(op, ins, regs)
+        return handle_cast
     elif op.startswith('invoke'):
-        return handle_invoke(op, ins)
+        return lambda op, ins, regs: handle_invoke(op, ins)
     elif op.startswith(('iget', 'iput')):
-        return handle_field_access(ins)
+        return lambda op, ins, regs: handle_field_access(ins)
     elif op.startswith(('add', 'sub', 'mul', 'div', 'rem')):
-        return handle_arithmetic(op, ins)
+        return lambda op, ins, regs: handle_arithmetic(op, ins)
     elif op.startswith(('shl', 'shr', 'and', 'or', 'xor')):
-        return handle_bitwise(op, ins)
+        return lambda op, ins, regs: handle_bitwise(op, ins)
     elif op.startswith('if-'):
-        return handle_control_flow(op, ins)
+        return lambda op, ins, regs: handle_control_flow(op, ins)
     elif op.startswith(('aget', 'aput')):
-        return handle_array_access(op, ins)
+        return lambda op, ins, regs: handle_array_access(op, ins)
     elif op.startswith('new-'):
-        return handle_object_creation(ins, regs)
+        return lambda op, ins, regs: handle_object_creation(ins, regs)
     else:
         return None
 
 
+def _get_operands(ins):
+    return ins.get_operands()
+
+
+# get_operands() 与 get_output() 完全对应、可以直接使用结构化操作数的指令格式及其解码函数
+OPERAND_FORMATS = {
+    dvm.Instruction10x: _get_operands,
+    dvm.Instruction11x: _get_operands,
+    dvm.Instruction11n: _get_operands,
+    dvm.Instruction12x: _get_operands,
+    dvm.Instruction21t: _get_operands,
+    dvm.Instruction22b: _get_operands,
+    dvm.Instruction22s: _get_operands,
+    dvm.Instruction22t: _get_operands,
+    dvm.Instruction23x: _get_operands,
+    dvm.Instruction21c: decode_21c,
+    dvm.Instruction22c: decode_22c,
+    dvm.Instruction35c: decode_35c,
+    dvm.Instruction3rc: decode_3rc,
+}
+
+
+def build_dispatch_table():
+    """
+    根据 androguard 的操作码表建立 指令名 -> 处理函数 的分派表
+    :return: (分派表, 指令名 -> 操作数解码函数)
+    """
+    table = {}
+    decoders = {}
+    for opcodes in (dvm.DALVIK_OPCODES_FORMAT, dvm.DALVIK_OPCODES_EXTENDED_WIDTH, dvm.DALVIK_OPCODES_OPTIMIZED):
+        for ins_class, (name, *_) in opcodes.values():
+            table[name] = select_handler(name)
+            decoder = OPERAND_FORMATS.get(ins_class)
+            # 同名指令出现在多种格式中时，只有格式一致才使用结构化操作数
+            if name in decoders and decoders[name] is not decoder:
+                decoder = None
+            decoders[name] = decoder
+    return table, {name: decoder for name, decoder in decoders.items() if decoder is not None}
+
+
+DISPATCH_TABLE, OPERAND_DECODERS = build_dispatch_table()
+
+# 指令名级别的统计，由 opcode_profile.enable 设置，为 None 时 build_body 不计时
+_opcode_profile = None
+
+
+def set_opcode_profile(profile):
+    """
+    :param profile: opcode_profile.OpcodeProfile，为 None 时关闭统计
+    """
+    global _opcode_profile
+    _opcode_profile = profile
+
+
+def get_opcode_profile():
+    return _opcode_profile
+
+
+def dispatch_instruction(op, ins, regs):
+    """ 指令分派 """
+    try:
+        handler = DISPATCH_TABLE[op]
+    except KeyError:
+        # 操作码表之外的指令名，第一次遇到时补充到表中
+        handler = DISPATCH_TABLE[op] = select_handler(op)
+    if handler is None:
+        return None
+    return handler(op, ins, regs)
+
+
 def build_body(encoded_method, is_static):
     # 初始化参数和寄存器类型
-    params = parse_parameters(encoded_method, is_static)
-    registers = {p['reg']: p['type_info'] for p in params}
+    registers = dict(parse_parameters(encoded_method, is_static))
 
     # 构建方法体
     body = []
-    for ins in encoded_method.get_instructions():
+    count = 0
+    profile = _opcode_profile
+    if profile is not None:
+        count = _profile_body(encoded_method, registers, body, profile.stats)
+    else:
+        for count, ins in enumerate(encoded_method.get_instructions(), 1):
+            op = ins.get_name()
+            stmt = dispatch_instruction(op, ins, registers)
+            if stmt:
+                body.append(stmt)
+    instrument.add(instructions=count)
+
+    return ['BlockStatement', None, body]
+
+
+def _profile_body(encoded_method, registers, body, stats):
+    """
+    build_body 的计时版本，统计每个指令名的 [次数, 累计秒数, 生成的语句数]
+    每条指令只读一次时钟，耗时为相邻两次读数之差，包含取下一条指令和分派的时间
+    :return: 指令数
+    """
+    count = 0
+    last = perf_counter()
+    for count, ins in enumerate(encoded_method.get_instructions(), 1):
         op = ins.get_name()
         stmt = dispatch_instruction(op, ins, registers)
+        now = perf_counter()
+        entry = stats.get(op)
+        if entry is None:
+            entry = stats[op] = [0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += now - last
         if stmt:
             body.append(stmt)
-
-    return ['BlockStatement', None, body]
+            entry[2] += 1
+        last = now
+    return count
@@ -0,0 +1,337 @@
+"""
+分阶段的耗时统计
+在 data_prepossess、feature_fusion 和 code_parse 的各个阶段（读取 zip、解析 dex、交叉引用、调用图、
+AST 转换、向量推理）记录墙钟时间、CPU 时间、阶段内的峰值内存和处理的方法数、指令数等计数，
+按 apk 汇总后可以找出语料中最慢的 apk。
+默认关闭，关闭时每个埋点只有一次全局变量判断。
+enable(path) 后每个阶段结束时向 path 追加一行 JSON，进程池中 fork 出的子进程写入同一个文件，
+summarize(load_records(path)) 得到整次运行的汇总。
+设置环境变量 PIPELINE_INSTRUMENT=<path> 时导入本模块即开启记录，不需要修改各个入口：
+    PIPELINE_INSTRUMENT=run.jsonl python data_prepossess.py
+    python -m code_parse.instrument run.jsonl [report.json]
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块，不记录内存
+    resource = None
+
+# 设置后导入时自动开启记录，值为记录文件路径
+INSTRUMENT_ENV = 'PIPELINE_INSTRUMENT'
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_recorder = None
+_local = threading.local()
+
+
+def _rss_kb():
+    """进程当前的常驻内存（KB），通过 /proc/self/statm 读取，其他系统上返回 None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _max_rss_kb():
+    """进程整个生命周期的峰值常驻内存（KB）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 的单位是字节
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _stage_peak_kb(rss_start, rss_end, max_start, max_end):
+    """
+    阶段内的峰值常驻内存（KB）
+    ru_maxrss 是整个进程的峰值，只有在阶段中创下新高时才等于阶段的峰值；
+    否则取阶段开始和结束时当前内存的较大值（阶段中间的短暂峰值无法得知）
+    """
+    if max_start is not None and max_end is not None and max_end > max_start:
+        return max_end
+    samples = [rss for rss in (rss_start, rss_end) if rss is not None]
+    return max(samples) if samples else None
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class Recorder:
+    """汇总当前进程的阶段记录，可选地把每条记录追加到 JSON Lines 文件"""
+
+    def __init__(self, path=None):
+        """
+        :param path: 记录文件路径，为 None 时只在内存中汇总
+        """
+        self.path = path
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._summary = _new_summary()
+
+    def record(self, record):
+        with self._lock:
+            _aggregate(self._summary, record)
+            if self.path is not None:
+                # fork 出的子进程重新打开文件，每条记录一次写入，多个进程追加不会交错
+                if self._pid != os.getpid():
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    self._file = open(self.path, 'a', encoding='utf-8')
+                    self._pid = os.getpid()
+                self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self._file.flush()
+
+    def summary(self, top=20):
+        """
+        当前进程的汇总，不包含子进程
+        :param top: 保留耗时最长的 apk 数
+        """
+        with self._lock:
+            return _finish_summary(self._summary, top)
+
+    def save(self, path, top=20):
+        """把汇总保存为 JSON"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(top), f, ensure_ascii=False, indent=2)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+
+
+def _after_fork_in_child():
+    """
+    fork 时其他线程可能正持有记录器的锁，子进程中只剩当前线程，锁永远不会释放，换一个新锁
+    """
+    if _recorder is not None:
+        _recorder._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def enable(path=None):
+    """
+    开启记录
+    :param path: 记录文件路径，为 None 时只在内存中汇总
+    :return: Recorder
+    """
+    global _recorder
+    disable()
+    _recorder = Recorder(path)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = None
+
+
+def get_recorder():
+    """
+    :return: 当前的 Recorder，未开启时返回 None
+    """
+    return _recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+@contextmanager
+def item(name):
+    """
+    之后的阶段都计入 name（通常是 apk 路径或 SHA-256），可以嵌套，内层优先
+    :param name: apk 标识
+    """
+    previous = getattr(_local, 'item', None)
+    _local.item = name
+    try:
+        yield
+    finally:
+        _local.item = previous
+
+
+def set_item(name):
+    """
+    在 item 的范围内更换 apk 标识，用于读取完 apk 才知道 SHA-256 的阶段，
+    进行中的阶段结束时按新的标识记录，离开 item 后恢复原来的标识
+    :param name: apk 标识
+    """
+    _local.item = name
+
+
+@contextmanager
+def stage(name, **counters):
+    """
+    记录一个阶段，可以嵌套，嵌套的阶段同时计入外层阶段的时间
+    :param name: 阶段名
+    :param counters: 初始计数，阶段中还可以用 add 累加
+    """
+    if _recorder is None:
+        yield
+        return
+    stack = _stack()
+    frame = {'counters': dict(counters)}
+    stack.append(frame)
+    rss_start = _rss_kb()
+    max_start = _max_rss_kb()
+    start = time.time()
+    wall_start = time.perf_counter()
+    # process_time 包含所有线程，推理线程池的 CPU 时间也计入
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        stack.pop()
+        recorder = _recorder
+        if recorder is not None:
+            rss_end = _rss_kb()
+            recorder.record({
+                'pid': os.getpid(),
+                'item': getattr(_local, 'item', None),
+                'stage': name,
+                'depth': len(stack),
+                'start': start,
+                'wall': wall,
+                'cpu': cpu,
+                'peak_rss_kb': _stage_peak_kb(rss_start, rss_end, max_start, _max_rss_kb()),
+                # 阶段结束时比开始时多占用的内存，释放内存的阶段为负数
+                'rss_growth_kb': None if rss_start is None or rss_end is None else rss_end - rss_start,
+                'counters': frame['counters'],
+            })
+
+
+def add(**counters):
+    """
+    累加当前线程最内层阶段的计数，没有进行中的阶段或未开启时忽略
+    :param counters: 如 methods=1, instructions=120
+    """
+    if _recorder is None:
+        return
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return
+    totals = stack[-1]['counters']
+    for key, value in counters.items():
+        totals[key] = totals.get(key, 0) + value
+
+
+def _new_summary():
+    return {'stages': {}, 'items': {}}
+
+
+def _add_counters(totals, counters):
+    for key, value in counters.items():
+        totals[key] = totals.get(key, 0) + value
+
+
+def _aggregate(summary, record):
+    """把一条记录并入汇总"""
+    peak = record['peak_rss_kb'] or 0
+    stats = summary['stages'].setdefault(record['stage'], {
+        'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_kb': 0, 'rss_growth_kb': 0, 'counters': {},
+    })
+    stats['count'] += 1
+    stats['wall'] += record['wall']
+    stats['cpu'] += record['cpu']
+    stats['peak_rss_kb'] = max(stats['peak_rss_kb'], peak)
+    stats['rss_growth_kb'] += record['rss_growth_kb'] or 0
+    _add_counters(stats['counters'], record['counters'])
+
+    if record['item'] is None:
+        return
+    item_stats = summary['items'].setdefault(record['item'], {
+        'wall': 0.0, 'cpu': 0.0, 'peak_rss_kb': 0, 'counters': {}, 'stages': {},
+    })
+    # 嵌套的阶段已经计入外层阶段，总时间只累加最外层
+    if record['depth'] == 0:
+        item_stats['wall'] += record['wall']
+        item_stats['cpu'] += record['cpu']
+    item_stats['peak_rss_kb'] = max(item_stats['peak_rss_kb'], peak)
+    item_stats['stages'][record['stage']] = item_stats['stages'].get(record['stage'], 0.0) + record['wall']
+    _add_counters(item_stats['counters'], record['counters'])
+
+
+def _rates(counters, wall):
+    return {f'{key}_per_second': value / wall for key, value in counters.items()} if wall else {}
+
+
+def _finish_summary(summary, top):
+    stages = {}
+    for name, stats in summary['stages'].items():
+        stages[name] = dict(stats, counters=dict(stats['counters']), **_rates(stats['counters'], stats['wall']))
+    items = sorted(({'item': name, **stats, 'counters': dict(stats['counters']), 'stages': dict(stats['stages'])}
+                    for name, stats in summary['items'].items()), key=lambda x: x['wall'], reverse=True)
+    return {'stages': stages, 'items': items[:top], 'item_count': len(items)}
+
+
+def load_records(path):
+    """
+    读取记录文件
+    :param path: enable 时指定的路径
+    :return: 生成记录字典，跳过写了一半的行
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.endswith('\n'):
+                yield json.loads(line)
+
+
+def summarize(records, top=20):
+    """
+    汇总记录
+    :param records: 记录的可迭代对象，通常为 load_records 的返回值
+    :param top: 保留耗时最长的 apk 数
+    :return: {'stages': {阶段名: 统计}, 'items': 按墙钟时间从长到短排列的 apk 统计, 'item_count': apk 数}
+    """
+    summary = _new_summary()
+    for record in records:
+        _aggregate(summary, record)
+    return _finish_summary(summary, top)
+
+
+def main():
+    from loguru import logger
+    path = sys.argv[1] if len(sys.argv) > 1 else 'instrument.jsonl'
+    report = summarize(load_records(path), top=10)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    for name, stats in sorted(report['stages'].items(), key=lambda x: x[1]['wall'], reverse=True):
+        logger.info(f'{name:20} {stats["count"]:>8} 次 wall {stats["wall"]:>10.2f}s cpu {stats["cpu"]:>10.2f}s '
+                    f'peak {stats["peak_rss_kb"] / 1024:>8.1f}MB {stats["counters"]}')
+    logger.info(f'最慢的 apk（共 {report["item_count"]} 个）:')
+    for stats in report['items']:
+        slowest = max(stats['stages'].items(), key=lambda x: x[1])[0]
+        logger.info(f'{stats["wall"]:>10.2f}s  {stats["item"]}  主要耗时: {slowest}')
+
+
+if os.environ.get(INSTRUMENT_ENV):
+    # spawn 启动的子进程重新导入本模块，同样写入这个文件
+    enable(os.environ[INSTRUMENT_ENV])
+
+if __name__ == '__main__':
+    main()
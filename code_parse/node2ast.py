@@ -2,40 +2,23 @@ from pprint import pformat
 from sys import stdout
 
 from androguard.core.analysis.analysis import ExternalMethod
-from androguard.misc import AnalyzeDex
+from androguard.core.bytecodes.dvm import DalvikVMFormat
 from loguru import logger
 from code_parse import handler
+from code_parse.compact_ast import CompactAst, StringPool
+from code_parse.descriptor import ast_signature, class_name
 
 
-def generate_param_names(params, is_static):
+def generate_param_names(descriptor, is_static):
     """
     生成参数列表
+    :param descriptor: 方法描述符
     :param is_static: 是否是静态方法
-    :param params: 参数类型列表
-    :return: 参数列表
+    :return: 参数列表，非静态方法第一个参数为 this（p0），宽类型（long/double）占两个寄存器
     """
-    param_names = []
-    reg_index = 0 if is_static else 1  # 非静态方法参数从 p1 开始
-
-    # 非静态方法：添加 this 参数（p0）
-    if not is_static:
-        param_names.append([['TypeName', ('this', 0)], ['Local', f'p0']])
-
-    # 遍历参数类型，分配寄存器
-    for param in params:
-        param_type = param[1][0]
-        dim = param[1][1]
-
-        # 检查是否为宽类型（long/double）
-        is_wide = (param_type in ('J', 'D')) and (dim == 0)
-
-        # 添加当前参数名（例如 p1）
-        param_names.append([[param[0], param[1]], ['Local', f'p{reg_index}']])
-
-        # 更新寄存器索引（宽类型占2个）
-        reg_index += 2 if is_wide else 1
-
-    return param_names
+    params, _ = ast_signature(descriptor, is_static)
+    # 缓存中的元组可以共享，外层列表每个方法新建，AST 的结构和文本不变
+    return [[['TypeName', type_name], ['Local', reg]] for type_name, reg in params]
 
 
 def convert_method(method):
@@ -46,35 +29,22 @@ def convert_method(method):
         return None
 
     # 获取方法基本信息
-    method_class = method.get_class_name()[1:-1].replace('/', '.')
-    method_name = method.get_name()
-    method_descriptor_list = method.get_descriptor()[1:].split(')')
+    method_descriptor = method.get_descriptor()
 
     # 构建方法triple
     triple = (
-        method_class,
-        method_name,
-        method.get_descriptor()
+        class_name(method.get_class_name()),
+        method.get_name(),
+        method_descriptor
     )
 
-    # 解析返回类型
-    return_type = method_descriptor_list[1]
-    return_type = return_type.removesuffix(';')
-    ret = ['TypeName', (return_type, return_type.count('['))]
-
     # 解析函数修饰符
     flags = method.get_access_flags_string().split(' ')
+    is_static = 'static' in flags
 
-    # 解析参数
-    params = []
-    params_temp = method_descriptor_list[0].split(';')[:-1]
-    is_static = True if 'static' in flags else False
-    for i in range(len(params_temp)):
-        params_temp[i] = params_temp[i].strip()
-    for param in params_temp:
-        temp = ['TypeName', (param, param.count('['))]
-        params.append(temp)
-    params = generate_param_names(params, is_static)
+    # 解析参数和返回类型
+    params = generate_param_names(method_descriptor, is_static)
+    ret = ['TypeName', ast_signature(method_descriptor, is_static)[1]]
 
     # 构建方法体AST
     ast_body = handler.build_body(method, is_static)
@@ -89,14 +59,36 @@ def convert_method(method):
     }
 
 
-def dex_to_ast(dex_path):
-    _, _, dx = AnalyzeDex(dex_path)
-    results = []
-    for method in dx.get_methods():
-        result = convert_method(method.method)
+def iter_dex_ast(dex_path, compact=False, dex_cache=None):
+    """
+    逐个生成dex中方法的AST，转换完一个产出一个
+    :param dex_path: dex文件路径
+    :param compact: 为 True 时生成 CompactAst，所有方法共享一个字符串池
+    :param dex_cache: dex_cache.DexCache，命中时不运行 androguard
+    :return: AST生成器
+    """
+    if dex_cache is not None:
+        methods, _ = dex_cache.load(dex_path)
+    else:
+        # 只需要每个方法的指令，不构建交叉引用
+        with open(dex_path, 'rb') as f:
+            methods = DalvikVMFormat(f.read()).get_methods()
+    pool = StringPool() if compact else None
+    for method in methods:
+        result = convert_method(method)
         if result:
-            results.append(result)
-    return results
+            yield CompactAst.from_ast(result, pool) if compact else result
+
+
+def dex_to_ast(dex_path, compact=False, dex_cache=None):
+    """
+    提取dex中所有方法的AST
+    :param dex_path: dex文件路径
+    :param compact: 为 True 时返回 CompactAst，所有方法共享一个字符串池
+    :param dex_cache: dex_cache.DexCache，命中时不运行 androguard
+    :return: AST列表
+    """
+    return list(iter_dex_ast(dex_path, compact, dex_cache))
 
 
 def main():
@@ -0,0 +1,267 @@
+"""
+AST分词结果的归一化
+ast_tokenizer 保留具体的类名、字段名、字符串常量和寄存器名，每个都会成为 Doc2Vec 的一个词，
+词表和模型文件随语料无限增长，推理也随之变慢。这里在分词之后逐词归一化：
+寄存器编号抽象、包名截断、数值常量分桶，训练语料中出现次数少的词用哈希分桶代替。
+训练和推理使用同一份配置，配置保存在模型文件旁边。
+"""
+import json
+import os
+import re
+import time
+import zlib
+from collections import Counter
+
+from loguru import logger
+
+# 2: 哈希分桶改为使用归一化后的文本
+NORMALIZER_VERSION = 2
+# 这些包中的类是系统 API，保留完整类名
+DEFAULT_KEEP_PACKAGES = ('java.', 'javax.', 'android.', 'androidx.', 'dalvik.', 'kotlin.')
+
+# 词由 repr 产生，前后带有引号、括号、逗号等结构符号，只归一化中间的部分
+_AFFIX_PATTERN = re.compile(r"([(\[{'\"]*)(.*?)(['\",)\]}:]*)", re.DOTALL)
+_REGISTER_PATTERN = re.compile(r'([vp])\d+')
+_INT_PATTERN = re.compile(r'[+-]?(?:0x[0-9a-fA-F]+|\d+)')
+_FLOAT_PATTERN = re.compile(r'[+-]?\d+\.\d*(?:[eE][+-]?\d+)?|[+-]?(?:inf|nan)')
+# 带包名的类名：com.a.B、com/a/B，描述符中为 Lcom/a/B
+_NAME_PATTERN = re.compile(r'(?<![\w$])[\w$]+(?:[./][\w$]+)+')
+_MEMO_SIZE = 1 << 18
+
+
+def normalizer_path(model_path):
+    """
+    :param model_path: 模型路径
+    :return: 模型对应的归一化配置路径
+    """
+    return model_path + '.normalize.json'
+
+
+def load_normalizer(model_path):
+    """
+    读取模型旁边的归一化配置
+    :param model_path: 模型路径
+    :return: TokenNormalizer，模型训练时没有归一化则返回 None
+    """
+    path = normalizer_path(model_path)
+    if not os.path.exists(path):
+        return None
+    return TokenNormalizer.load(path)
+
+
+class TokenNormalizer:
+    """逐词归一化分词结果，实例可以直接作为函数调用"""
+
+    def __init__(self, registers=True, package_depth=2, keep_packages=DEFAULT_KEEP_PACKAGES,
+                 literal_limit=16, hash_buckets=4096, vocabulary=None):
+        """
+        :param registers: 是否把 v3、p1 等寄存器名抽象为 v、p
+        :param package_depth: 包名保留的层数，更深的包和类名替换为 *，为 None 时不截断
+        :param keep_packages: 不截断的包名前缀
+        :param literal_limit: 绝对值不超过该值的整数保留原值，其余按二进制位数分桶，为 None 时不分桶
+        :param hash_buckets: 不在词表中的词哈希到的桶数，为 0 时不哈希
+        :param vocabulary: fit 得到的词表，为 None 时不做哈希
+        """
+        self.registers = registers
+        self.package_depth = package_depth
+        self.keep_packages = tuple(keep_packages)
+        self.literal_limit = literal_limit
+        self.hash_buckets = hash_buckets
+        self.vocabulary = None if vocabulary is None else frozenset(vocabulary)
+        self._memo = {}
+
+    def _truncate_name(self, match):
+        name = match.group()
+        separator = '/' if '/' in name else '.'
+        prefix = ''
+        # 描述符中的类型以 L 开头
+        if separator == '/' and name[0] == 'L':
+            prefix, name = 'L', name[1:]
+        dotted = name.replace('/', '.')
+        if dotted.startswith(self.keep_packages):
+            return match.group()
+        parts = name.split(separator)
+        if len(parts) - 1 <= self.package_depth:
+            return match.group()
+        return prefix + separator.join(parts[:self.package_depth] + ['*'])
+
+    def _bucket(self, core):
+        if _INT_PATTERN.fullmatch(core):
+            sign = core[0] if core[0] in '+-' else ''
+            digits = core.lstrip('+-')
+            value = int(digits, 16) if digits.startswith('0x') else int(digits)
+            if value <= self.literal_limit:
+                return core
+            return f'{sign}#{value.bit_length()}'
+        if _FLOAT_PATTERN.fullmatch(core):
+            return '#f'
+        return core
+
+    def normalize_core(self, core):
+        """
+        归一化去掉前后结构符号的词，不做哈希
+        :param core: 词的中间部分
+        :return: 归一化后的文本
+        """
+        if not core:
+            return core
+        if self.registers and _REGISTER_PATTERN.fullmatch(core):
+            return core[0]
+        if self.literal_limit is not None:
+            bucketed = self._bucket(core)
+            if bucketed is not core:
+                return bucketed
+        if self.package_depth is not None and ('.' in core or '/' in core):
+            return _NAME_PATTERN.sub(self._truncate_name, core)
+        return core
+
+    def _hash(self, core):
+        return f'#h{zlib.crc32(core.encode("utf-8", "surrogatepass")) % self.hash_buckets}'
+
+    def normalize_token(self, token, hashing=True):
+        """
+        :param token: ast_tokenizer 产生的词
+        :param hashing: 是否把不在词表中的词哈希分桶
+        :return: 归一化后的词
+        """
+        key = (token, hashing)
+        result = self._memo.get(key)
+        if result is not None:
+            return result
+        prefix, core, suffix = _AFFIX_PATTERN.fullmatch(token).groups()
+        normalized = self.normalize_core(core)
+        result = prefix + normalized + suffix
+        if hashing and self.vocabulary is not None and self.hash_buckets and result not in self.vocabulary:
+            # 按归一化后的文本分桶，归一化结果相同的罕见词落在同一个桶中
+            result = prefix + self._hash(normalized) + suffix
+        if len(self._memo) >= _MEMO_SIZE:
+            self._memo.clear()
+        self._memo[key] = result
+        return result
+
+    def __call__(self, tokens):
+        """
+        :param tokens: 一个方法的词列表
+        :return: 归一化后的词列表
+        """
+        normalize_token = self.normalize_token
+        return [normalize_token(token) for token in tokens]
+
+    def fit(self, token_lists, min_count=5, max_vocab=None):
+        """
+        统计归一化后的词频，生成词表，之后不在词表中的词都会哈希分桶
+        :param token_lists: 可迭代对象，每项为一个方法的词列表
+        :param min_count: 出现次数低于该值的词不进入词表
+        :param max_vocab: 词表最多保留的词数，按出现次数从高到低选取，为 None 时不限制
+        :return: self
+        """
+        counts = Counter()
+        for tokens in token_lists:
+            counts.update(self.normalize_token(token, hashing=False) for token in tokens)
+        kept = [token for token, count in counts.most_common(max_vocab) if count >= min_count]
+        self.vocabulary = frozenset(kept)
+        self._memo.clear()
+        logger.info(f'归一化后 {len(counts)} 个词，词表保留 {len(self.vocabulary)} 个')
+        return self
+
+    def to_dict(self):
+        return {
+            'version': NORMALIZER_VERSION,
+            'registers': self.registers,
+            'package_depth': self.package_depth,
+            'keep_packages': list(self.keep_packages),
+            'literal_limit': self.literal_limit,
+            'hash_buckets': self.hash_buckets,
+            'vocabulary': None if self.vocabulary is None else sorted(self.vocabulary),
+        }
+
+    def save(self, path):
+        """保存配置和词表"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        if config.pop('version') != NORMALIZER_VERSION:
+            raise ValueError(f'{path}: 归一化配置版本不一致，需要重新训练模型')
+        return cls(**config)
+
+
+def _iter_corpus(corpus_path):
+    with open(corpus_path, encoding='utf-8') as f:
+        for line in f:
+            yield line.split()
+
+
+def normalize_corpus_file(normalizer, corpus_path, output_path, min_count=5, max_vocab=None):
+    """
+    读取两遍语料文件：第一遍生成词表，第二遍写出归一化后的语料，行号与原语料一致
+    :param normalizer: TokenNormalizer
+    :param corpus_path: ast2vec.build_corpus_file 生成的语料文件
+    :param output_path: 归一化后的语料文件
+    :param min_count: 进入词表的最少出现次数
+    :param max_vocab: 词表最多保留的词数
+    :return: (文档数, 词数)
+    """
+    from .ast2vec import write_corpus_file
+    normalizer.fit(_iter_corpus(corpus_path), min_count, max_vocab)
+    return write_corpus_file(map(normalizer, _iter_corpus(corpus_path)), output_path)
+
+
+def _model_size(model_path):
+    """模型文件和单独保存的数组文件的总大小"""
+    directory = os.path.dirname(model_path) or '.'
+    name = os.path.basename(model_path)
+    return sum(os.path.getsize(os.path.join(directory, file_name)) for file_name in os.listdir(directory)
+               if file_name == name or file_name.startswith(name + '.') and file_name.endswith('.npy'))
+
+
+def report(corpus_path, work_dir, normalizer=None, min_count=5, max_vocab=None, sample_size=1000, **train_args):
+    """
+    在同一份语料上分别训练不归一化和归一化的模型，比较词表大小、模型大小和推理速度
+    :param corpus_path: ast2vec.build_corpus_file 生成的语料文件
+    :param work_dir: 保存两个模型的目录
+    :param normalizer: TokenNormalizer，为 None 时使用默认配置
+    :param min_count: 归一化词表的最少出现次数
+    :param max_vocab: 归一化词表最多保留的词数
+    :param sample_size: 用语料前多少个文档测量推理速度
+    :param train_args: 传给 ast2vec.train_model 的训练参数
+    :return: {'raw': 指标, 'normalized': 指标}，指标为 {'vocabulary', 'model_bytes', 'infer_seconds'}
+    """
+    from .ast2vec import load_model, train_model
+    os.makedirs(work_dir, exist_ok=True)
+    normalizer = normalizer or TokenNormalizer()
+    normalized_corpus = os.path.join(work_dir, 'normalized_corpus.txt')
+    normalize_corpus_file(normalizer, corpus_path, normalized_corpus, min_count, max_vocab)
+
+    samples = []
+    for tokens in _iter_corpus(corpus_path):
+        if len(samples) >= sample_size:
+            break
+        samples.append(tokens)
+
+    results = {}
+    for name, corpus, model_normalizer in (('raw', corpus_path, None),
+                                           ('normalized', normalized_corpus, normalizer)):
+        model_path = os.path.join(work_dir, f'{name}.model')
+        train_model(corpus, model_path, normalizer=model_normalizer, **train_args)
+        model = load_model(model_path)
+        start = time.perf_counter()
+        for tokens in samples:
+            # 推理时间包含归一化
+            model.infer_vector(model_normalizer(tokens) if model_normalizer else tokens)
+        results[name] = {
+            'vocabulary': len(model.wv),
+            'model_bytes': _model_size(model_path),
+            'infer_seconds': time.perf_counter() - start,
+        }
+
+    raw, normalized = results['raw'], results['normalized']
+    logger.info(f'{"":14}{"raw":>14}{"normalized":>14}{"change":>10}')
+    for key in ('vocabulary', 'model_bytes', 'infer_seconds'):
+        change = normalized[key] / raw[key] - 1 if raw[key] else 0.0
+        value_format = '>14,.3f' if key == 'infer_seconds' else '>14,'
+        logger.info(f'{key:14}{raw[key]:{value_format}}{normalized[key]:{value_format}}{change:>+10.1%}')
+    return results
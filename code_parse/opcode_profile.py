@@ -0,0 +1,175 @@
+"""
+指令名级别的 AST 构建统计
+开启后 handler.build_body 对每条指令计时，按指令名累计出现次数、处理函数的耗时和生成的语句数，
+用来找出构建 AST 时最耗时的指令，以及被 dispatch_instruction 丢弃的指令
+（没有处理函数，如 const、move、sget、check-cast、goto、switch，或处理函数没有生成语句）。
+统计只在当前进程中进行，多个进程的结果可以保存后用 merge 合并：
+    python -m code_parse.opcode_profile dex_output --sort seconds -o profile.json
+    python -m code_parse.opcode_profile a.json b.json --sort dropped
+"""
+import argparse
+import json
+import os
+from sys import stdout
+
+from loguru import logger
+
+from . import handler
+
+PROFILE_VERSION = 1
+# summary 可以按这些列从大到小排序
+SORT_KEYS = ('seconds', 'count', 'mean_us', 'dropped')
+
+
+class OpcodeProfile:
+    """指令名 -> [次数, 累计秒数, 生成的语句数]，同一时间只应在一个线程中构建 AST"""
+
+    def __init__(self, stats=None):
+        """
+        :param stats: to_dict 保存的统计，为 None 时从空开始
+        """
+        self.stats = {op: list(entry) for op, entry in (stats or {}).items()}
+
+    def merge(self, other):
+        """
+        累加另一个进程的统计
+        :param other: OpcodeProfile
+        :return: self
+        """
+        for op, (count, seconds, statements) in other.stats.items():
+            entry = self.stats.setdefault(op, [0, 0.0, 0])
+            entry[0] += count
+            entry[1] += seconds
+            entry[2] += statements
+        return self
+
+    def reset(self):
+        self.stats.clear()
+
+    def summary(self, sort='seconds'):
+        """
+        :param sort: 排序列，见 SORT_KEYS
+        :return: 每个指令名一行，按 sort 从大到小排列，
+                 handled 为 False 表示没有处理函数，dropped 为没有生成语句的次数
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f'sort 只能是 {SORT_KEYS} 之一')
+        total = sum(seconds for _, seconds, _ in self.stats.values())
+        rows = []
+        for op, (count, seconds, statements) in self.stats.items():
+            rows.append({
+                'op': op,
+                'count': count,
+                'seconds': seconds,
+                'mean_us': seconds / count * 1e6 if count else 0.0,
+                'share': seconds / total if total else 0.0,
+                'handled': handler.DISPATCH_TABLE.get(op) is not None,
+                'statements': statements,
+                'dropped': count - statements,
+            })
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows
+
+    def unhandled(self):
+        """
+        :return: 没有处理函数的指令名及其出现次数，按次数从多到少排列
+        """
+        return [(row['op'], row['count']) for row in self.summary('count') if not row['handled']]
+
+    def to_dict(self):
+        return {'version': PROFILE_VERSION, 'stats': self.stats}
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != PROFILE_VERSION:
+            raise ValueError(f'{path}: 统计文件版本不一致')
+        return cls(data['stats'])
+
+
+def enable(profile=None):
+    """
+    开启统计，之后 build_body 构建的每个方法都计入 profile
+    :param profile: OpcodeProfile，为 None 时新建
+    :return: 正在使用的 OpcodeProfile
+    """
+    profile = profile if profile is not None else OpcodeProfile()
+    handler.set_opcode_profile(profile)
+    return profile
+
+
+def disable():
+    """
+    关闭统计
+    :return: 关闭前使用的 OpcodeProfile，未开启时返回 None
+    """
+    profile = handler.get_opcode_profile()
+    handler.set_opcode_profile(None)
+    return profile
+
+
+def profile_dex_dir(dex_dir, profile=None, dex_cache=None):
+    """
+    对目录中的所有dex构建 AST 并统计
+    :param dex_dir: dex 目录，递归查找 .dex 文件
+    :param profile: 累加到的 OpcodeProfile，为 None 时新建
+    :param dex_cache: dex_cache.DexCache，命中时不运行 androguard
+    :return: OpcodeProfile
+    """
+    from .node2ast import iter_dex_ast
+    dex_paths = sorted(os.path.join(root, name)
+                       for root, _, names in os.walk(dex_dir)
+                       for name in names if name.endswith('.dex'))
+    previous = handler.get_opcode_profile()
+    profile = enable(profile)
+    try:
+        for dex_path in dex_paths:
+            methods = sum(1 for _ in iter_dex_ast(dex_path, dex_cache=dex_cache))
+            logger.debug(f'{dex_path}: {methods} 个方法')
+    finally:
+        handler.set_opcode_profile(previous)
+    return profile
+
+
+def print_summary(profile, sort='seconds', top=None):
+    logger.info(f'{"op":28}{"count":>12}{"seconds":>10}{"mean us":>10}{"share":>8}{"dropped":>12}')
+    for row in profile.summary(sort)[:top]:
+        mark = '' if row['handled'] else '  (unhandled)'
+        logger.info(f'{row["op"]:28}{row["count"]:>12,}{row["seconds"]:>10.3f}{row["mean_us"]:>10.2f}'
+                    f'{row["share"]:>8.1%}{row["dropped"]:>12,}{mark}')
+
+
+def main(argv=None):
+    logger.remove(0)
+    logger.add(stdout, colorize=True, level='INFO')
+    parser = argparse.ArgumentParser(description='统计构建 AST 时每个指令名的次数和耗时')
+    parser.add_argument('inputs', nargs='+', help='dex 目录，或之前保存的统计文件（.json），结果累加')
+    parser.add_argument('--sort', default='seconds', choices=SORT_KEYS)
+    parser.add_argument('--top', type=int, help='只显示前几行')
+    parser.add_argument('--cache', help='dex_cache 的缓存目录')
+    parser.add_argument('-o', '--output', help='统计保存路径')
+    args = parser.parse_args(argv)
+
+    dex_cache = None
+    if args.cache is not None:
+        from dex_cache import DexCache
+        dex_cache = DexCache(args.cache)
+    profile = OpcodeProfile()
+    for path in args.inputs:
+        if os.path.isdir(path):
+            profile_dex_dir(path, profile, dex_cache)
+        else:
+            profile.merge(OpcodeProfile.load(path))
+    print_summary(profile, args.sort, args.top)
+    if args.output:
+        profile.save(args.output)
+        logger.info(f'统计已保存到 {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,24 @@
 """
 把apk文件反编译为dex文件
 """
+import hashlib
+import json
 import os
+import re
 import shutil
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from loguru import logger
 
 from androguard.core.bytecodes.apk import APK
 
+from code_parse import instrument
+from supervisor import FAILURE_CRASH, FAILURE_ERROR
+
+# 与 androguard APK.get_dex_names 使用相同的匹配规则，保证文件顺序和命名一致
+DEX_NAME_PATTERN = re.compile(r"classes(\d*).dex")
+
 
 def clear_folder(folder_path):
     """
@@ -36,35 +48,359 @@ def apk_to_dex(apk_path, output_dir, relative_path):
     :param apk_path: apk文件目录
     :param output_dir: 输出目录
     :param relative_path: 拼接的相对目录
+    :return: 生成的 dex 文件路径列表，处理失败时返回 None
     """
 
     try:
-        # 加载 APK 文件
-        apk = APK(apk_path)
-        # 获取 APK 中的所有 DEX 文件
-        dex_files = apk.get_all_dex()
-        # 获取 APK 文件名（不包含扩展名）
-        apk_name = os.path.splitext(os.path.basename(apk_path))[0]
-        # 构建输出目录，包含相对路径
-        apk_output_dir = os.path.join(output_dir, relative_path)
-        os.makedirs(apk_output_dir, exist_ok=True)
-
-        for i, dex in enumerate(dex_files):
-            # 生成输出 DEX 文件的路径
-            output_path = os.path.join(apk_output_dir, f"{apk_name}{i + 1}.dex" if i > 0 else f"{apk_name}.dex")
-            # 将 DEX 文件写入到指定路径
-            with open(output_path, 'wb') as f:
-                f.write(dex)
-            logger.success(f"DEX file saved to {output_path}")
+        with instrument.item(apk_path), instrument.stage('apk_to_dex'):
+            # 加载 APK 文件
+            apk = APK(apk_path)
+            # 获取 APK 中的所有 DEX 文件
+            dex_files = apk.get_all_dex()
+            # 获取 APK 文件名（不包含扩展名）
+            apk_name = os.path.splitext(os.path.basename(apk_path))[0]
+            # 构建输出目录，包含相对路径
+            apk_output_dir = os.path.join(output_dir, relative_path)
+            os.makedirs(apk_output_dir, exist_ok=True)
+
+            output_paths = []
+            for i, dex in enumerate(dex_files):
+                # 生成输出 DEX 文件的路径
+                output_path = os.path.join(apk_output_dir, f"{apk_name}{i + 1}.dex" if i > 0 else f"{apk_name}.dex")
+                # 将 DEX 文件写入到指定路径
+                with open(output_path, 'wb') as f:
+                    f.write(dex)
+                output_paths.append(output_path)
+                instrument.add(dex=1, bytes=len(dex))
+                logger.success(f"DEX file saved to {output_path}")
+            return output_paths
     except Exception as e:
         logger.error(f"An error occurred while processing {apk_path}: {e}")
+        return None
+
+
+def apk_to_dex_fast(apk_path, output_dir, relative_path, chunk_size=1 << 20):
+    """
+    直接从 zip 中读取 classes*.dex 并分块写入磁盘，不解析 manifest 和资源
+    输出文件命名与 apk_to_dex 相同，内存占用与 dex 大小无关
+    :param apk_path: apk文件目录
+    :param output_dir: 输出目录
+    :param relative_path: 拼接的相对目录
+    :param chunk_size: 每次读写的字节数
+    :return: 生成的 dex 文件路径列表，处理失败时返回 None
+    """
+
+    try:
+        with instrument.item(apk_path), instrument.stage('apk_to_dex_fast'), zipfile.ZipFile(apk_path) as apk_zip:
+            dex_names = [name for name in apk_zip.namelist() if DEX_NAME_PATTERN.match(name)]
+            apk_name = os.path.splitext(os.path.basename(apk_path))[0]
+            apk_output_dir = os.path.join(output_dir, relative_path)
+            os.makedirs(apk_output_dir, exist_ok=True)
+
+            output_paths = []
+            for i, dex_name in enumerate(dex_names):
+                output_path = os.path.join(apk_output_dir, f"{apk_name}{i + 1}.dex" if i > 0 else f"{apk_name}.dex")
+                with apk_zip.open(dex_name) as src, open(output_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, chunk_size)
+                output_paths.append(output_path)
+                instrument.add(dex=1, bytes=apk_zip.getinfo(dex_name).file_size)
+                logger.success(f"DEX file saved to {output_path}")
+        return output_paths
+    except Exception as e:
+        logger.error(f"An error occurred while processing {apk_path}: {e}")
+        return None
+
+
+def file_sha256(file_path, chunk_size=1 << 20):
+    """
+    分块计算文件的 SHA-256
+    :param file_path: 文件路径
+    :param chunk_size: 每次读取的字节数
+    :return: 十六进制摘要
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class DexManifest:
+    """
+    增量反编译清单，保存在输出目录下
+    结构为 {apk 的 SHA-256: {apk 相对路径: {dex 相对路径: 文件大小}}}
+    """
+    FILE_NAME = '.dex_manifest.json'
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, self.FILE_NAME)
+        self.entries = {}
+        # apk 相对路径 -> sha256 的反向索引
+        self.sources = {}
+        # 本次运行中确认仍然有效的 (sha256, apk 相对路径)
+        self.seen = set()
+        self.skipped = 0
+
+    def load(self):
+        """读取清单，文件不存在或损坏时从空清单开始"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            logger.warning(f"Failed to load manifest {self.path}, starting from scratch: {e}")
+            self.entries = {}
+        self.sources = {apk_relative_path: sha256
+                        for sha256, sources in self.entries.items() for apk_relative_path in sources}
+        return self
+
+    def save(self):
+        """先写临时文件再替换，避免中断时留下半个清单"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def previous(self, apk_relative_path):
+        """
+        查找上次运行时该 apk 的记录
+        :param apk_relative_path: apk 相对于 apk 目录的路径
+        :return: (sha256, {dex 相对路径: 文件大小})，没有记录时返回 None
+        """
+        sha256 = self.sources.get(apk_relative_path)
+        if sha256 is None:
+            return None
+        return sha256, self.entries[sha256][apk_relative_path]
+
+    def record(self, apk_relative_path, sha256, outputs, skipped=False):
+        """记录一个处理成功的 apk"""
+        self.entries.setdefault(sha256, {})[apk_relative_path] = outputs
+        self.sources[apk_relative_path] = sha256
+        self.seen.add((sha256, apk_relative_path))
+        if skipped:
+            self.skipped += 1
+
+    def keep(self, apk_relative_path):
+        """源 apk 仍然存在但本次处理失败（如临时的读取错误），保留上次的记录和 dex 文件"""
+        sha256 = self.sources.get(apk_relative_path)
+        if sha256 is not None:
+            self.seen.add((sha256, apk_relative_path))
+
+    def remove_stale(self):
+        """
+        删除源 apk 已不存在或内容已变化的记录及其 dex 文件
+        本次运行中遍历到的每个 apk 都要经过 record 或 keep，否则视为已被删除
+        :return: 删除的 dex 文件数
+        """
+        live_outputs = set()
+        stale_outputs = set()
+        for sha256, sources in list(self.entries.items()):
+            for apk_relative_path, outputs in list(sources.items()):
+                if (sha256, apk_relative_path) in self.seen:
+                    live_outputs.update(outputs)
+                else:
+                    stale_outputs.update(outputs)
+                    del sources[apk_relative_path]
+                    if self.sources.get(apk_relative_path) == sha256:
+                        del self.sources[apk_relative_path]
+            if not sources:
+                del self.entries[sha256]
+
+        removed = 0
+        # 内容变化的 apk 会重新生成同名 dex，仍在使用的文件不能删
+        for output in stale_outputs - live_outputs:
+            output_path = os.path.join(self.output_dir, output)
+            try:
+                os.remove(output_path)
+                removed += 1
+            except FileNotFoundError:
+                continue
+            # 顺便删除因此变空的子目录
+            parent = os.path.dirname(output_path)
+            while os.path.abspath(parent) != os.path.abspath(self.output_dir) and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+        return removed
+
+    @staticmethod
+    def outputs_valid(output_dir, outputs):
+        """检查记录中的 dex 文件是否都还在且大小一致"""
+        for output, size in outputs.items():
+            try:
+                if os.path.getsize(os.path.join(output_dir, output)) != size:
+                    return False
+            except OSError:
+                return False
+        return True
+
+
+def incremental_apk_to_dex(apk_path, output_dir, relative_path, previous=None, fast=False):
+    """
+    增量反编译一个 apk，内容没变且 dex 文件完好时跳过
+    :param apk_path: apk文件目录
+    :param output_dir: 输出目录
+    :param relative_path: 拼接的相对目录
+    :param previous: 清单中上次的记录 (sha256, {dex 相对路径: 文件大小})
+    :param fast: 使用 apk_to_dex_fast 直接从 zip 中提取
+    :return: (sha256, {dex 相对路径: 文件大小}, 是否跳过)，失败时第二项为 None
+    """
+    try:
+        with instrument.item(apk_path), instrument.stage('sha256', bytes=os.path.getsize(apk_path)):
+            sha256 = file_sha256(apk_path)
+    except Exception as e:
+        logger.error(f"An error occurred while hashing {apk_path}: {e}")
+        return None, None, False
+
+    if previous is not None and previous[0] == sha256 and DexManifest.outputs_valid(output_dir, previous[1]):
+        logger.info(f"Skipping unchanged {apk_path}")
+        return sha256, previous[1], True
+
+    extract = apk_to_dex_fast if fast else apk_to_dex
+    output_paths = extract(apk_path, output_dir, relative_path)
+    if output_paths is None:
+        return sha256, None, False
+    outputs = {os.path.relpath(path, output_dir): os.path.getsize(path) for path in output_paths}
+    return sha256, outputs, False
+
+
+def iter_apk_files(apk_dir):
+    """
+    遍历 apk 目录及其所有子目录
+    :param apk_dir: apk 目录
+    :return: 生成 (apk 文件路径, 相对路径)
+    """
+    for root, dirs, files in os.walk(apk_dir):
+        for file in files:
+            if file.endswith('.apk'):
+                yield os.path.join(root, file), os.path.relpath(root, apk_dir)
+
+
+def _pool_apk_to_dex(func, tasks, workers, crashed):
+    """
+    在进程池中反编译 apk，工作进程异常退出时停止提交新任务
+    :param func: 处理单个 apk 的函数，第一个参数是 apk 文件路径
+    :param tasks: func 参数元组的迭代器
+    :param workers: 进程数
+    :param crashed: 进程池崩溃时未完成的任务会追加到这个列表
+    :return: 生成 (参数元组, func 的返回值, 失败原因)，抛出异常时返回值为 None
+    """
+    pending = {}
+    broken = False
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # 限制同时提交的任务数，避免一次性把整个目录都放进队列
+            while not broken and len(pending) < workers * 4:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                logger.info(f"Processing {task[0]}...")
+                try:
+                    pending[executor.submit(func, *task)] = task
+                except BrokenProcessPool:
+                    # 等待结果之前已经有工作进程退出
+                    broken = True
+                    crashed.append(task)
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    crashed.append(task)
+                    continue
+                except Exception as e:
+                    yield task, None, f'{FAILURE_ERROR} ({type(e).__name__}: {e})'
+                    continue
+                yield task, result, None
+
 
+def _run_apk_tasks(func, tasks, workers, supervisor=None):
+    """
+    串行、在进程池中或在受监控的子进程中执行 apk 任务
+    :param supervisor: supervisor.Supervisor，不为 None 时忽略 workers；
+                       之前超时、超出内存或使子进程退出的 apk 按它的失败记录跳过
+    :return: 生成 (参数元组, func 的返回值, 失败原因)，成功时失败原因为 None，失败时返回值为 None
+    """
+    if supervisor is not None:
+        for task, result, failure in supervisor.run(func, tasks):
+            yield task, result, None if failure is None else f'{failure["reason"]} ({failure["detail"]})'
+        return
+
+    if workers <= 1:
+        for task in tasks:
+            logger.info(f"Processing {task[0]}...")
+            try:
+                result = func(*task)
+            except Exception as e:
+                yield task, None, f'{FAILURE_ERROR} ({type(e).__name__}: {e})'
+                continue
+            yield task, result, None
+        return
 
-def batch_apk_to_dex(apk_dir, output_dir):
+    while True:
+        crashed = []
+        yield from _pool_apk_to_dex(func, tasks, workers, crashed)
+        if not crashed:
+            break
+        # 无法确定是哪个 apk 让工作进程退出，逐个放到单独的进程中重试
+        for task in crashed:
+            isolated = []
+            yield from _pool_apk_to_dex(func, iter([task]), 1, isolated)
+            if isolated:
+                yield task, None, f'{FAILURE_CRASH} (worker process exited)'
+
+
+def iter_apk_to_dex(apk_dir, output_dir, workers=1, manifest=None, fast=False, supervisor=None):
+    """
+    反编译目录下的 apk 文件，每处理完一个就返回一个结果
+    :param apk_dir: apk 目录
+    :param output_dir: 输出目录
+    :param workers: 进程数，小于等于 1 时在当前进程中串行处理
+    :param manifest: 增量模式使用的 DexManifest，为 None 时全部重新反编译
+    :param fast: 使用 apk_to_dex_fast 直接从 zip 中提取
+    :param supervisor: supervisor.Supervisor，每个 apk 在受监控的子进程中处理，超时或超出内存时只丢弃这个 apk
+    :return: 生成 (apk 文件路径, dex 文件路径列表)，处理失败时列表为 None
+    """
+    if manifest is None:
+        tasks = ((apk_path, output_dir, relative_path)
+                 for apk_path, relative_path in iter_apk_files(apk_dir))
+        extract = apk_to_dex_fast if fast else apk_to_dex
+        for task, dex_paths, reason in _run_apk_tasks(extract, tasks, workers, supervisor):
+            if reason is not None:
+                logger.error(f"Failed {task[0]}: {reason}")
+            yield task[0], dex_paths
+        return
+
+    tasks = ((apk_path, output_dir, relative_path,
+              manifest.previous(os.path.relpath(apk_path, apk_dir)), fast)
+             for apk_path, relative_path in iter_apk_files(apk_dir))
+    for task, result, reason in _run_apk_tasks(incremental_apk_to_dex, tasks, workers, supervisor):
+        if reason is not None:
+            logger.error(f"Failed {task[0]}: {reason}")
+        sha256, outputs, skipped = result or (None, None, False)
+        if outputs is None:
+            manifest.keep(os.path.relpath(task[0], apk_dir))
+            yield task[0], None
+            continue
+        manifest.record(os.path.relpath(task[0], apk_dir), sha256, outputs, skipped)
+        yield task[0], [os.path.join(output_dir, output) for output in outputs]
+
+
+def batch_apk_to_dex(apk_dir, output_dir, workers=1, incremental=False, fast=False, supervisor=None):
     """
     把一个目录下的 apk 文件全部反编译成 dex 文件
     :param apk_dir: apk 目录
     :param output_dir: 输出目录
+    :param workers: 进程数，小于等于 1 时串行处理
+    :param incremental: 增量模式，跳过内容未变的 apk，只清理源文件已不存在的 dex
+    :param fast: 直接从 zip 中提取 dex，不经过 androguard 的 APK 解析
+    :param supervisor: supervisor.Supervisor，每个 apk 在受监控的子进程中处理，忽略 workers
     """
     # 检查 APK 目录是否存在
     if not os.path.exists(apk_dir):
@@ -72,22 +408,28 @@ def batch_apk_to_dex(apk_dir, output_dir):
         return
     # 检查输出目录是否存在，不存在则创建
     os.makedirs(output_dir, exist_ok=True)
-    clear_folder(output_dir)
+    manifest = None
+    if incremental:
+        manifest = DexManifest(output_dir).load()
+    else:
+        clear_folder(output_dir)
     total_apks = 0
     processed_apks = 0
-    # 遍历 APK 目录及其所有子目录
-    for root, dirs, files in os.walk(apk_dir):
-        for file in files:
-            if file.endswith('.apk'):
-                total_apks += 1
-                apk_path = os.path.join(root, file)
-                # 计算相对路径
-                relative_path = os.path.relpath(root, apk_dir)
-                logger.info(f"Processing {apk_path}...")
-
-                apk_to_dex(apk_path, output_dir, relative_path)
-                processed_apks += 1
-    logger.success(f"Total APKs found: {total_apks}, Processed: {processed_apks}")
+    for apk_path, dex_paths in iter_apk_to_dex(apk_dir, output_dir, workers, manifest, fast, supervisor):
+        total_apks += 1
+        if dex_paths is not None:
+            processed_apks += 1
+        # 定期保存清单，中途退出时下次还能跳过已完成的部分
+        if manifest is not None and total_apks % 1000 == 0:
+            manifest.save()
+    logger.success(f"Total APKs found: {total_apks}, Processed: {processed_apks}, "
+                   f"Failed: {total_apks - processed_apks}")
+    if supervisor is not None:
+        logger.info(f"Supervisor: {supervisor.stats}")
+    if manifest is not None:
+        removed = manifest.remove_stale()
+        manifest.save()
+        logger.success(f"Skipped unchanged: {manifest.skipped}, Removed stale DEX files: {removed}")
 
 
 def main():
@@ -96,7 +438,13 @@ def main():
     # 输出 DEX 文件的根目录
     output_dir = "dex_output"
 
-    batch_apk_to_dex(apk_dir, output_dir)
+    batch_apk_to_dex(apk_dir, output_dir, workers=os.cpu_count(), incremental=True, fast=True)
+    # 语料中有会让 androguard 长时间运行或占用大量内存的 apk 时，每个 apk 在受监控的子进程中处理，
+    # 失败记录中超时或超出内存的 apk 之后不再处理，升级 androguard 后修改 version 或设置 retry_failed=True 重试：
+    # from supervisor import Supervisor
+    # with Supervisor(timeout=600, max_rss_mb=4096, failure_log="dex_output/failures.jsonl",
+    #                 version=androguard.__version__) as supervisor:
+    #     batch_apk_to_dex(apk_dir, output_dir, incremental=True, supervisor=supervisor)
 
 
 if __name__ == "__main__":
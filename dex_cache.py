@@ -0,0 +1,160 @@
+"""
+dex 解析结果缓存
+按 dex 文件的 SHA-256 把每个方法解码后的指令流（以及需要时的 CSR 调用图）保存到磁盘，
+再次处理同一个 dex 时不再运行 androguard 的解析、反汇编和交叉引用分析。
+缓存文件用 pickle 保存，只应读取本机生成的缓存目录。
+"""
+import hashlib
+import os
+import pickle
+
+import androguard
+from androguard.core.analysis.analysis import ExternalMethod
+from androguard.core.bytecodes.dvm import DalvikVMFormat
+from loguru import logger
+
+from code_parse import instrument
+from code_parse.handler import HANDLER_VERSION, DecodedInstruction, decode_instruction
+from feature_fusion import analyze_dex, call_graph_csr
+
+# 指令流格式的版本，修改保存的内容时加一；handler 的操作数解码方式由 HANDLER_VERSION 区分
+STREAM_VERSION = 1
+# androguard 升级后反汇编结果可能不同，旧缓存一并失效
+CACHE_VERSION = f'{STREAM_VERSION}:handler-{HANDLER_VERSION}:androguard-{androguard.__version__}'
+
+
+class CachedMethod:
+    """缓存中的方法，提供 convert_method 和 handler 用到的 EncodedMethod 接口"""
+    __slots__ = ('class_name', 'name', 'descriptor', 'access_flags', 'instructions')
+
+    def __init__(self, class_name, name, descriptor, access_flags, instructions):
+        """
+        :param instructions: DecodedInstruction 列表
+        """
+        self.class_name = class_name
+        self.name = name
+        self.descriptor = descriptor
+        self.access_flags = access_flags
+        self.instructions = instructions
+
+    def get_class_name(self):
+        return self.class_name
+
+    def get_name(self):
+        return self.name
+
+    def get_descriptor(self):
+        return self.descriptor
+
+    def get_access_flags_string(self):
+        return self.access_flags
+
+    def get_instructions(self):
+        return self.instructions
+
+    def __repr__(self):
+        return f'<CachedMethod {self.class_name}->{self.name}{self.descriptor}>'
+
+
+class DexCache:
+    """按 dex 的 SHA-256 缓存方法指令流和调用图"""
+
+    def __init__(self, cache_dir='cache/dex'):
+        """
+        :param cache_dir: 缓存目录
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, sha256):
+        return os.path.join(self.cache_dir, sha256[:2], sha256 + '.pkl')
+
+    def _read(self, sha256):
+        """读取缓存，不存在、损坏或版本不一致时返回 None"""
+        try:
+            with open(self._path(sha256), 'rb') as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f'Failed to load dex cache {sha256}: {e}')
+            return None
+        if entry.get('version') != CACHE_VERSION:
+            return None
+        return entry
+
+    def _write(self, sha256, entry):
+        """先写临时文件再替换，并发写入同一个 dex 时以最后完成的为准"""
+        path = self._path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _build(data, call_graph):
+        """用 androguard 解析dex，生成缓存内容"""
+        dex = DalvikVMFormat(data)
+        methods = dex.get_methods()
+        # 相同的操作数和指令只保存一个对象，pickle 对同一对象只序列化一次，读取时快得多
+        interned = {}
+
+        def intern(value):
+            return interned.setdefault(value, value)
+
+        def stream(method):
+            return tuple(intern((intern(name), intern(tuple(intern(tuple(operand)) for operand in operands))))
+                         for name, operands in map(decode_instruction, method.get_instructions()))
+
+        entry = {
+            'version': CACHE_VERSION,
+            'methods': [(method.get_class_name(), method.get_name(), method.get_descriptor(),
+                         method.get_access_flags_string(), stream(method))
+                        for method in methods],
+            'externals': None,
+            'graph': None,
+        }
+        if call_graph:
+            nodes, indptr, indices = call_graph_csr(dex, analyze_dex(dex))
+            entry['externals'] = [(method.get_class_name(), method.get_name(), method.get_descriptor())
+                                  for method in nodes[len(methods):]]
+            entry['graph'] = (indptr, indices)
+        return entry
+
+    def load(self, dex_path, call_graph=False):
+        """
+        读取dex的方法，缓存未命中时解析并写入缓存
+        :param dex_path: dex文件路径
+        :param call_graph: 是否需要调用图，缓存中没有调用图时会重新分析
+        :return: (方法列表, (indptr, indices))，与 feature_fusion.dex_methods 相同，
+                 call_graph 为 False 时调用图为 None
+        """
+        with open(dex_path, 'rb') as f:
+            data = f.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        entry = self._read(sha256)
+        if entry is None or (call_graph and entry['graph'] is None):
+            self.misses += 1
+            with instrument.stage('dex_cache_build', bytes=len(data)):
+                entry = self._build(data, call_graph)
+                self._write(sha256, entry)
+        else:
+            self.hits += 1
+
+        # 缓存中相同的指令是同一个对象，每个只创建一个 DecodedInstruction
+        decoded = {}
+
+        def instruction(pair):
+            ins = decoded.get(id(pair))
+            if ins is None:
+                ins = decoded[id(pair)] = DecodedInstruction(*pair)
+            return ins
+
+        methods = [CachedMethod(class_name, name, descriptor, access_flags, list(map(instruction, stream)))
+                   for class_name, name, descriptor, access_flags, stream in entry['methods']]
+        if not call_graph:
+            return methods, None
+        methods += [ExternalMethod(*method) for method in entry['externals']]
+        return methods, entry['graph']
@@ -1,7 +1,13 @@
-from androguard.misc import AnalyzeDex
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from androguard.core.analysis.analysis import Analysis, ExternalMethod
+from androguard.core.bytecodes.dvm import DalvikVMFormat
 from loguru import logger
 
-from code_parse import AstFeature
+from code_parse import AstFeature, instrument
 
 
 def fusion(api_feature, ast_feature):
@@ -9,33 +15,382 @@ def fusion(api_feature, ast_feature):
     return [api_feature, ast_feature]
 
 
-def dex2feature(dex_path):
+def method_signature(method):
+    """
+    方法签名，流式输出时代替 androguard 的方法对象作为键
+    :param method: androguard 方法对象
+    :return: 形如 Lcom/a/B;->run(I)V 的字符串
+    """
+    return f'{method.get_class_name()}->{method.get_name()}{method.get_descriptor()}'
+
+
+def _flush_feature_cache():
+    if AstFeature.cache is not None:
+        AstFeature.cache.flush()
+        logger.debug(f'方法特征缓存: {AstFeature.cache.stats()}')
+
+
+def load_dex(dex_path):
+    """
+    只解析dex，不构建交叉引用，AST特征只需要每个方法的指令
+    :param dex_path: dex文件路径
+    :return: DalvikVMFormat
+    """
+    with open(dex_path, 'rb') as f:
+        data = f.read()
+    with instrument.stage('parse_dex', bytes=len(data)):
+        return DalvikVMFormat(data)
+
+
+def analyze_dex(dex):
+    """
+    构建交叉引用
+    不经过 AnalyzeDex，它会把每个dex的分析结果一直保存在 androguard 的默认 session 中
+    :param dex: DalvikVMFormat
+    :return: Analysis
+    """
+    with instrument.stage('analyze'):
+        dx = Analysis(dex)
+        dx.create_xref()
+    return dx
+
+
+def call_graph_csr(dex, dx):
+    """
+    以 CSR 数组的形式构建函数调用图，不经过 networkx
+    节点先按dex中的顺序排列dex中定义的所有方法，再按签名排序排列被调用的外部方法；
+    与 get_call_graph 一样，同一对方法之间只保留一条边
+    :param dex: DalvikVMFormat
+    :param dx: 由 dex 构建的 Analysis
+    :return: (方法列表, indptr, indices)，第 i 个方法调用的方法为 indices[indptr[i]:indptr[i + 1]]
+    """
+    with instrument.stage('call_graph'):
+        methods, indptr, indices = _call_graph_csr(dex, dx)
+        instrument.add(nodes=len(methods), edges=len(indices))
+    return methods, indptr, indices
+
+
+def _call_graph_csr(dex, dx):
+    methods = list(dex.get_methods())
+    external = {}
+    callees = {}
+    for method_analysis in dx.get_methods():
+        caller = method_analysis.get_method()
+        if isinstance(caller, ExternalMethod):
+            external.setdefault(method_signature(caller), caller)
+            continue
+        targets = callees.setdefault(method_signature(caller), set())
+        for _, callee, _ in method_analysis.get_xref_to():
+            signature = method_signature(callee)
+            if isinstance(callee, ExternalMethod):
+                external.setdefault(signature, callee)
+            targets.add(signature)
+    methods += [external[signature] for signature in sorted(external)]
+    index = {method_signature(method): i for i, method in enumerate(methods)}
+
+    indptr = np.zeros(len(methods) + 1, dtype=np.int64)
+    indices = []
+    for i, method in enumerate(methods):
+        row = sorted(index[signature] for signature in callees.get(method_signature(method), ()))
+        indices += row
+        indptr[i + 1] = indptr[i] + len(row)
+    return methods, indptr, np.array(indices, dtype=np.int32)
+
+
+def dex_methods(dex, call_graph=True):
+    """
+    需要提取特征的方法
+    :param dex: DalvikVMFormat
+    :param call_graph: 为 False 时只取dex中定义的方法，不构建交叉引用
+    :return: (方法列表, (indptr, indices))，call_graph 为 False 时调用图为 None
+    """
+    if not call_graph:
+        return list(dex.get_methods()), None
+    methods, indptr, indices = call_graph_csr(dex, analyze_dex(dex))
+    logger.debug('提取FCG完成')
+    return methods, (indptr, indices)
+
+
+def load_methods(dex_path, call_graph=True, dex_cache=None):
+    """
+    读取需要提取特征的方法
+    :param dex_path: dex文件路径
+    :param call_graph: 同 dex_methods
+    :param dex_cache: dex_cache.DexCache，命中时不运行 androguard
+    :return: 同 dex_methods
+    """
+    if dex_cache is not None:
+        return dex_cache.load(dex_path, call_graph)
+    return dex_methods(load_dex(dex_path), call_graph)
+
+
+def dex2feature(dex_path, call_graph=True, dex_cache=None):
     """
     把dex文件转换为FCG及其特征
     :param dex_path: dex文件路径
-    :return: FCG及其特征
+    :param call_graph: 为 False 时不构建交叉引用和调用图，只提取dex中定义的方法，
+                       结果中没有外部方法（外部方法没有代码，特征总是提取失败）
+    :param dex_cache: dex_cache.DexCache，为 None 时每次都用 androguard 解析
+    :return: FCG及其特征，顺序与 call_graph_csr 的节点顺序一致
     """
-    _, _, dx = AnalyzeDex(dex_path)
-    # 创建调用图
-    call_graph = dx.get_call_graph()
     results = {}
 
-    logger.debug('提取FCG完成')
-    # 输出调用图
-    for method in call_graph.nodes():
-        api_feature = []
-        AstFeature.method = method
-        ast_feature = AstFeature.extract_feature()
-        feature = fusion(api_feature, ast_feature)
-        results.update({method: feature})
+    with instrument.stage('dex2feature'):
+        # 一次性推理所有方法的AST特征
+        methods, _ = load_methods(dex_path, call_graph, dex_cache)
+        flags, matrix = AstFeature.extract_features(methods)
+        for method, flag, vector in zip(methods, flags, matrix):
+            api_feature = []
+            feature = fusion(api_feature, (flag, vector))
+            results.update({method: feature})
+
+    _flush_feature_cache()
+    return results
+
+
+def _iter_features(methods, batch_size):
+    for start in range(0, len(methods), batch_size):
+        batch = methods[start:start + batch_size]
+        flags, matrix = AstFeature.extract_features(batch)
+        for method, flag, vector in zip(batch, flags, matrix):
+            api_feature = []
+            yield method_signature(method), fusion(api_feature, (flag, vector))
+
+    _flush_feature_cache()
+
+
+def iter_dex2feature(dex_path, batch_size=1024, call_graph=True, dex_cache=None):
+    """
+    dex2feature 的流式版本，每推理完一批方法就产出结果，不在内存中保留所有方法的特征
+    :param dex_path: dex文件路径
+    :param batch_size: 每批推理的方法数
+    :param call_graph: 同 dex2feature
+    :param dex_cache: 同 dex2feature
+    :return: 生成 (方法签名, 特征)
+    """
+    methods, _ = load_methods(dex_path, call_graph, dex_cache)
+    yield from _iter_features(methods, batch_size)
+
 
+def _class_shards(dex, shards):
+    """
+    按类把方法分成指令数相近的若干组，同一个类的方法总在同一组
+    :param dex: DalvikVMFormat
+    :param shards: 组数
+    :return: 每组的类名列表
+    """
+    sizes = []
+    for cls in dex.get_classes():
+        size = 0
+        for method in cls.get_methods():
+            code = method.get_code()
+            # 没有代码的方法也要转换，按 1 计
+            size += code.get_insns_size() if code else 1
+        sizes.append((size, cls.get_name()))
+    sizes.sort(reverse=True)
+
+    # 每次把最大的类放进当前最小的组
+    heap = [(0, i) for i in range(max(1, min(shards, len(sizes))))]
+    groups = [[] for _ in heap]
+    for size, class_name in sizes:
+        load, i = heapq.heappop(heap)
+        groups[i].append(class_name)
+        heapq.heappush(heap, (load + size, i))
+    return [group for group in groups if group]
+
+
+# 子进程中解析好的dex，按类名索引
+_shard_classes = None
+# fork 得到的父进程缓存，sqlite 连接不能跨进程使用，也不能在子进程中关闭，只保留引用
+_inherited_cache = None
+
+
+def _init_shard_worker(dex_path, model_path, cache_path, cache_capacity):
+    """子进程只解析一次dex，模型以只读内存映射方式加载，多个进程共享同一份物理内存"""
+    global _shard_classes, _inherited_cache
+    _shard_classes = {cls.get_name(): cls for cls in load_dex(dex_path).get_classes()}
+    AstFeature.model_path = model_path
+    _inherited_cache, AstFeature.cache = AstFeature.cache, None
+    if cache_capacity:
+        AstFeature.enable_cache(cache_path, cache_capacity)
+
+
+def _extract_shard(class_names):
+    """
+    提取一组类中所有方法的特征
+    :param class_names: 类名列表
+    :return: (方法签名列表, 是否提取成功列表, 特征矩阵)
+    """
+    methods = [method for class_name in class_names for method in _shard_classes[class_name].get_methods()]
+    # 进程之间已经并行，推理不再开线程
+    flags, matrix = AstFeature.extract_features(methods, workers=1)
+    if AstFeature.cache is not None:
+        AstFeature.cache.flush()
+    return [method_signature(method) for method in methods], flags, matrix
+
+
+def dex2feature_parallel(dex_path, workers=None, shards_per_worker=4, call_graph=True):
+    """
+    dex2feature 的多进程版本，按类把方法分组交给进程池提取，返回值与 dex2feature 相同
+    :param dex_path: dex文件路径
+    :param workers: 进程数，默认为 CPU 核数
+    :param shards_per_worker: 每个进程平均分到的组数，组越多负载越均衡
+    :param call_graph: 同 dex2feature
+    :return: FCG及其特征，顺序与 dex2feature 相同
+    """
+    workers = workers or os.cpu_count()
+    if workers <= 1:
+        return dex2feature(dex_path, call_graph)
+
+    dex = load_dex(dex_path)
+    shards = _class_shards(dex, workers * shards_per_worker)
+    cache = AstFeature.cache
+    features = {}
+    with ProcessPoolExecutor(workers, initializer=_init_shard_worker,
+                             initargs=(dex_path, AstFeature.model_path,
+                                       cache.path if cache else None, cache.capacity if cache else 0)) as executor:
+        futures = [executor.submit(_extract_shard, shard) for shard in shards]
+
+        # 子进程提取特征的同时在主进程中构建调用图
+        methods, _ = dex_methods(dex, call_graph)
+
+        # 按提交顺序合并，结果与完成顺序无关
+        for future in futures:
+            signatures, flags, matrix = future.result()
+            features.update(zip(signatures, zip(flags, matrix)))
+
+    results = {}
+    for method in methods:
+        api_feature = []
+        feature = features.get(method_signature(method))
+        if feature is None:
+            # 外部方法没有代码，与 extract_features 一样记为提取失败
+            feature = (False, np.zeros(AstFeature.model.vector_size, dtype=np.float32))
+        results[method] = fusion(api_feature, feature)
     return results
 
 
+class FeatureWriter:
+    """
+    把方法特征逐条追加到磁盘
+    向量写入 <path>.npy，行数在关闭时回写到文件头，可以直接用 np.load(mmap_mode='r') 读取；
+    方法签名和是否提取成功按行写入 <path>.txt，行号与向量的行号一致
+    """
+
+    def __init__(self, path, vector_size=200):
+        """
+        :param path: 输出文件路径，不含扩展名
+        :param vector_size: 特征向量维数
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.vector_size = vector_size
+        self.rows = 0
+        self._vectors = open(path + '.npy', 'wb')
+        self._index = open(path + '.txt', 'w', encoding='utf-8', errors='surrogatepass')
+        self._header_size = self._write_header()
+
+    def _write_header(self):
+        """写入 .npy 文件头，返回文件头长度，第一维的位数变化时长度不变"""
+        self._vectors.seek(0)
+        np.lib.format.write_array_header_1_0(self._vectors, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+            'fortran_order': False,
+            'shape': (self.rows, self.vector_size),
+        })
+        return self._vectors.tell()
+
+    def write(self, signature, flag, vector):
+        """
+        追加一个方法的特征
+        :param signature: 方法签名
+        :param flag: 是否提取成功
+        :param vector: 特征向量
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape != (self.vector_size,):
+            raise ValueError(f'特征向量维数为 {vector.shape}，应为 ({self.vector_size},)')
+        self._vectors.write(vector.tobytes())
+        self._index.write(f'{int(flag)}\t{signature}\n')
+        self.rows += 1
+
+    def close(self):
+        """回写行数并关闭文件"""
+        if self._vectors.closed:
+            return
+        self._vectors.flush()
+        if self._write_header() != self._header_size:
+            raise RuntimeError(f'{self.path}.npy 文件头长度发生变化')
+        self._vectors.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_features(path, mmap_mode='r'):
+    """
+    读取 FeatureWriter 写出的特征
+    :param path: 输出文件路径，不含扩展名
+    :param mmap_mode: 传给 np.load，默认只读映射
+    :return: (方法签名列表, 是否提取成功列表, 特征矩阵)
+    """
+    signatures = []
+    flags = []
+    with open(path + '.txt', encoding='utf-8', errors='surrogatepass') as f:
+        for line in f:
+            flag, signature = line.rstrip('\n').split('\t', 1)
+            flags.append(flag == '1')
+            signatures.append(signature)
+    matrix = np.load(path + '.npy', mmap_mode=mmap_mode)
+    return signatures, flags, matrix
+
+
+def load_call_graph(path):
+    """
+    读取 dex2feature_file 写出的调用图，不依赖 androguard 和 networkx
+    :param path: 输出文件路径，不含扩展名
+    :return: (indptr, indices)，节点编号与特征矩阵的行号一致
+    """
+    with np.load(path + '.npz') as graph:
+        return graph['indptr'], graph['indices']
+
+
+def dex2feature_file(dex_path, output_path, batch_size=1024, call_graph=True, dex_cache=None):
+    """
+    把dex中所有方法的特征流式写入磁盘，内存占用与方法数无关
+    call_graph 为 True 时调用图以 CSR 数组写入 <output_path>.npz，节点编号与特征的行号一致
+    :param dex_path: dex文件路径
+    :param output_path: 输出文件路径，不含扩展名
+    :param batch_size: 每批推理的方法数
+    :param call_graph: 同 dex2feature
+    :param dex_cache: 同 dex2feature
+    :return: 写入的方法数
+    """
+    with instrument.stage('dex2feature_file'):
+        methods, graph = load_methods(dex_path, call_graph, dex_cache)
+        with FeatureWriter(output_path, AstFeature.model.vector_size) as writer:
+            for signature, (api_feature, (flag, vector)) in _iter_features(methods, batch_size):
+                writer.write(signature, flag, vector)
+        if graph is not None:
+            indptr, indices = graph
+            np.savez(output_path + '.npz', indptr=indptr, indices=indices)
+    return writer.rows
+
+
 def main():
+    # dex_cache 依赖本模块，在这里导入避免循环导入
+    from dex_cache import DexCache
+
     logger.info('begin')
+    AstFeature.enable_cache("cache/method_features.db")
     dex_path = "dex_output/test/test.dex"
-    result = dex2feature(dex_path)
+    result = dex2feature(dex_path, dex_cache=DexCache("cache/dex"))
     logger.info('end')
     for k, v in result.items():
         logger.success(f'{k}:{v}')
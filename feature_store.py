@@ -0,0 +1,325 @@
+"""
+语料级别的方法特征库
+所有 apk 的方法特征保存在一个目录中：
+vectors.f32 按行追加 float32 特征向量，通过内存映射读取；
+index.jsonl 每行对应一行向量，记录 [apk 的 SHA-256, 是否提取成功, 类名, 方法名, 描述符]；
+complete.txt 每行一个所有dex都已写入的 apk 的 SHA-256，中断或部分dex失败的 apk 不在其中，下次继续补全。
+训练时直接按行号读取映射的矩阵，不需要重新运行 androguard。
+同一时间只允许一个进程写入。
+"""
+import json
+import os
+import shutil
+from sys import stdout
+
+import numpy as np
+from loguru import logger
+
+from code_parse import instrument
+from supervisor import FAILURE_ERROR
+
+VECTORS_FILE = 'vectors.f32'
+INDEX_FILE = 'index.jsonl'
+COMPLETE_FILE = 'complete.txt'
+
+
+def split_signature(signature):
+    """
+    把 feature_fusion.method_signature 生成的签名拆成方法三元组
+    :param signature: 形如 Lcom/a/B;->run(I)V 的字符串
+    :return: (类名, 方法名, 描述符)
+    """
+    class_name, rest = signature.split('->', 1)
+    i = rest.index('(')
+    return class_name, rest[:i], rest[i:]
+
+
+class FeatureStore:
+    """
+    方法特征库，(apk 的 SHA-256, 方法三元组) -> 行号的索引保存在内存的字典中，
+    按键或行号读取都是 O(1)
+    """
+
+    def __init__(self, path, vector_size=200):
+        """
+        :param path: 特征库目录，不存在时创建
+        :param vector_size: 特征向量维数
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.vector_size = vector_size
+        self._row_bytes = vector_size * np.dtype(np.float32).itemsize
+        self._vectors_path = os.path.join(path, VECTORS_FILE)
+        self._index_path = os.path.join(path, INDEX_FILE)
+        self._complete_path = os.path.join(path, COMPLETE_FILE)
+        # (apk 的 SHA-256, 三元组) -> 行号
+        self._rows = {}
+        # apk 的 SHA-256 -> 该 apk 的行号区间列表
+        self._apks = {}
+        # 所有dex都已写入的 apk
+        self._complete = set()
+        self._flags = bytearray()
+        self._matrix = None
+        self._load()
+
+    def _load(self):
+        """读取索引，中断的写入以向量和索引中较短的一方为准截断"""
+        vector_rows = os.path.getsize(self._vectors_path) // self._row_bytes \
+            if os.path.exists(self._vectors_path) else 0
+        rows = 0
+        index_bytes = 0
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'rb') as f:
+                for line in f:
+                    if rows == vector_rows or not line.endswith(b'\n'):
+                        break
+                    apk_hash, flag, *triple = json.loads(line)
+                    self._add_key(apk_hash, tuple(triple), rows, flag)
+                    rows += 1
+                    index_bytes += len(line)
+
+        with open(self._vectors_path, 'ab') as f:
+            if f.tell() != rows * self._row_bytes:
+                logger.warning(f'{self.path}: 丢弃未写完的数据，保留 {rows} 行')
+            f.truncate(rows * self._row_bytes)
+        with open(self._index_path, 'ab') as f:
+            f.truncate(index_bytes)
+        if os.path.exists(self._complete_path):
+            with open(self._complete_path, encoding='utf-8') as f:
+                self._complete = {line.rstrip('\n') for line in f if line.endswith('\n')}
+
+    def _add_key(self, apk_hash, triple, row, flag):
+        self._rows[(apk_hash, triple)] = row
+        self._flags.append(1 if flag else 0)
+        ranges = self._apks.setdefault(apk_hash, [])
+        if ranges and ranges[-1].stop == row:
+            ranges[-1] = range(ranges[-1].start, row + 1)
+        else:
+            ranges.append(range(row, row + 1))
+
+    def __len__(self):
+        return len(self._flags)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def has_apk(self, apk_hash):
+        """apk 至少有一行特征，不代表所有dex都已写入，见 is_complete"""
+        return apk_hash in self._apks
+
+    def is_complete(self, apk_hash):
+        return apk_hash in self._complete
+
+    def mark_complete(self, apk_hash):
+        """
+        记录 apk 的所有dex都已写入，在最后一个dex写入之后调用
+        :param apk_hash: apk 的 SHA-256
+        """
+        if apk_hash in self._complete:
+            return
+        with open(self._complete_path, 'a', encoding='utf-8') as f:
+            f.write(apk_hash + '\n')
+        self._complete.add(apk_hash)
+
+    def apk_rows(self, apk_hash):
+        """
+        :param apk_hash: apk 的 SHA-256
+        :return: 该 apk 所有方法的行号区间列表
+        """
+        return list(self._apks.get(apk_hash, ()))
+
+    def row(self, apk_hash, triple):
+        """
+        :param apk_hash: apk 的 SHA-256
+        :param triple: (类名, 方法名, 描述符)
+        :return: 行号，不存在时返回 None
+        """
+        return self._rows.get((apk_hash, tuple(triple)))
+
+    @property
+    def matrix(self):
+        """全部特征向量的只读内存映射，形状为 (行数, vector_size)"""
+        if self._matrix is None or len(self._matrix) != len(self):
+            if not len(self):
+                return np.zeros((0, self.vector_size), dtype=np.float32)
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode='r',
+                                     shape=(len(self), self.vector_size))
+        return self._matrix
+
+    def __getitem__(self, row):
+        """
+        :param row: 行号
+        :return: (是否提取成功, 特征向量)，向量是映射矩阵的视图，不复制数据
+        """
+        return bool(self._flags[row]), self.matrix[row]
+
+    def get(self, apk_hash, triple):
+        """
+        按 apk 和方法读取特征
+        :return: (是否提取成功, 特征向量)，不存在时返回 None
+        """
+        row = self.row(apk_hash, triple)
+        return None if row is None else self[row]
+
+    def iter_batches(self, batch_size=4096):
+        """
+        按行顺序分批读取，供训练流式使用
+        :return: 生成 (起始行号, 是否提取成功的数组, 特征矩阵的视图)
+        """
+        matrix = self.matrix
+        flags = np.frombuffer(bytes(self._flags), dtype=np.uint8).astype(bool)
+        for start in range(0, len(matrix), batch_size):
+            yield start, flags[start:start + batch_size], matrix[start:start + batch_size]
+
+    def append(self, apk_hash, items, chunk_size=4096):
+        """
+        追加一个 apk 的方法特征，已经存在的 (apk, 方法) 会跳过
+        :param apk_hash: apk 的 SHA-256
+        :param items: 可迭代对象，每项为 (方法三元组, 是否提取成功, 特征向量)
+        :param chunk_size: 每写入多少行落盘一次
+        :return: 新写入的行数
+        """
+        written = 0
+        chunk = []
+        keys = set()
+        for triple, flag, vector in items:
+            triple = tuple(triple)
+            if (apk_hash, triple) in self._rows or triple in keys:
+                continue
+            vector = np.asarray(vector, dtype=np.float32)
+            if vector.shape != (self.vector_size,):
+                raise ValueError(f'特征向量维数为 {vector.shape}，应为 ({self.vector_size},)')
+            keys.add(triple)
+            chunk.append((triple, flag, vector))
+            if len(chunk) >= chunk_size:
+                written += self._write(apk_hash, chunk)
+                chunk = []
+        if chunk:
+            written += self._write(apk_hash, chunk)
+        return written
+
+    def _write(self, apk_hash, chunk):
+        """先写向量再写索引，中断时加载会按较短的一方截断"""
+        with open(self._vectors_path, 'ab') as f:
+            f.write(np.stack([vector for _, _, vector in chunk]).tobytes())
+        with open(self._index_path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps([apk_hash, bool(flag), *triple]) + '\n' for triple, flag, _ in chunk)
+        start = len(self)
+        for i, (triple, flag, _) in enumerate(chunk):
+            self._add_key(apk_hash, triple, start + i, flag)
+        return len(chunk)
+
+    def add_dex(self, apk_hash, dex_path, batch_size=1024):
+        """
+        提取一个dex的方法特征并追加
+        :param apk_hash: dex 所属 apk 的 SHA-256
+        :param dex_path: dex文件路径
+        :param batch_size: 每批推理的方法数
+        :return: 新写入的行数
+        """
+        # 只读取特征库时不需要导入 androguard
+        from feature_fusion import iter_dex2feature
+        def items():
+            for signature, (api_feature, (flag, vector)) in iter_dex2feature(dex_path, batch_size):
+                yield split_signature(signature), flag, vector
+        return self.append(apk_hash, items())
+
+
+def extract_apk_features(apk_hash, dex_paths, feature_dir):
+    """
+    在子进程中提取一个 apk 所有dex的方法特征，写到 feature_dir
+    :param apk_hash: apk 的 SHA-256，只用于失败记录
+    :param dex_paths: dex 文件路径列表
+    :param feature_dir: 特征输出目录
+    :return: 每个dex的特征路径（不含扩展名），可以用 feature_fusion.load_features 读取
+    """
+    from feature_fusion import dex2feature_file
+    os.makedirs(feature_dir, exist_ok=True)
+    feature_paths = []
+    with instrument.item(apk_hash):
+        for i, dex_path in enumerate(dex_paths):
+            feature_path = os.path.join(feature_dir, str(i))
+            dex2feature_file(dex_path, feature_path)
+            feature_paths.append(feature_path)
+    return feature_paths
+
+
+def _pending_apks(store, manifest, output_dir):
+    """
+    :return: 生成特征库中还没有写完的 (apk 的 SHA-256, dex 文件路径列表)，
+             只写入了一部分的 apk 也会返回，已经写入的方法由 append 跳过
+    """
+    for apk_hash, sources in manifest.entries.items():
+        if store.is_complete(apk_hash):
+            continue
+        # 同一个 apk 在多个位置出现时只需要提取一次
+        for dex_files in sources.values():
+            yield apk_hash, [os.path.join(output_dir, dex_relative_path) for dex_relative_path in dex_files]
+            break
+
+
+def add_dex_dir(store, output_dir, supervisor=None, work_dir=None):
+    """
+    把 data_prepossess.batch_apk_to_dex 增量模式输出的dex全部加入特征库，
+    所有dex都已写入的 apk 跳过，提取失败的 apk 记录日志后继续处理其他 apk，下次运行时重试
+    :param store: FeatureStore
+    :param output_dir: dex 输出目录，其中需要有增量清单
+    :param supervisor: supervisor.Supervisor，为 None 时在当前进程中提取；
+                       否则每个 apk 在受监控的子进程中提取，超时或超出内存的 apk 不加入特征库，
+                       记录在它的失败记录中，之后的运行跳过，除非设置 retry_failed 或修改 version
+    :param work_dir: 子进程写出特征的临时目录，默认为特征库目录下的 tmp
+    :return: 新加入的 apk 数
+    """
+    from data_prepossess import DexManifest
+    manifest = DexManifest(output_dir).load()
+    pending = _pending_apks(store, manifest, output_dir)
+    added = 0
+    failed = 0
+    if supervisor is None:
+        for apk_hash, dex_paths in pending:
+            try:
+                with instrument.item(apk_hash):
+                    for dex_path in dex_paths:
+                        rows = store.add_dex(apk_hash, dex_path)
+                        logger.debug(f'{dex_path}: {rows} 行')
+            except Exception as e:
+                logger.error(f'{apk_hash}: 未加入特征库，{FAILURE_ERROR} ({type(e).__name__}: {e})')
+                failed += 1
+                continue
+            store.mark_complete(apk_hash)
+            added += 1
+    else:
+        from feature_fusion import load_features
+        work_dir = work_dir or os.path.join(store.path, 'tmp')
+        tasks = ((apk_hash, dex_paths, os.path.join(work_dir, apk_hash)) for apk_hash, dex_paths in pending)
+        for (apk_hash, _, feature_dir), feature_paths, failure in supervisor.run(extract_apk_features, tasks):
+            if failure is None:
+                # 特征库只在当前进程中写入
+                for feature_path in feature_paths:
+                    signatures, flags, matrix = load_features(feature_path)
+                    rows = store.append(apk_hash, ((split_signature(signature), flag, vector)
+                                                   for signature, flag, vector in zip(signatures, flags, matrix)))
+                    logger.debug(f'{feature_path}: {rows} 行')
+                store.mark_complete(apk_hash)
+                added += 1
+            else:
+                logger.error(f'{apk_hash}: 未加入特征库，{failure["reason"]} ({failure["detail"]})')
+                failed += 1
+            shutil.rmtree(feature_dir, ignore_errors=True)
+        try:
+            os.rmdir(work_dir)
+        except OSError:
+            pass
+    logger.info(f'Added APKs: {added}, failed: {failed}, total rows: {len(store)}')
+    return added
+
+
+def main():
+    logger.remove(0)
+    logger.add(stdout, colorize=True, level='INFO')
+    store = FeatureStore('feature_store')
+    add_dex_dir(store, 'dex_output')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,444 @@
+"""
+从 apk 目录到方法特征的流水线
+discover → read → analyze → vectorize → write 各阶段之间用有界队列连接，下游处理不过来时上游阻塞，
+同时在内存中的 apk 和 dex 数量有上限：
+    read       I/O 线程读取 apk、计算 SHA-256，并在内存中解压出 dex，不再先写到磁盘
+    analyze    受监控的子进程解析 dex、构建调用图，并把每个方法转换为 AST 分词结果（AST 阶段在同一进程中，
+               androguard 的方法对象不需要跨进程传输）
+    vectorize  推理线程调用 Doc2Vec.infer_vector
+    write      一个线程按 FeatureWriter 的格式写出特征，每个 apk 一个目录，结果追加到 index.jsonl
+磁盘读取、分析进程和推理线程同时工作。
+index.jsonl 中同一个 apk 路径以最后一条记录为准，每次运行结束时重写为每个路径一条记录；
+内容相同的 apk 只处理一次，其他路径的记录用 duplicate_of 指向处理的那份，特征在同一个 SHA-256 目录中。
+    python pipeline.py data features --workers 8 --timeout 600 --max-rss-mb 4096
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import queue
+import threading
+import time
+import zipfile
+from sys import stdout
+
+import numpy as np
+from loguru import logger
+
+from code_parse import AstFeature, instrument
+from code_parse.ast2vec import infer_vectors, load_model
+from data_prepossess import DEX_NAME_PATTERN, iter_apk_files
+from feature_fusion import FeatureWriter
+from supervisor import NO_TASK, Supervisor
+
+INDEX_FILE = 'index.jsonl'
+FAILURE_FILE = 'failures.jsonl'
+# apk 的所有dex都写完后在其目录中创建，再次运行时跳过
+DONE_FILE = '.done'
+
+# 队列结束标记
+_DONE = object()
+
+# 分析进程中的分词归一化，由 _init_analysis_worker 加载
+_normalizer = None
+
+
+def load_index(output_dir):
+    """
+    读取 index.jsonl，同一个 apk 路径以最后一条记录为准，忽略中断时写了一半的最后一行
+    :param output_dir: Pipeline 的输出目录
+    :return: {apk 相对路径: 记录}，按第一次出现的顺序
+    """
+    index = {}
+    try:
+        with open(os.path.join(output_dir, INDEX_FILE), encoding='utf-8') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    record = json.loads(line)
+                    index[record['apk']] = record
+    except FileNotFoundError:
+        pass
+    return index
+
+
+def _init_analysis_worker(model_path):
+    global _normalizer
+    from code_parse.normalize import load_normalizer
+    _normalizer = load_normalizer(model_path)
+
+
+def analyze_dex_bytes(label, data, call_graph):
+    """
+    在分析进程中把一个dex的每个方法转换为分词结果
+    :param label: <apk 的 SHA-256>/<dex 名>，用于失败记录，耗时统计按 SHA-256 记录
+    :param data: dex 文件内容
+    :param call_graph: 同 feature_fusion.dex2feature
+    :return: (方法签名列表, 是否提取成功列表, 分词结果列表, (indptr, indices) 或 None)，
+             分词结果为空格连接的字符串，跨进程传输比词列表快得多，提取失败的方法为空字符串
+    """
+    from androguard.core.bytecodes.dvm import DalvikVMFormat
+    from code_parse.ast2vec import ast_tokens
+    from code_parse.node2ast import convert_method
+    from feature_fusion import dex_methods, method_signature
+
+    with instrument.item(label.partition('/')[0]):
+        with instrument.stage('parse_dex', bytes=len(data)):
+            dex = DalvikVMFormat(data)
+        methods, graph = dex_methods(dex, call_graph)
+        flags = []
+        documents = []
+        with instrument.stage('convert_method', methods=len(methods)):
+            for method in methods:
+                ast = convert_method(method)
+                flags.append(ast is not None)
+                if ast is None:
+                    documents.append('')
+                    continue
+                tokens = ast_tokens(ast)
+                if _normalizer is not None:
+                    tokens = _normalizer(tokens)
+                documents.append(' '.join(tokens))
+        return [method_signature(method) for method in methods], flags, documents, graph
+
+
+class Pipeline:
+    """一次运行处理 apk_dir 中的所有 apk，特征按 apk 的 SHA-256 分目录写入 output_dir"""
+
+    def __init__(self, apk_dir, output_dir, io_threads=2, analysis_workers=None, inference_threads=2,
+                 queue_size=None, call_graph=True, model_path=None, timeout=None, max_rss_mb=None, retry_failed=False):
+        """
+        :param apk_dir: apk 目录，递归查找 .apk 文件
+        :param output_dir: 输出目录，<SHA-256>/<dex 名>.npy/.txt/.npz 为特征，index.jsonl 为每个 apk 的结果
+        :param io_threads: 读取 apk 的线程数
+        :param analysis_workers: 分析进程数，默认为 CPU 核数
+        :param inference_threads: 推理线程数
+        :param queue_size: 每个队列的容量，默认为分析进程数的 2 倍
+        :param call_graph: 同 feature_fusion.dex2feature，为 True 时同时写出调用图
+        :param model_path: ast2vec 模型路径，默认为 AstFeature 的模型路径
+        :param timeout: 每个dex的分析时间上限（秒），超时的 dex 记为失败
+        :param max_rss_mb: 分析进程的常驻内存上限（MB）
+        :param retry_failed: 重新分析 failures.jsonl 中超时、超出内存或使分析进程退出的 dex，默认直接记为失败
+        """
+        self.apk_dir = apk_dir
+        self.output_dir = output_dir
+        self.io_threads = io_threads
+        self.analysis_workers = analysis_workers or os.cpu_count() or 1
+        self.inference_threads = inference_threads
+        self.queue_size = queue_size or self.analysis_workers * 2
+        self.call_graph = call_graph
+        self.model_path = model_path or AstFeature.model_path
+        self.timeout = timeout
+        self.max_rss_mb = max_rss_mb
+        self.retry_failed = retry_failed
+        self.stats = {'apks': 0, 'duplicates': 0, 'skipped': 0, 'failed_apks': 0, 'dex': 0, 'failed_dex': 0,
+                      'methods': 0, 'extracted': 0}
+        # 阶段名 -> [处理的项数, 累计处理时间]
+        self.stage_stats = {}
+        self._lock = threading.Lock()
+        # 本次运行中读到的 SHA-256 -> 第一个读到的 apk 路径
+        self._seen = {}
+        # index.jsonl 的内容，apk 路径 -> 记录，由 run 加载
+        self._index = {}
+        self._model = None
+        self._supervisor = None
+        # 分析阶段出错时设置，其他阶段不再读取新的 apk
+        self._stop = threading.Event()
+        self._error = None
+
+    def _done_path(self, sha256):
+        return os.path.join(self.output_dir, sha256, DONE_FILE)
+
+    def _count(self, **counters):
+        with self._lock:
+            for key, value in counters.items():
+                self.stats[key] += value
+
+    def _start_stage(self, name, func, inbox, outbox, threads):
+        """
+        启动一个阶段的线程，每个线程从 inbox 取出一项交给 func，所有线程结束后向 outbox 放入结束标记
+        :return: 线程列表
+        """
+        stats = self.stage_stats[name] = [0, 0.0]
+        remaining = [threads]
+
+        def loop():
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    # 留给同一阶段的其他线程
+                    inbox.put(_DONE)
+                    break
+                start = time.perf_counter()
+                try:
+                    func(item)
+                except Exception as e:
+                    logger.exception(f'{name} 阶段出错: {e}')
+                with self._lock:
+                    stats[0] += 1
+                    stats[1] += time.perf_counter() - start
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and outbox is not None:
+                outbox.put(_DONE)
+
+        workers = [threading.Thread(target=loop, name=f'pipeline-{name}-{i}', daemon=True) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def _discover(self):
+        for apk_path, _ in iter_apk_files(self.apk_dir):
+            if self._stop.is_set():
+                break
+            self._discovered.put(apk_path)
+        self._discovered.put(_DONE)
+
+    def _read(self, apk_path):
+        """读取 apk 并解压出所有 dex，每个 dex 作为一项交给分析阶段"""
+        if self._stop.is_set():
+            return
+        relative_path = os.path.relpath(apk_path, self.apk_dir)
+        # 各阶段的耗时都按 SHA-256 记录，读取完才知道，先不设置标识
+        with instrument.item(None), instrument.stage('read_apk'):
+            try:
+                with open(apk_path, 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                record = {'apk': relative_path, 'sha256': None, 'dex': [], 'errors': [f'{type(e).__name__}: {e}'],
+                          'remaining': 0}
+                self._count(apks=1)
+                self._vectorized.put((record, None, None, None))
+                return
+            instrument.add(bytes=len(data))
+            sha256 = hashlib.sha256(data).hexdigest()
+            instrument.set_item(sha256)
+            with self._lock:
+                canonical = self._seen.setdefault(sha256, relative_path)
+            if os.path.exists(self._done_path(sha256)):
+                self._count(**{'skipped' if canonical == relative_path else 'duplicates': 1})
+                if self._index.get(relative_path, {}).get('sha256') != sha256:
+                    # 内容已经处理过，只是位置是新的；已有记录的路径保留原来的记录
+                    self._record_duplicate(relative_path, sha256, self._canonical_path(sha256))
+                return
+            if canonical != relative_path:
+                # 结果与第一份相同，失败时也一样，下次运行与第一份一起重试
+                self._count(duplicates=1)
+                self._record_duplicate(relative_path, sha256, canonical)
+                return
+
+            record = {'apk': relative_path, 'sha256': sha256, 'dex': [], 'errors': []}
+            try:
+                with zipfile.ZipFile(io.BytesIO(data)) as apk_zip:
+                    dex_files = [(name, apk_zip.read(name)) for name in apk_zip.namelist()
+                                 if DEX_NAME_PATTERN.match(name)]
+            except Exception as e:
+                record['errors'].append(f'{type(e).__name__}: {e}')
+                dex_files = []
+        self._count(apks=1)
+        record['remaining'] = len(dex_files)
+        if not dex_files:
+            if not record['errors']:
+                record['errors'].append('apk 中没有dex文件')
+            # 直接交给写入阶段记录结果
+            self._vectorized.put((record, None, None, None))
+            return
+        for name, dex in dex_files:
+            self._extracted.put((record, name, dex))
+
+    def _analysis_tasks(self, labels):
+        """把分析队列转换为 Supervisor 的任务，队列暂时为空时产出 NO_TASK"""
+        while True:
+            try:
+                item = self._extracted.get(timeout=0.05)
+            except queue.Empty:
+                yield NO_TASK
+                continue
+            if item is _DONE:
+                return
+            record, name, data = item
+            label = f'{record["sha256"]}/{name}'
+            labels[label] = (record, name)
+            yield label, data, self.call_graph
+
+    def _analyze(self):
+        """
+        在受监控的子进程中分析dex，失败的dex直接交给写入阶段记录
+        Supervisor 本身出错时停止读取新的 apk，取走已解压的dex让读取线程退出，run 随后抛出这个异常
+        """
+        labels = {}
+        # 分析在子进程中进行，这里只记录完成的dex数
+        stats = self.stage_stats['analyze'] = [0, 0.0]
+        try:
+            for (label, _, _), result, failure in self._supervisor.run(analyze_dex_bytes,
+                                                                       self._analysis_tasks(labels)):
+                record, name = labels.pop(label)
+                stats[0] += 1
+                if failure is None:
+                    self._analyzed.put((record, name, result))
+                else:
+                    self._vectorized.put((record, name, None, f'{failure["reason"]}: {failure["detail"]}'))
+        except Exception as e:
+            logger.exception(f'analyze 阶段出错: {e}')
+            self._error = e
+            self._stop.set()
+            while self._extracted.get() is not _DONE:
+                pass
+        finally:
+            self._analyzed.put(_DONE)
+
+    def _vectorize(self, item):
+        """推理一个dex的特征，出错时把错误交给写入阶段记录，apk 不会从 index.jsonl 中遗漏"""
+        record, name, (signatures, flags, documents, graph) = item
+        try:
+            token_lists = [document.split() for document, flag in zip(documents, flags) if flag]
+            with instrument.item(record['sha256']), \
+                    instrument.stage('infer_vector', inferred=len(token_lists),
+                                     words=sum(map(len, token_lists)) if instrument.enabled() else 0):
+                vectors = infer_vectors(token_lists, self._model, workers=1)
+            matrix = np.zeros((len(flags), self._model.vector_size), dtype=np.float32)
+            matrix[np.flatnonzero(flags)] = vectors
+        except Exception as e:
+            logger.exception(f'{record["apk"]}/{name}: 推理出错: {e}')
+            self._vectorized.put((record, name, None, f'{type(e).__name__}: {e}'))
+            return
+        self._vectorized.put((record, name, (signatures, flags, matrix, graph), None))
+
+    def _write(self, item):
+        """写出一个dex的特征，无论成功与否都计入 apk 的进度，apk 的所有dex都处理完后记录结果"""
+        record, name, result, error = item
+        try:
+            if error is not None:
+                record['errors'].append(f'{name}: {error}')
+                self._count(failed_dex=1)
+            elif result is not None:
+                self._write_features(record, name, *result)
+        except Exception as e:
+            logger.exception(f'{record["apk"]}/{name}: 写入出错: {e}')
+            record['errors'].append(f'{name}: {type(e).__name__}: {e}')
+            self._count(failed_dex=1)
+        finally:
+            if name is not None:
+                record['remaining'] -= 1
+            if record['remaining'] == 0:
+                self._finish_apk(record)
+
+    def _write_features(self, record, name, signatures, flags, matrix, graph):
+        feature_path = os.path.join(self.output_dir, record['sha256'], os.path.splitext(name)[0])
+        with instrument.item(record['sha256']), instrument.stage('write_features', rows=len(signatures)):
+            with FeatureWriter(feature_path, matrix.shape[1]) as writer:
+                for signature, flag, vector in zip(signatures, flags, matrix):
+                    writer.write(signature, flag, vector)
+            if graph is not None:
+                indptr, indices = graph
+                np.savez(feature_path + '.npz', indptr=indptr, indices=indices)
+        extracted = sum(flags)
+        record['dex'].append({'dex': name, 'methods': len(signatures), 'extracted': extracted,
+                              'features': os.path.relpath(feature_path, self.output_dir)})
+        self._count(dex=1, methods=len(signatures), extracted=extracted)
+
+    def _finish_apk(self, record):
+        """apk 的所有dex都已处理，记录结果；全部成功时创建完成标记，下次运行跳过"""
+        del record['remaining']
+        if record['errors']:
+            self._count(failed_apks=1)
+            logger.error(f'{record["apk"]}: {record["errors"]}')
+        else:
+            with open(self._done_path(record['sha256']), 'w'):
+                pass
+        self._append_index(record)
+
+    def _canonical_path(self, sha256):
+        """之前的运行中处理这个 SHA-256 的 apk 路径，没有记录时返回 None"""
+        with self._lock:
+            for record in self._index.values():
+                if record.get('sha256') == sha256 and 'duplicate_of' not in record:
+                    return record['apk']
+        return None
+
+    def _record_duplicate(self, relative_path, sha256, canonical):
+        """记录内容与 canonical 相同的 apk，特征在同一个 SHA-256 目录中"""
+        self._append_index({'apk': relative_path, 'sha256': sha256, 'duplicate_of': canonical, 'dex': [], 'errors': []})
+
+    def _append_index(self, record):
+        """追加到 index.jsonl，中断时已完成的 apk 不会丢失，同一路径以最后一条为准"""
+        with self._lock:
+            self._index[record['apk']] = record
+            with open(os.path.join(self.output_dir, INDEX_FILE), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def _rewrite_index(self):
+        """把 index.jsonl 重写为每个 apk 路径一条记录"""
+        path = os.path.join(self.output_dir, INDEX_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in self._index.values())
+        os.replace(tmp_path, path)
+
+    def run(self):
+        """
+        运行流水线，处理完所有 apk 后返回，分析阶段的 Supervisor 出错时停止并抛出该异常
+        :return: 统计 {'apks', 'duplicates', 'skipped', 'failed_apks', 'dex', 'failed_dex', 'methods', 'extracted',
+                 'seconds', 'stages': {阶段名: [项数, 累计处理秒数]}, 'supervisor': 分析进程的统计}
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        start = time.perf_counter()
+        self._index = load_index(self.output_dir)
+        self._model = load_model(self.model_path)
+        self._discovered, self._extracted, self._analyzed, self._vectorized = \
+            (queue.Queue(self.queue_size) for _ in range(4))
+        self._supervisor = Supervisor(self.analysis_workers, self.timeout, self.max_rss_mb, poll_interval=0.1,
+                                      failure_log=os.path.join(self.output_dir, FAILURE_FILE),
+                                      initializer=_init_analysis_worker, initargs=(self.model_path,),
+                                      retry_failed=self.retry_failed)
+        try:
+            threads = [threading.Thread(target=self._discover, name='pipeline-discover', daemon=True),
+                       threading.Thread(target=self._analyze, name='pipeline-analyze', daemon=True)]
+            for thread in threads:
+                thread.start()
+            threads += self._start_stage('read', self._read, self._discovered, self._extracted, self.io_threads)
+            threads += self._start_stage('vectorize', self._vectorize, self._analyzed, self._vectorized,
+                                         self.inference_threads)
+            threads += self._start_stage('write', self._write, self._vectorized, None, 1)
+            for thread in threads:
+                thread.join()
+        finally:
+            self._supervisor.close()
+        self._rewrite_index()
+        if self._error is not None:
+            raise self._error
+
+        seconds = time.perf_counter() - start
+        stats = dict(self.stats, seconds=seconds, stages=dict(self.stage_stats), supervisor=self._supervisor.stats)
+        logger.success(f'APKs: {stats["apks"]}, failed: {stats["failed_apks"]}, skipped: {stats["skipped"]}, '
+                       f'duplicates: {stats["duplicates"]}, dex: {stats["dex"]}, methods: {stats["methods"]}, '
+                       f'{stats["methods"] / seconds:.0f} methods/s')
+        for name, (items, busy) in self.stage_stats.items():
+            logger.info(f'{name:10} {items:>8} 项，累计 {busy:>8.1f}s')
+        return stats
+
+
+def main(argv=None):
+    logger.remove(0)
+    logger.add(stdout, colorize=True, level='INFO')
+    parser = argparse.ArgumentParser(description='从 apk 目录提取方法特征')
+    parser.add_argument('apk_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--io-threads', type=int, default=2)
+    parser.add_argument('--workers', type=int, help='分析进程数，默认为 CPU 核数')
+    parser.add_argument('--inference-threads', type=int, default=2)
+    parser.add_argument('--queue-size', type=int)
+    parser.add_argument('--no-call-graph', action='store_true', help='不构建调用图，只提取dex中定义的方法')
+    parser.add_argument('--model', help='ast2vec 模型路径')
+    parser.add_argument('--timeout', type=float, help='每个dex的分析时间上限（秒）')
+    parser.add_argument('--max-rss-mb', type=int, help='分析进程的常驻内存上限（MB）')
+    parser.add_argument('--retry-failed', action='store_true', help='重新分析之前超时或超出内存的dex')
+    args = parser.parse_args(argv)
+    Pipeline(args.apk_dir, args.output_dir, args.io_threads, args.workers, args.inference_threads,
+             args.queue_size, not args.no_call_graph, args.model, args.timeout, args.max_rss_mb,
+             args.retry_failed).run()
+
+
+if __name__ == '__main__':
+    main()
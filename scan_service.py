@@ -0,0 +1,313 @@
+"""
+apk 扫描服务
+上传的 apk 作为任务放入有界的进程池，在工作进程中提取 dex 并用 dex2feature_file 把方法特征写入任务目录，
+请求线程只负责保存文件和查询状态，不会被分析阻塞。
+排队和运行中的任务达到上限时直接拒绝新任务，由客户端稍后重试，已接受任务的等待时间因此有上限。
+任务按 apk 的 SHA-256 去重：已有结果时直接返回，正在分析时返回同一个任务。
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from loguru import logger
+
+# 上传的 apk 保存为 classes.apk，apk_to_dex_fast 生成的dex与 apk 中的文件同名
+UPLOAD_NAME = 'classes.apk'
+# 工作进程开始处理任务时在任务目录中创建，已提交到进程池但还在排队的任务没有这个文件
+STARTED_FILE = '.started'
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class ScanQueueFull(RuntimeError):
+    """排队和运行中的任务已达到上限"""
+
+
+def _init_scan_worker(model_path, feature_cache_path):
+    """
+    工作进程启动时加载一次模型，之后所有任务共用
+    模型的大数组以只读内存映射方式加载，多个工作进程共享同一份物理内存
+    """
+    from code_parse import AstFeature
+    if model_path is not None:
+        AstFeature.model_path = model_path
+    # fork 得到的父进程缓存不能在子进程中使用
+    AstFeature.cache = None
+    if feature_cache_path is not None:
+        AstFeature.enable_cache(feature_cache_path)
+    AstFeature.model
+
+
+def scan_apk(apk_path, output_dir):
+    """
+    在工作进程中提取 apk 中所有dex的方法特征
+    :param apk_path: apk文件路径
+    :param output_dir: 特征输出目录，每个dex写出 <dex 名>.npy/.txt/.npz
+    :return: 每个dex的结果 {'dex': dex 名, 'methods': 方法数, 'extracted': 提取成功的方法数,
+             'features': 相对于任务目录的特征路径}，结果会返回给客户端，不包含服务器上的路径
+    """
+    from data_prepossess import apk_to_dex_fast
+    from feature_fusion import dex2feature_file, load_features
+
+    mark_started(output_dir)
+    dex_paths = apk_to_dex_fast(apk_path, output_dir, '')
+    if dex_paths is None:
+        raise ValueError('无法读取 apk')
+    if not dex_paths:
+        raise ValueError('apk 中没有dex文件')
+    results = []
+    for dex_path in dex_paths:
+        name = os.path.splitext(os.path.basename(dex_path))[0]
+        feature_path = os.path.join(output_dir, name)
+        rows = dex2feature_file(dex_path, feature_path)
+        _, flags, _ = load_features(feature_path)
+        # 特征已经写出，dex 不再需要
+        os.remove(dex_path)
+        results.append({'dex': name, 'methods': rows, 'extracted': sum(flags), 'features': name})
+    return results
+
+
+def mark_started(output_dir):
+    """
+    在工作进程中标记任务已开始
+    ProcessPoolExecutor 会提前把排队的任务放进调用队列，future.running() 因此不能区分排队和运行中
+    :param output_dir: 任务目录
+    """
+    with open(os.path.join(output_dir, STARTED_FILE), 'w'):
+        pass
+
+
+class ScanJob:
+    """一次扫描任务"""
+
+    def __init__(self, job_id, job_dir, sha256):
+        self.job_id = job_id
+        self.job_dir = job_dir
+        self.sha256 = sha256
+        self.submitted = time.time()
+        self.finished = None
+        self.future = None
+        self.result = None
+        self.error = None
+
+    @property
+    def status(self):
+        if self.finished is not None:
+            return STATUS_FAILED if self.error is not None else STATUS_DONE
+        if os.path.exists(os.path.join(self.job_dir, STARTED_FILE)):
+            return STATUS_RUNNING
+        return STATUS_QUEUED
+
+    def to_dict(self):
+        end = self.finished if self.finished is not None else time.time()
+        return {
+            'job_id': self.job_id,
+            'sha256': self.sha256,
+            'status': self.status,
+            'submitted': self.submitted,
+            'finished': self.finished,
+            'elapsed': end - self.submitted,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class ScanService:
+    """
+    管理扫描任务和进程池，方法可以在多个请求线程中同时调用
+    同一个 apk（SHA-256 相同）的结果在 result_ttl 内直接复用；正在分析时再次提交会得到同一个任务，
+    不会重复运行 androguard
+    """
+
+    def __init__(self, work_dir='scan_jobs', workers=None, max_pending=None, max_jobs=1000,
+                 result_ttl=3600, model_path=None, feature_cache_path=None):
+        """
+        :param work_dir: 任务目录，每个任务一个子目录，保存上传的 apk 和特征
+        :param workers: 工作进程数，默认为 CPU 核数
+        :param max_pending: 排队和运行中的任务上限，默认为进程数的 4 倍
+        :param max_jobs: 最多保留的已结束任务数，超出时删除最早结束的任务及其目录
+        :param result_ttl: 已结束任务保留的秒数，期间相同 apk 的提交直接返回结果，为 None 时不过期
+        :param model_path: ast2vec 模型路径，为 None 时使用 AstFeature 的默认路径
+        :param feature_cache_path: 方法特征缓存的 sqlite 路径，为 None 时不使用缓存
+        """
+        self.work_dir = work_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.max_jobs = max_jobs
+        self.result_ttl = result_ttl
+        self.model_path = model_path
+        self.feature_cache_path = feature_cache_path
+        self._jobs = {}
+        # 已结束任务，按结束顺序排列
+        self._finished = OrderedDict()
+        # apk 的 SHA-256 -> 排队或运行中的任务
+        self._inflight = {}
+        # apk 的 SHA-256 -> 成功结束且未过期的任务
+        self._results = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self.cache_hits = 0
+        self.attached = 0
+
+    def _get_executor(self):
+        """第一次提交任务时创建进程池"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, initializer=_init_scan_worker,
+                                                 initargs=(self.model_path, self.feature_cache_path))
+        return self._executor
+
+    def _save_upload(self, apk_file):
+        """
+        把上传的 apk 写入临时文件，同时计算 SHA-256
+        :return: (临时文件路径, SHA-256)
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        tmp_path = os.path.join(self.work_dir, f'.upload-{uuid.uuid4().hex}.apk')
+        sha256 = hashlib.sha256()
+        source = open(apk_file, 'rb') if isinstance(apk_file, (str, os.PathLike)) else None
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: (source or apk_file).read(1 << 20), b''):
+                    sha256.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            _remove_file(tmp_path)
+            raise
+        finally:
+            if source is not None:
+                source.close()
+        return tmp_path, sha256.hexdigest()
+
+    def submit(self, apk_file):
+        """
+        提交一个 apk，相同的 apk 已有结果或正在分析时返回已有的任务
+        :param apk_file: apk 文件路径或可读的文件对象
+        :return: (ScanJob, 是否为新任务)
+        :raise ScanQueueFull: 需要新建任务，但排队和运行中的任务已达到上限
+        """
+        tmp_path, sha256 = self._save_upload(apk_file)
+        expired = []
+        try:
+            with self._lock:
+                expired = self._evict_locked()
+                job = self._results.get(sha256)
+                if job is not None:
+                    self.cache_hits += 1
+                    return job, False
+                job = self._inflight.get(sha256)
+                if job is not None:
+                    self.attached += 1
+                    return job, False
+                if len(self._inflight) >= self.max_pending:
+                    raise ScanQueueFull(f'排队和运行中的任务已达到上限 {self.max_pending}')
+
+                job_id = uuid.uuid4().hex
+                job = ScanJob(job_id, os.path.join(self.work_dir, job_id), sha256)
+                os.makedirs(job.job_dir)
+                apk_path = os.path.join(job.job_dir, UPLOAD_NAME)
+                os.replace(tmp_path, apk_path)
+                try:
+                    try:
+                        job.future = self._get_executor().submit(scan_apk, apk_path, job.job_dir)
+                    except BrokenProcessPool:
+                        # 有工作进程异常退出，旧进程池不再接受任务，回收后重建
+                        broken, self._executor = self._executor, None
+                        broken.shutdown(wait=False)
+                        job.future = self._get_executor().submit(scan_apk, apk_path, job.job_dir)
+                except BaseException:
+                    expired.append(job)
+                    raise
+                self._jobs[job_id] = job
+                self._inflight[sha256] = job
+        finally:
+            _remove_file(tmp_path)
+            _remove_job_dirs(expired)
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        logger.info(f'扫描任务 {job.job_id} 已提交: {sha256}')
+        return job, True
+
+    def _finish(self, job, future):
+        """任务结束时在进程池的管理线程中调用"""
+        try:
+            job.result = future.result()
+        except BrokenProcessPool as e:
+            job.error = f'工作进程异常退出: {e}'
+        except Exception as e:
+            job.error = f'{type(e).__name__}: {e}'
+        job.finished = time.time()
+        _remove_file(os.path.join(job.job_dir, UPLOAD_NAME))
+
+        with self._lock:
+            del self._inflight[job.sha256]
+            self._finished[job.job_id] = job
+            # 失败的任务不复用，再次提交时重新分析
+            if job.error is None:
+                self._results[job.sha256] = job
+            expired = self._evict_locked()
+        _remove_job_dirs(expired)
+        if job.error is None:
+            logger.info(f'扫描任务 {job.job_id} 完成，用时 {job.finished - job.submitted:.1f}s')
+        else:
+            logger.error(f'扫描任务 {job.job_id} 失败: {job.error}')
+
+    def _evict_locked(self):
+        """
+        删除超出数量或过期的已结束任务，调用时需持有锁
+        :return: 被删除的任务，目录在锁外删除
+        """
+        expired = []
+        deadline = None if self.result_ttl is None else time.time() - self.result_ttl
+        while self._finished:
+            job = next(iter(self._finished.values()))
+            if len(self._finished) <= self.max_jobs and (deadline is None or job.finished > deadline):
+                break
+            self._finished.popitem(last=False)
+            del self._jobs[job.job_id]
+            if self._results.get(job.sha256) is job:
+                del self._results[job.sha256]
+            expired.append(job)
+        return expired
+
+    def get(self, job_id):
+        """
+        :param job_id: 任务编号
+        :return: ScanJob，不存在或已被清理时返回 None
+        """
+        with self._lock:
+            expired = self._evict_locked()
+            job = self._jobs.get(job_id)
+        _remove_job_dirs(expired)
+        return job
+
+    def stats(self):
+        with self._lock:
+            return {'active': len(self._inflight), 'max_pending': self.max_pending,
+                    'workers': self.workers, 'jobs': len(self._jobs), 'results': len(self._results),
+                    'cache_hits': self.cache_hits, 'attached': self.attached}
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _remove_job_dirs(jobs):
+    for job in jobs:
+        shutil.rmtree(job.job_dir, ignore_errors=True)
@@ -0,0 +1,375 @@
+"""
+受监控的子进程执行
+每个任务（通常是一个 apk）在常驻的子进程中运行，父进程定期检查运行时间和子进程的常驻内存，
+超时或超出内存上限时直接结束该子进程并记录原因，之后按需启动新的子进程，其他任务不受影响。
+子进程处理一定数量的任务后退出重建，androguard 的缓存和内存碎片不会一直累积。
+内存通过 /proc/<pid>/statm 读取，其他系统上只检查超时；子进程的数据段同时用 RLIMIT_DATA 限制，
+在两次检查之间很快分配大量内存的任务会得到 MemoryError，同样记为超出内存。
+超时、超出内存或子进程退出的任务保存在失败记录中，之后的运行直接跳过，除非要求重试或处理代码的版本改变。
+"""
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+
+from loguru import logger
+
+FAILURE_TIMEOUT = 'timeout'
+FAILURE_MEMORY = 'memory'
+FAILURE_CRASH = 'crash'
+FAILURE_ERROR = 'error'
+# 再次运行通常得到同样结果且代价很高的失败，失败记录中这些任务在之后的运行中跳过；
+# 抛出异常的任务失败得很快，每次都重试
+SKIP_REASONS = (FAILURE_TIMEOUT, FAILURE_MEMORY, FAILURE_CRASH)
+
+# run 的任务迭代器暂时没有任务时产出，run 先检查运行中的任务再继续读取
+NO_TASK = object()
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def process_rss(pid):
+    """
+    :param pid: 进程号
+    :return: 进程的常驻内存字节数，无法读取时返回 None
+    """
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _limit_memory(limit):
+    """
+    限制子进程的数据段大小，超出时分配内存抛出 MemoryError，不依赖父进程的轮询
+    :param limit: 字节数
+    """
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+    except (ImportError, AttributeError, ValueError, OSError) as e:
+        logger.warning(f'无法设置子进程的内存上限: {e}')
+
+
+def _worker_main(conn, initializer, initargs, memory_limit=None):
+    """
+    子进程循环：接收 (func, args)，返回 ('ok', 结果)、('memory', 异常描述) 或 ('error', 异常描述)，收到 None 时退出
+    :param memory_limit: 数据段上限（字节），为 None 时不限制
+    """
+    if memory_limit is not None:
+        _limit_memory(memory_limit)
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        func, args = message
+        try:
+            reply = ('ok', func(*args))
+        except MemoryError as e:
+            reply = ('memory', f'{type(e).__name__}: {e}')
+        except Exception as e:
+            reply = ('error', f'{type(e).__name__}: {e}')
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # 结果无法序列化
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+
+
+class _Worker:
+    """父进程中的一个子进程及其当前任务"""
+
+    def __init__(self, context, initializer, initargs, memory_limit=None):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, initializer, initargs, memory_limit),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+        self.task = None
+        self.started = None
+        self.rss = None
+
+    def submit(self, func, task):
+        self.conn.send((func, task))
+        self.task = task
+        self.started = time.monotonic()
+        self.rss = None
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        """让空闲的子进程正常退出"""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class Supervisor:
+    """
+    在受监控的子进程中执行任务，每个子进程同一时间只运行一个任务
+    同一个实例的 run 不能在多个线程中同时调用
+    """
+
+    def __init__(self, workers=None, timeout=None, max_rss_mb=None, max_tasks_per_worker=100,
+                 poll_interval=0.5, failure_log=None, initializer=None, initargs=(), start_method=None,
+                 version=None, retry_failed=False):
+        """
+        :param workers: 子进程数，默认为 CPU 核数
+        :param timeout: 每个任务的墙钟时间上限（秒），为 None 时不限制
+        :param max_rss_mb: 子进程常驻内存上限（MB），为 None 时不限制；子进程的数据段也限制为这个大小
+        :param max_tasks_per_worker: 子进程处理多少个任务后重建，为 None 时不重建
+        :param poll_interval: 检查运行时间和内存的间隔（秒）
+        :param failure_log: 失败记录的 JSON Lines 文件路径，每行一个失败的任务，为 None 时只保存在内存中；
+                            其中版本相同、原因属于 SKIP_REASONS 的任务在 run 中直接跳过
+        :param initializer: 子进程启动时调用的函数，如加载模型
+        :param initargs: initializer 的参数
+        :param start_method: multiprocessing 的启动方式，默认使用系统默认值
+        :param version: 处理代码的版本，写入失败记录，版本不同的失败记录不再跳过
+        :param retry_failed: 为 True 时重试失败记录中的任务，这些记录从文件中删除，再次失败时重新记录
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_rss = None if max_rss_mb is None else max_rss_mb * 1024 * 1024
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.poll_interval = poll_interval
+        self.failure_log = failure_log
+        self.initializer = initializer
+        self.initargs = initargs
+        self.version = version
+        self._context = multiprocessing.get_context(start_method)
+        self._idle = []
+        self.failures = []
+        self.stats = {'completed': 0, 'failed': 0, 'skipped': 0, 'started_workers': 0, 'killed_workers': 0,
+                      'crashed_workers': 0, 'recycled_workers': 0}
+        if self.max_rss is not None and process_rss(os.getpid()) is None:
+            logger.warning('无法读取进程内存，max_rss_mb 不生效')
+        # 失败记录中需要跳过的任务，键为任务的第一个参数
+        self.skip = self._load_skip(retry_failed)
+
+    def _load_skip(self, retry_failed):
+        """
+        读取失败记录中需要跳过的任务
+        :param retry_failed: 为 True 时不跳过，并从文件中删除这些记录
+        :return: {任务的第一个参数: 失败记录}
+        """
+        if self.failure_log is None or not os.path.exists(self.failure_log):
+            return {}
+        failures = load_failures(self.failure_log)
+        skip = {failure['item']: failure for failure in failures
+                if failure.get('version') == self.version and failure['reason'] in SKIP_REASONS}
+        if retry_failed and skip:
+            tmp_path = self.failure_log + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(failure, ensure_ascii=False) + '\n'
+                             for failure in failures if failure['item'] not in skip)
+            os.replace(tmp_path, self.failure_log)
+            logger.info(f'重试失败记录中的 {len(skip)} 个任务')
+            return {}
+        if skip:
+            logger.info(f'跳过失败记录中的 {len(skip)} 个任务，设置 retry_failed 重试')
+        return skip
+
+    def _get_worker(self):
+        if self._idle:
+            return self._idle.pop()
+        self.stats['started_workers'] += 1
+        return self._new_worker()
+
+    def _new_worker(self):
+        return _Worker(self._context, self.initializer, self.initargs, self.max_rss)
+
+    def _submit(self, func, task):
+        """把任务交给空闲的子进程，空闲子进程已经退出时换一个新的"""
+        worker = self._get_worker()
+        try:
+            worker.submit(func, task)
+        except OSError:
+            worker.kill()
+            worker = self._new_worker()
+            self.stats['started_workers'] += 1
+            worker.submit(func, task)
+        return worker
+
+    def _release(self, worker):
+        """任务正常结束，子进程处理的任务数达到上限时重建"""
+        worker.tasks += 1
+        worker.task = None
+        if self.max_tasks_per_worker is not None and worker.tasks >= self.max_tasks_per_worker:
+            worker.stop()
+            self.stats['recycled_workers'] += 1
+        else:
+            self._idle.append(worker)
+
+    def _fail(self, worker, reason, detail):
+        """
+        记录失败的任务
+        :return: 失败记录 {'item', 'reason', 'detail', 'elapsed', 'rss_mb', 'time', 'version'}
+        """
+        task = worker.task
+        failure = {
+            'item': str(task[0]) if task else None,
+            'reason': reason,
+            'detail': detail,
+            'elapsed': worker.elapsed(),
+            'rss_mb': None if worker.rss is None else worker.rss / (1024 * 1024),
+            'time': time.time(),
+            'version': self.version,
+        }
+        self.failures.append(failure)
+        self.stats['failed'] += 1
+        logger.error(f'{failure["item"]}: {reason} ({detail})')
+        if self.failure_log is not None:
+            with open(self.failure_log, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(failure, ensure_ascii=False) + '\n')
+        return failure
+
+    def _check(self, worker):
+        """
+        检查运行中的子进程是否超时或超出内存
+        :return: 失败记录，子进程已被结束；正常时返回 None
+        """
+        if self.timeout is not None and worker.elapsed() > self.timeout:
+            worker.kill()
+            self.stats['killed_workers'] += 1
+            return self._fail(worker, FAILURE_TIMEOUT, f'超过 {self.timeout}s')
+        if self.max_rss is not None:
+            rss = process_rss(worker.process.pid)
+            if rss is not None:
+                worker.rss = max(rss, worker.rss or 0)
+                if rss > self.max_rss:
+                    worker.kill()
+                    self.stats['killed_workers'] += 1
+                    return self._fail(worker, FAILURE_MEMORY, f'常驻内存 {rss / (1024 * 1024):.0f}MB '
+                                                              f'超过 {self.max_rss / (1024 * 1024):.0f}MB')
+        return None
+
+    def _collect(self, worker):
+        """
+        读取已结束任务的结果
+        :return: (结果, 失败记录)
+        """
+        try:
+            status, value = worker.conn.recv()
+        except (EOFError, OSError):
+            # 子进程在任务中退出，如被系统的 OOM killer 结束或解析时段错误
+            worker.process.join()
+            exitcode = worker.process.exitcode
+            worker.conn.close()
+            self.stats['crashed_workers'] += 1
+            return None, self._fail(worker, FAILURE_CRASH, f'子进程退出，退出码 {exitcode}')
+        if status == 'ok':
+            self.stats['completed'] += 1
+            self._release(worker)
+            return value, None
+        if status == 'memory':
+            # 分配失败后子进程的堆可能已经很大，不再复用
+            failure = self._fail(worker, FAILURE_MEMORY, value)
+            worker.stop()
+            self.stats['killed_workers'] += 1
+            return None, failure
+        failure = self._fail(worker, FAILURE_ERROR, value)
+        self._release(worker)
+        return None, failure
+
+    def _wait_timeout(self, busy):
+        """等待到下一次检查的秒数"""
+        timeout = self.poll_interval
+        if self.timeout is not None:
+            remaining = min(self.timeout - worker.elapsed() for worker in busy)
+            timeout = min(timeout, max(remaining, 0))
+        return timeout
+
+    def run(self, func, tasks):
+        """
+        执行任务，结果按完成顺序返回
+        :param func: 在子进程中调用的函数，需要能被 pickle
+        :param tasks: 可迭代对象，每项为 func 的参数元组，第一个参数用于失败记录；
+                      从队列中读取任务时，队列为空可以产出 NO_TASK，不阻塞已完成任务的返回和超时检查
+        :return: 生成 (参数元组, 结果, 失败记录)，成功时失败记录为 None，失败时结果为 None；
+                 跳过的任务返回之前的失败记录
+        """
+        tasks = iter(tasks)
+        busy = []
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(busy) < self.workers:
+                    task = next(tasks, None)
+                    if task is None:
+                        exhausted = True
+                        break
+                    if task is NO_TASK:
+                        break
+                    failure = self.skip.get(str(task[0]))
+                    if failure is not None:
+                        self.stats['skipped'] += 1
+                        logger.warning(f'{failure["item"]}: 跳过，之前 {failure["reason"]} ({failure["detail"]})')
+                        yield task, None, failure
+                        continue
+                    busy.append(self._submit(func, task))
+                if not busy:
+                    if exhausted:
+                        return
+                    continue
+
+                ready = set(wait([worker.conn for worker in busy] + [worker.process.sentinel for worker in busy],
+                                 self._wait_timeout(busy)))
+                for worker in list(busy):
+                    task = worker.task
+                    if worker.conn in ready or worker.process.sentinel in ready:
+                        busy.remove(worker)
+                        result, failure = self._collect(worker)
+                        yield task, result, failure
+                        continue
+                    failure = self._check(worker)
+                    if failure is not None:
+                        busy.remove(worker)
+                        yield task, None, failure
+        finally:
+            # 提前停止迭代时结束仍在运行的任务
+            for worker in busy:
+                worker.kill()
+
+    def close(self):
+        """结束所有空闲的子进程"""
+        while self._idle:
+            self._idle.pop().stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_failures(path):
+    """
+    读取失败记录
+    :param path: Supervisor 的 failure_log
+    :return: 失败记录列表
+    """
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.endswith('\n')]
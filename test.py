@@ -1,6 +1,36 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+from unittest import mock
 from loguru import logger
 
+import numpy as np
+
+import app as web
+import data_prepossess
+import scan_service
+from benchmarks.run import bench_dex2feature, compare, print_comparison
+from benchmarks.synthetic import FIXTURES, build_dex, fixture_path, golden_ast_path
+from code_parse import instrument, opcode_profile
+from code_parse.ast2vec import (ast_tokenizer, ast_tokens, build_corpus_file, infer_vectors, iter_ast_tokens, load_model,
+                                train_model, write_corpus_file)
+from code_parse.cache import MethodFeatureCache
+from code_parse.compact_ast import CompactAst, StringPool
+from code_parse.descriptor import TypeInfo, ast_signature, parameter_registers, parse_method_descriptor
+from code_parse.feature import AstFeatureClass
+from code_parse.node2ast import convert_method, dex_to_ast
+from code_parse.normalize import TokenNormalizer
+from feature_fusion import FeatureWriter, load_features
+from feature_store import FeatureStore, _pending_apks, add_dex_dir
+from pipeline import INDEX_FILE, Pipeline
+from supervisor import FAILURE_CRASH, FAILURE_ERROR, FAILURE_MEMORY, FAILURE_TIMEOUT, Supervisor
+
 
 class MyTestCase(unittest.TestCase):
     def test_logger(self):
@@ -13,5 +43,948 @@ class MyTestCase(unittest.TestCase):
         logger.critical("Unexpected system error occurred. Shutting down.")
 
 
+def _crashing_apk_to_dex(apk_path, output_dir, relative_path):
+    """代替 apk_to_dex_fast，处理 crash.apk 时工作进程直接退出"""
+    if os.path.basename(apk_path) == 'crash.apk':
+        os._exit(1)
+    return data_prepossess.apk_to_dex_fast(apk_path, output_dir, relative_path)
+
+
+class IncrementalDexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.apk_dir = os.path.join(self.tmp_dir, 'apk')
+        self.output_dir = os.path.join(self.tmp_dir, 'dex')
+        os.makedirs(os.path.join(self.apk_dir, 'sub'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_apk(self, relative_path, *dex_files):
+        with zipfile.ZipFile(os.path.join(self.apk_dir, relative_path), 'w') as z:
+            for i, dex in enumerate(dex_files):
+                z.writestr(f'classes{i + 1}.dex' if i > 0 else 'classes.dex', dex)
+
+    def test_incremental(self):
+        self.write_apk('a.apk', b'dex\n035\x00a', b'dex\n035\x00a2')
+        self.write_apk(os.path.join('sub', 'b.apk'), b'dex\n035\x00b')
+        data_prepossess.batch_apk_to_dex(self.apk_dir, self.output_dir, incremental=True)
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'a2.dex')))
+        b_dex = os.path.join(self.output_dir, 'sub', 'b.dex')
+        b_mtime = os.path.getmtime(b_dex)
+
+        # a.apk 内容变化且少了一个 dex，b.apk 不变，新增 c.apk
+        self.write_apk('a.apk', b'dex\n035\x00changed')
+        self.write_apk('c.apk', b'dex\n035\x00c')
+        manifest = data_prepossess.DexManifest(self.output_dir).load()
+        results = dict(data_prepossess.iter_apk_to_dex(self.apk_dir, self.output_dir, manifest=manifest))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(manifest.skipped, 1)
+        self.assertEqual(manifest.remove_stale(), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'a2.dex')))
+        with open(os.path.join(self.output_dir, 'a.dex'), 'rb') as f:
+            self.assertEqual(f.read(), b'dex\n035\x00changed')
+        self.assertEqual(os.path.getmtime(b_dex), b_mtime)
+
+        # 删除源文件后只清理对应的 dex
+        manifest.save()
+        os.remove(os.path.join(self.apk_dir, 'sub', 'b.apk'))
+        data_prepossess.batch_apk_to_dex(self.apk_dir, self.output_dir, incremental=True)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'sub')))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'c.dex')))
+
+    def test_failed_apk_keeps_outputs(self):
+        self.write_apk('a.apk', b'dex\n035\x00a')
+        data_prepossess.batch_apk_to_dex(self.apk_dir, self.output_dir, incremental=True)
+        a_dex = os.path.join(self.output_dir, 'a.dex')
+        self.assertTrue(os.path.exists(a_dex))
+
+        # 源文件还在但这次处理失败，上次的 dex 不能当作过期文件删除
+        with open(os.path.join(self.apk_dir, 'a.apk'), 'wb') as f:
+            f.write(b'not a zip')
+        data_prepossess.batch_apk_to_dex(self.apk_dir, self.output_dir, incremental=True)
+        self.assertTrue(os.path.exists(a_dex))
+        self.assertIsNotNone(data_prepossess.DexManifest(self.output_dir).load().previous('a.apk'))
+
+    def test_parallel_matches_serial(self):
+        for i in range(6):
+            self.write_apk(os.path.join('sub' if i % 2 else '', f'{i}.apk'), f'dex\n035\x00{i}'.encode(),
+                           f'dex\n035\x00{i}b'.encode())
+        outputs = {}
+        for workers in (1, 2):
+            output_dir = os.path.join(self.tmp_dir, f'dex{workers}')
+            data_prepossess.batch_apk_to_dex(self.apk_dir, output_dir, workers=workers)
+            outputs[workers] = {}
+            for root, _, names in os.walk(output_dir):
+                for name in names:
+                    with open(os.path.join(root, name), 'rb') as f:
+                        outputs[workers][os.path.relpath(os.path.join(root, name), output_dir)] = f.read()
+        self.assertEqual(len(outputs[1]), 12)
+        self.assertEqual(outputs[2], outputs[1])
+
+    def test_worker_crash_loses_one_apk(self):
+        for name in ('a', 'b', 'crash', 'c', 'd'):
+            self.write_apk(f'{name}.apk', f'dex\n035\x00{name}'.encode())
+        tasks = ((apk_path, self.output_dir, relative_path)
+                 for apk_path, relative_path in data_prepossess.iter_apk_files(self.apk_dir))
+        results = {os.path.basename(task[0]): (result, reason)
+                   for task, result, reason in data_prepossess._run_apk_tasks(_crashing_apk_to_dex, tasks, workers=2)}
+        # 工作进程退出后其他 apk 重新提交，只有导致退出的 apk 失败
+        self.assertEqual(set(results), {'a.apk', 'b.apk', 'crash.apk', 'c.apk', 'd.apk'})
+        self.assertIsNone(results['crash.apk'][0])
+        self.assertTrue(results['crash.apk'][1].startswith(FAILURE_CRASH))
+        for name in ('a', 'b', 'c', 'd'):
+            self.assertEqual(results[f'{name}.apk'], ([os.path.join(self.output_dir, '.', f'{name}.dex')], None))
+
+    def test_supervisor_failures_skipped(self):
+        for name in ('a', 'crash'):
+            self.write_apk(f'{name}.apk', f'dex\n035\x00{name}'.encode())
+        failure_log = os.path.join(self.tmp_dir, 'failures.jsonl')
+
+        def run(**kwargs):
+            tasks = ((apk_path, self.output_dir, relative_path)
+                     for apk_path, relative_path in data_prepossess.iter_apk_files(self.apk_dir))
+            with Supervisor(workers=1, failure_log=failure_log, version='1', **kwargs) as supervisor:
+                results = {os.path.basename(task[0]): (result, reason) for task, result, reason
+                           in data_prepossess._run_apk_tasks(_crashing_apk_to_dex, tasks, 1, supervisor)}
+            return results, supervisor.stats
+
+        results, stats = run()
+        self.assertTrue(results['crash.apk'][1].startswith(FAILURE_CRASH))
+        self.assertEqual((stats['crashed_workers'], stats['skipped']), (1, 0))
+        # 失败记录中的 apk 不再运行，返回之前的失败原因
+        results, stats = run()
+        self.assertTrue(results['crash.apk'][1].startswith(FAILURE_CRASH))
+        self.assertIsNone(results['a.apk'][1])
+        self.assertEqual((stats['crashed_workers'], stats['skipped']), (0, 1))
+        # 要求重试或版本改变时重新运行
+        _, stats = run(retry_failed=True)
+        self.assertEqual((stats['crashed_workers'], stats['skipped']), (1, 0))
+        _, stats = run()
+        self.assertEqual(stats['skipped'], 1)
+        with open(failure_log, encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_fast_extraction_matches_apk(self):
+        self.write_apk('a.apk', b'dex\n035\x00a', b'dex\n035\x00a2', b'dex\n035\x00a3')
+        apk_path = os.path.join(self.apk_dir, 'a.apk')
+        expected = data_prepossess.apk_to_dex(apk_path, os.path.join(self.tmp_dir, 'slow'), 'x')
+        actual = data_prepossess.apk_to_dex_fast(apk_path, os.path.join(self.tmp_dir, 'fast'), 'x')
+        self.assertEqual([os.path.basename(p) for p in actual], [os.path.basename(p) for p in expected])
+        for slow_path, fast_path in zip(expected, actual):
+            with open(slow_path, 'rb') as f1, open(fast_path, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+
+class MethodFeatureCacheTestCase(unittest.TestCase):
+    def test_memory_and_disk_tiers(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'features.db')
+            cache = MethodFeatureCache(path, capacity=1, namespace='m:')
+            self.assertIsNone(cache.get('a'))
+            cache.put('a', True, [1.0, 2.0])
+            cache.put('b', True, [3.0, 4.0])
+            # 容量为 1，a 已被淘汰，只能从磁盘读取
+            self.assertEqual(cache.get('b')[1].tolist(), [3.0, 4.0])
+            self.assertEqual(cache.get('a')[1].tolist(), [1.0, 2.0])
+            self.assertEqual(cache.stats()['memory_hits'], 1)
+            self.assertEqual(cache.stats()['disk_hits'], 1)
+            self.assertEqual(cache.stats()['misses'], 1)
+            cache.close()
+
+            reopened = MethodFeatureCache(path, namespace='m:')
+            self.assertTrue(reopened.get('b')[0])
+            self.assertIsNone(MethodFeatureCache(path, namespace='other:').get('b'))
+            reopened.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class DexCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        from dex_cache import DexCache
+        dex_path = fixture_path('medium')
+        cache = DexCache(self.tmp_dir)
+        expected = dex_to_ast(dex_path)
+        # 第一次解析并写入缓存，第二次从缓存读取
+        self.assertEqual(dex_to_ast(dex_path, dex_cache=cache), expected)
+        self.assertEqual(dex_to_ast(dex_path, dex_cache=cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_stale_version_ignored(self):
+        import dex_cache
+        dex_path = fixture_path('small')
+        with mock.patch.object(dex_cache, 'CACHE_VERSION', 'stale'):
+            dex_cache.DexCache(self.tmp_dir).load(dex_path)
+        cache = dex_cache.DexCache(self.tmp_dir)
+        methods, _ = cache.load(dex_path)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual([convert_method(method) for method in methods], dex_to_ast(dex_path))
+        # 重新写入的缓存版本是当前版本
+        cache.load(dex_path)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_versions_in_feature_cache_namespace(self):
+        from code_parse import feature
+        model_path = os.path.join(self.tmp_dir, 'model')
+        open(model_path, 'wb').close()
+        namespace = AstFeatureClass(model_path=model_path).enable_cache().namespace
+        with mock.patch.object(feature, 'HANDLER_VERSION', 0):
+            self.assertNotEqual(AstFeatureClass(model_path=model_path).enable_cache().namespace, namespace)
+        with mock.patch.object(feature, 'NORMALIZER_VERSION', 0):
+            self.assertNotEqual(AstFeatureClass(model_path=model_path).enable_cache().namespace, namespace)
+
+
+class AstTokenTestCase(unittest.TestCase):
+    def test_tokens_match_str_tokenizer(self):
+        body = [['ExpressionStatement', ['Assignment', ['Local', 'v0'], ['Literal', -1]]],
+                ['ExpressionStatement', ['MethodInvocation', ['Local', 'v1'], 'append', ['Literal', 'a [b] c']]],
+                ['ExpressionStatement', ['FieldAccess', ['Local', 'v2'], ('La/B;', 'name [I')]],
+                ['LocalDeclaration', ('single',), (), [], {}],
+                ['ReturnStatement', None]] * 40
+        asts = [
+            {'triple': ('La/B;', 'run', '()V'), 'flags': ['public', 'static'],
+             'params': [], 'body': ['BlockStatement', None, body]},
+            ['tab\there', "quote'\"", '\n', True, 1.5, {'k': [1, (2, 3)]}],
+            [],
+        ]
+        for ast in asts:
+            expected = ast_tokenizer(str(ast))
+            self.assertEqual(list(iter_ast_tokens(ast)), expected)
+            self.assertEqual(ast_tokens(ast), expected)
+
+
+class CompactAstTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        pool = StringPool()
+        asts = [
+            {'body': ['BlockStatement', None, [
+                ['ExpressionStatement', ['Assignment', ['Local', 'v0'], ['Literal', -7]]],
+                ['ExpressionStatement', ['Assignment', ['Local', 'v1'], ['Literal', 1 << 40]]],
+                ['ExpressionStatement', ['FieldAccess', ['Local', 'v2'], ('La/B;', 'name I')]],
+                ['ReturnStatement', None]]],
+             'comments': [], 'flags': ['public', 'static'], 'params': [],
+             'ret': ['TypeName', ('V', 0)], 'triple': ('a.B', 'run', '()V')},
+            ['Local', 'v0', True, False, 1.5, (), ('single',), {}, 'Local'],
+        ]
+        compact = [CompactAst.from_ast(ast, pool) for ast in asts]
+        for ast, item in zip(asts, compact):
+            self.assertEqual(item.to_ast(), ast)
+            self.assertEqual(str(item), str(ast))
+        # 节点类型不进入字符串池，相同的字符串只保存一次
+        self.assertNotIn('Local', pool.strings)
+        self.assertEqual(pool.strings.count('v0'), 1)
+
+
+class FeatureWriterTestCase(unittest.TestCase):
+    def test_append_and_load(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'features', 'test')
+            vectors = np.arange(12, dtype=np.float32).reshape(3, 4)
+            with FeatureWriter(path, vector_size=4) as writer:
+                for i, vector in enumerate(vectors):
+                    writer.write(f'La/B;->m{i}()V', i != 1, vector)
+                with self.assertRaises(ValueError):
+                    writer.write('La/B;->bad()V', True, [0.0])
+            signatures, flags, matrix = load_features(path)
+            self.assertEqual(signatures, ['La/B;->m0()V', 'La/B;->m1()V', 'La/B;->m2()V'])
+            self.assertEqual(flags, [True, False, True])
+            np.testing.assert_array_equal(matrix, vectors)
+            del matrix
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class FeatureStoreTestCase(unittest.TestCase):
+    def test_append_lookup_and_reopen(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            store = FeatureStore(tmp_dir, vector_size=4)
+            run = ('La/B;', 'run', '()V')
+            init = ('La/B;', '<init>', '()V')
+            self.assertEqual(store.append('apk1', [(run, True, [1, 2, 3, 4]), (init, False, [0] * 4)]), 2)
+            self.assertEqual(store.append('apk2', [(run, True, [5, 6, 7, 8])]), 1)
+            # 已经存在的方法跳过
+            self.assertEqual(store.append('apk1', [(run, True, [9] * 4)]), 0)
+
+            flag, vector = store.get('apk2', run)
+            self.assertTrue(flag)
+            np.testing.assert_array_equal(vector, [5, 6, 7, 8])
+            self.assertEqual(store.apk_rows('apk1'), [range(0, 2)])
+            del vector
+
+            # 模拟写入中断：向量多出半行
+            with open(os.path.join(tmp_dir, 'vectors.f32'), 'ab') as f:
+                f.write(b'\0' * 6)
+            store = FeatureStore(tmp_dir, vector_size=4)
+            self.assertEqual(len(store), 3)
+            self.assertEqual(store.row('apk1', init), 1)
+            self.assertFalse(store[1][0])
+            np.testing.assert_array_equal(store.matrix[2], [5, 6, 7, 8])
+            self.assertEqual(sum(len(batch) for _, _, batch in store.iter_batches(batch_size=2)), 3)
+            del store
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_resume_incomplete_apks(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            output_dir = os.path.join(tmp_dir, 'dex')
+            os.makedirs(output_dir)
+            manifest = data_prepossess.DexManifest(output_dir)
+            manifest.entries = {'apk1': {'a.apk': {'a.dex': 1, 'a2.dex': 1}}, 'apk2': {'b.apk': {'b.dex': 1}}}
+            manifest.save()
+            store = FeatureStore(os.path.join(tmp_dir, 'store'), vector_size=4)
+            # apk1 只写入了第一个dex，apk2 已经写完
+            store.append('apk1', [(('La/B;', 'run', '()V'), True, [1] * 4)])
+            store.append('apk2', [(('La/C;', 'run', '()V'), True, [2] * 4)])
+            store.mark_complete('apk2')
+            self.assertTrue(store.has_apk('apk1'))
+
+            self.assertEqual([apk_hash for apk_hash, _ in _pending_apks(store, manifest, output_dir)], ['apk1'])
+            # dex 文件不存在，提取失败的 apk 不中断整次运行，也不标记为完成
+            self.assertEqual(add_dex_dir(store, output_dir), 0)
+            store = FeatureStore(os.path.join(tmp_dir, 'store'), vector_size=4)
+            self.assertEqual((store.is_complete('apk1'), store.is_complete('apk2')), (False, True))
+            del store
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class CorpusFileTestCase(unittest.TestCase):
+    def test_write_and_train(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            asts = [{'body': ['ReturnStatement', None], 'triple': ('a.B', 'run', '()V')},
+                    {'body': ['ExpressionStatement', ['Local', 'p1']], 'triple': ('a.B', 'f', '(I)V')}]
+            corpus_path = os.path.join(tmp_dir, 'corpus.txt')
+            documents, words = write_corpus_file((ast_tokens(ast) for ast in asts), corpus_path)
+            self.assertEqual(documents, 2)
+            with open(corpus_path, encoding='utf-8') as f:
+                self.assertEqual([line.split() for line in f], [ast_tokens(ast) for ast in asts])
+
+            model = train_model(corpus_path, vector_size=8, epochs=1, workers=1)
+            self.assertEqual(len(model.dv), documents)
+            self.assertEqual(model.corpus_total_words, words)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_build_from_dex_dir(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dex_dir = os.path.join(tmp_dir, 'dex')
+            os.makedirs(os.path.join(dex_dir, 'b'))
+            shutil.copy(fixture_path('small'), os.path.join(dex_dir, 'a.dex'))
+            # 无法解析的dex被跳过，不影响其他dex
+            with open(os.path.join(dex_dir, 'b', 'bad.dex'), 'wb') as f:
+                f.write(b'dex\n035\0' + b'\xff' * 64)
+            shutil.copy(fixture_path('medium'), os.path.join(dex_dir, 'c.dex'))
+            corpus_path = os.path.join(tmp_dir, 'corpus.txt')
+            documents, words = build_corpus_file(dex_dir, corpus_path, workers=2)
+
+            # 按文件名顺序写出，每个方法一行
+            expected = [tokens for name in ('small', 'medium')
+                        for tokens in map(ast_tokens, dex_to_ast(fixture_path(name))) if tokens]
+            with open(corpus_path, encoding='utf-8') as f:
+                self.assertEqual([line.split() for line in f], expected)
+            self.assertEqual(documents, len(expected))
+            self.assertEqual(words, sum(map(len, expected)))
+            # 没有留下临时文件
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['corpus.txt', 'dex'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class InferVectorsTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.mkdtemp()
+        cls.model_path = _train_fixture_model(cls.model_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_dir)
+
+    def test_threaded_matches_serial(self):
+        model = load_model(self.model_path)
+        token_lists = [ast_tokens(ast) for ast in dex_to_ast(fixture_path('small'))]
+        serial = infer_vectors(token_lists, model, workers=1)
+        threaded = infer_vectors(token_lists, model, workers=4, chunk_size=2)
+        np.testing.assert_array_equal(threaded, serial)
+        # 行顺序与输入一致，每行与单独推理该文档的结果相同
+        for tokens, row in zip(reversed(token_lists), serial[::-1]):
+            np.testing.assert_array_equal(row, infer_vectors([tokens], model, workers=1)[0])
+
+    def test_extract_features_rows(self):
+        from androguard.core.bytecodes.dvm import DalvikVMFormat
+        from feature_fusion import dex_methods
+        with open(fixture_path('small'), 'rb') as f:
+            methods, _ = dex_methods(DalvikVMFormat(f.read()))
+        feature = AstFeatureClass(model_path=self.model_path)
+        flags, matrix = feature.extract_features(methods, workers=2)
+        self.assertEqual(matrix.shape, (len(methods), 8))
+        # 调用图中的外部方法没有代码，对应的行为 0
+        self.assertIn(False, flags)
+        for method, flag, row in zip(methods, flags, matrix):
+            ast = convert_method(method)
+            self.assertEqual(flag, ast is not None)
+            if flag:
+                np.testing.assert_array_equal(row, infer_vectors([ast_tokens(ast)], feature.model, workers=1)[0])
+            else:
+                self.assertFalse(row.any())
+
+
+class ParallelFeatureTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.mkdtemp()
+        cls.model_path = _train_fixture_model(cls.model_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_dir)
+
+    def test_parallel_matches_serial(self):
+        from code_parse import AstFeature
+        from feature_fusion import dex2feature, dex2feature_parallel, method_signature
+        dex_path = fixture_path('medium')
+        with mock.patch.object(AstFeature, 'model_path', self.model_path), \
+                mock.patch.object(AstFeature, '_model', None), mock.patch.object(AstFeature, 'cache', None):
+            serial = list(dex2feature(dex_path).items())
+            parallel = list(dex2feature_parallel(dex_path, workers=2).items())
+        self.assertEqual([method_signature(method) for method, _ in parallel],
+                         [method_signature(method) for method, _ in serial])
+        # 特征为 [api_feature, (flag, vector)]，调用图中的外部方法提取失败
+        self.assertIn(False, [feature[1][0] for _, feature in serial])
+        for (_, parallel_feature), (_, serial_feature) in zip(parallel, serial):
+            self.assertEqual(parallel_feature[0], serial_feature[0])
+            self.assertEqual(parallel_feature[1][0], serial_feature[1][0])
+            np.testing.assert_array_equal(parallel_feature[1][1], serial_feature[1][1])
+
+
+class CallGraphTestCase(unittest.TestCase):
+    def test_csr_matches_xrefs(self):
+        from androguard.core.analysis.analysis import Analysis
+        from code_parse import AstFeature
+        from feature_fusion import dex2feature_file, load_call_graph, load_dex, method_signature
+        dex_path = fixture_path('medium')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            output_path = os.path.join(tmp_dir, 'features')
+            with mock.patch.object(AstFeature, 'model_path', _train_fixture_model(tmp_dir)), \
+                    mock.patch.object(AstFeature, '_model', None), mock.patch.object(AstFeature, 'cache', None):
+                dex2feature_file(dex_path, output_path)
+            signatures, _, matrix = load_features(output_path)
+            indptr, indices = load_call_graph(output_path)
+            self.assertEqual(len(indptr), len(signatures) + 1)
+            self.assertEqual(len(indptr), matrix.shape[0] + 1)
+            edges = {(signatures[i], signatures[j])
+                     for i in range(len(signatures)) for j in indices[indptr[i]:indptr[i + 1]]}
+            # 每个节点的被调用方法按编号排序且不重复
+            for i in range(len(signatures)):
+                row = indices[indptr[i]:indptr[i + 1]].tolist()
+                self.assertEqual(row, sorted(set(row)))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # androguard 的 get_call_graph 与 networkx 3 不兼容，直接从交叉引用得到边
+        dx = Analysis(load_dex(dex_path))
+        dx.create_xref()
+        expected = {(method_signature(method_analysis.get_method()), method_signature(callee))
+                    for method_analysis in dx.get_methods() if not method_analysis.is_external()
+                    for _, callee, _ in method_analysis.get_xref_to()}
+        self.assertTrue(expected)
+        self.assertEqual(edges, expected)
+        self.assertEqual(set(signatures), {method_signature(method_analysis.get_method())
+                                           for method_analysis in dx.get_methods()})
+
+
+class TokenNormalizerTestCase(unittest.TestCase):
+    def test_normalize_fit_and_reload(self):
+        normalizer = TokenNormalizer(package_depth=2, literal_limit=16, hash_buckets=8)
+        self.assertEqual(normalizer.normalize_token("'v12'"), "'v'")
+        self.assertEqual(normalizer.normalize_token("('com.tencent.qqgame.installer.i;',"), "('com.tencent.*;',")
+        self.assertEqual(normalizer.normalize_token("'(Lcom/a/b/C;I)V')}"), "'(Lcom/a/*;I)V')}")
+        self.assertEqual(normalizer.normalize_token("'java.lang.StringBuilder'"), "'java.lang.StringBuilder'")
+        self.assertEqual(normalizer.normalize_token('3,'), '3,')
+        self.assertEqual(normalizer.normalize_token("'+300'"), "'+#9'")
+
+        normalizer.fit([["'Local',", "'v0'", "'rare'"], ["'Local',", "'v5'"]], min_count=2)
+        self.assertEqual(normalizer(["'Local',", "'v3'"]), ["'Local',", "'v'"])
+        # 不在词表中的词哈希分桶，保留结构符号
+        self.assertRegex(normalizer.normalize_token("'rare'"), r"^'#h[0-7]'$")
+        # 归一化结果相同的罕见词落在同一个桶中
+        self.assertEqual(normalizer.normalize_token("('com.rare.a.B;',"), normalizer.normalize_token("('com.rare.c.D;',"))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'normalize.json')
+            normalizer.save(path)
+            reloaded = TokenNormalizer.load(path)
+            tokens = ["'Local',", "'v7'", "'rare'", "('com.a.b.C;',"]
+            self.assertEqual(reloaded(tokens), normalizer(tokens))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class BenchmarkFixtureTestCase(unittest.TestCase):
+    def test_fixtures_are_reproducible(self):
+        for name, args in FIXTURES.items():
+            with open(fixture_path(name), 'rb') as f:
+                self.assertEqual(f.read(), build_dex(**args), name)
+
+
+class BenchmarkRunTestCase(unittest.TestCase):
+    def test_compare_without_items(self):
+        def result(**per_item_us):
+            return {'meta': {'fixture': 'small', 'model': None},
+                    'benchmarks': {name: {'per_item_us': us} for name, us in per_item_us.items()}}
+        rows = compare(result(a=1.0, b=None, c=2.0), result(a=2.0, b=1.0, c=None))
+        self.assertEqual(rows, [('a', 1.0, 2.0, 1.0, True), ('b', None, 1.0, None, False),
+                                ('c', 2.0, None, None, False)])
+        print_comparison(rows)
+
+    def test_dex2feature_keeps_global_feature(self):
+        import feature_fusion
+        from code_parse import AstFeature
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            model = load_model(_train_fixture_model(tmp_dir))
+            cache = AstFeature.cache
+            run, items = bench_dex2feature({'model': model, 'dex_path': fixture_path('small')})
+            self.assertEqual(len(run()), items)
+            self.assertIs(feature_fusion.AstFeature, AstFeature)
+            self.assertIs(AstFeature.cache, cache)
+            self.assertIsNot(AstFeature._model, model)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def _record_child_stage():
+    with instrument.stage('child'):
+        pass
+
+
+class InstrumentTestCase(unittest.TestCase):
+    def tearDown(self):
+        instrument.disable()
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), '需要 fork')
+    def test_fork_while_locked(self):
+        import multiprocessing
+        recorder = instrument.enable()
+        # 模拟 fork 时另一个线程正在记录
+        with recorder._lock:
+            process = multiprocessing.get_context('fork').Process(target=_record_child_stage)
+            process.start()
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+        self.assertEqual(process.exitcode, 0)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), '需要 /proc 读取当前内存')
+    def test_stage_peak_rss(self):
+        recorder = instrument.enable()
+        with instrument.stage('large'):
+            data = b'x' * (128 << 20)
+        del data
+        with instrument.stage('small'):
+            pass
+        stages = recorder.summary()['stages']
+        # 之前阶段的峰值不计入之后的阶段
+        self.assertGreater(stages['large']['peak_rss_kb'] - stages['small']['peak_rss_kb'], 100 << 10)
+        self.assertGreater(stages['large']['rss_growth_kb'], 100 << 10)
+
+    def test_stages_and_items(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'run.jsonl')
+            recorder = instrument.enable(path)
+            with instrument.item('a.apk'), instrument.stage('dex2feature'):
+                with instrument.stage('convert_method', methods=2):
+                    instrument.add(instructions=10)
+                    instrument.add(instructions=5)
+                with instrument.stage('infer_vector'):
+                    pass
+            with instrument.item('b.apk'), instrument.stage('dex2feature'):
+                instrument.add(methods=1)
+            instrument.disable()
+            # 未开启时不记录
+            with instrument.stage('convert_method'):
+                instrument.add(methods=100)
+
+            report = instrument.summarize(instrument.load_records(path))
+            self.assertEqual(report, recorder.summary())
+            self.assertEqual(report['stages']['convert_method']['count'], 1)
+            self.assertEqual(report['stages']['convert_method']['counters'], {'methods': 2, 'instructions': 15})
+            self.assertIn('instructions_per_second', report['stages']['convert_method'])
+            self.assertEqual(report['stages']['dex2feature']['count'], 2)
+            self.assertEqual(report['item_count'], 2)
+            a = next(item for item in report['items'] if item['item'] == 'a.apk')
+            self.assertEqual(set(a['stages']), {'dex2feature', 'convert_method', 'infer_vector'})
+            # 嵌套阶段不重复计入 apk 的总时间
+            self.assertEqual(a['wall'], a['stages']['dex2feature'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class GoldenAstTestCase(unittest.TestCase):
+    def test_small_fixture(self):
+        # 元组按 JSON 转为列表后比较，方法顺序不影响结果
+        asts = json.loads(json.dumps(dex_to_ast(fixture_path('small')), ensure_ascii=False))
+        asts.sort(key=lambda ast: ast['triple'])
+        with open(golden_ast_path('small'), encoding='utf-8') as f:
+            expected = sorted((json.loads(line) for line in f), key=lambda ast: ast['triple'])
+        self.assertEqual(len(asts), len(expected))
+        for ast, golden in zip(asts, expected):
+            self.assertEqual(ast, golden, golden['triple'])
+
+
+class OpcodeProfileTestCase(unittest.TestCase):
+    def test_profile_dex_dir(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(fixture_path('small'), tmp_dir)
+            expected = dex_to_ast(fixture_path('small'))
+            profile = opcode_profile.profile_dex_dir(tmp_dir)
+            # 统计结束后恢复原状，开启统计不改变 AST
+            self.assertIsNone(opcode_profile.disable())
+            opcode_profile.enable(profile)
+            try:
+                self.assertEqual(dex_to_ast(fixture_path('small')), expected)
+            finally:
+                opcode_profile.disable()
+
+            rows = profile.summary('count')
+            self.assertEqual([row['count'] for row in rows], sorted((row['count'] for row in rows), reverse=True))
+            for row in rows:
+                self.assertEqual(row['dropped'], row['count'] - row['statements'])
+                if not row['handled']:
+                    self.assertEqual(row['statements'], 0)
+            path = os.path.join(tmp_dir, 'profile.json')
+            profile.save(path)
+            merged = opcode_profile.OpcodeProfile.load(path).merge(profile)
+            self.assertEqual(merged.stats['return-void'][0], profile.stats['return-void'][0] * 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class DescriptorTestCase(unittest.TestCase):
+    def test_parse_and_share(self):
+        params, ret = parse_method_descriptor('([Ljava/lang/String;JI)Landroid/content/Context;')
+        self.assertEqual(params, (TypeInfo('java.lang.String', 1), TypeInfo('long', 0), TypeInfo('int', 0)))
+        self.assertEqual(ret, TypeInfo('android.content.Context', 0))
+        self.assertEqual(parse_method_descriptor('()V'), ((), TypeInfo('void', 0)))
+        # 相同描述符返回同一个不可变对象
+        self.assertIs(parse_method_descriptor('([Ljava/lang/String;JI)Landroid/content/Context;')[0], params)
+
+        self.assertEqual(parameter_registers('(JI)V', False),
+                         (('p0', TypeInfo('this', 0)), ('p1', TypeInfo('long', 0)), ('p3', TypeInfo('int', 0))))
+        self.assertEqual(parameter_registers('(JI)V', True), (('p0', TypeInfo('long', 0)), ('p2', TypeInfo('int', 0))))
+        # convert_method 的参数保留按 ; 分割的原样文本
+        self.assertEqual(ast_signature('(ILjava/lang/String;[J)[I', True),
+                         (((('ILjava/lang/String', 0), 'p0'),), ('[I', 1)))
+
+
+def _supervised_task(action, value):
+    if action == 'sleep':
+        time.sleep(value)
+    elif action == 'alloc':
+        data = bytearray(value * 1024 * 1024)
+        time.sleep(30)
+        return len(data)
+    elif action == 'exit':
+        os._exit(value)
+    elif action == 'raise':
+        raise ValueError(value)
+    return os.getpid()
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def test_failures_and_recycling(self):
+        tasks = [('exit', 3), ('pid', None), ('raise', 'bad apk'), ('sleep', 30), ('alloc', 256),
+                 ('pid', None), ('pid', None)]
+        with Supervisor(workers=2, timeout=1, max_rss_mb=128, max_tasks_per_worker=2, poll_interval=0.05) as supervisor:
+            results = {task: (result, failure) for task, result, failure in supervisor.run(_supervised_task, tasks)}
+        self.assertEqual(results[('exit', 3)][1]['reason'], FAILURE_CRASH)
+        self.assertEqual(results[('raise', 'bad apk')][1]['reason'], FAILURE_ERROR)
+        self.assertEqual(results[('sleep', 30)][1]['reason'], FAILURE_TIMEOUT)
+        self.assertEqual(results[('alloc', 256)][1]['reason'], FAILURE_MEMORY)
+        # 失败的任务不影响其他任务，子进程被结束后会重新启动
+        self.assertIsNone(results[('pid', None)][1])
+        self.assertNotEqual(results[('pid', None)][0], os.getpid())
+        self.assertEqual(supervisor.stats['completed'], 3)
+        self.assertEqual(supervisor.stats['failed'], 4)
+        self.assertEqual(len(supervisor.failures), 4)
+
+    def test_memory_limit_in_worker(self):
+        # 轮询间隔很长，只能由子进程中的 RLIMIT_DATA 发现超出内存，否则会记为超时
+        with Supervisor(workers=1, timeout=5, max_rss_mb=128, poll_interval=60) as supervisor:
+            (_, result, failure), = supervisor.run(_supervised_task, [('alloc', 512)])
+        self.assertEqual(failure['reason'], FAILURE_MEMORY)
+        self.assertIn('MemoryError', failure['detail'])
+        self.assertLess(failure['elapsed'], 5)
+
+
+def _train_fixture_model(directory):
+    """在 small 样本上训练一个很小的模型，返回模型路径"""
+    corpus_path = os.path.join(directory, 'corpus.txt')
+    model_path = os.path.join(directory, 'ast2vec.model')
+    write_corpus_file((ast_tokens(ast) for ast in dex_to_ast(fixture_path('small'))), corpus_path)
+    train_model(corpus_path, model_path, vector_size=8, epochs=1, workers=1)
+    return model_path
+
+
+def _write_fixture_apk(path, comment=b''):
+    """把 small 样本打包为 apk，comment 不同时 SHA-256 不同"""
+    with zipfile.ZipFile(path, 'w') as apk:
+        apk.write(fixture_path('small'), 'classes.dex')
+        apk.comment = comment
+
+
+class PipelineTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.mkdtemp()
+        cls.model_path = _train_fixture_model(cls.model_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_dir)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.apk_dir = os.path.join(self.tmp_dir, 'apk')
+        self.output_dir = os.path.join(self.tmp_dir, 'features')
+        os.makedirs(os.path.join(self.apk_dir, 'sub'))
+
+    def tearDown(self):
+        instrument.disable()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_pipeline(self, **kwargs):
+        return Pipeline(self.apk_dir, self.output_dir, analysis_workers=1, model_path=self.model_path, **kwargs).run()
+
+    def load_index(self):
+        with open(os.path.join(self.output_dir, INDEX_FILE), encoding='utf-8') as f:
+            return {os.path.basename(record['apk']): record for record in map(json.loads, f)}
+
+    def test_apk_dir(self):
+        _write_fixture_apk(os.path.join(self.apk_dir, 'a.apk'))
+        shutil.copy(os.path.join(self.apk_dir, 'a.apk'), os.path.join(self.apk_dir, 'sub', 'copy.apk'))
+        with open(os.path.join(self.apk_dir, 'broken.apk'), 'wb') as f:
+            f.write(b'not a zip')
+
+        instrument_path = os.path.join(self.tmp_dir, 'instrument.jsonl')
+        instrument.enable(instrument_path)
+        stats = self.run_pipeline()
+        instrument.disable()
+        self.assertEqual((stats['apks'], stats['duplicates'], stats['failed_apks']), (2, 1, 1))
+        records = self.load_index()
+        self.assertEqual(set(records), {'a.apk', 'copy.apk', 'broken.apk'})
+        self.assertTrue(records['broken.apk']['errors'])
+        # 内容相同的两个 apk 只处理一次，另一个路径的记录指向处理的那份
+        record, duplicate = sorted((records['a.apk'], records['copy.apk']), key=lambda r: 'duplicate_of' in r)
+        self.assertEqual(duplicate['duplicate_of'], record['apk'])
+        self.assertEqual(duplicate['sha256'], record['sha256'])
+        self.assertEqual(record['errors'], [])
+        dex, = record['dex']
+        signatures, flags, matrix = load_features(os.path.join(self.output_dir, dex['features']))
+        self.assertEqual(len(signatures), dex['methods'])
+        self.assertEqual(sum(flags), dex['extracted'])
+        self.assertEqual(matrix.shape, (dex['methods'], 8))
+
+        # 所有阶段（包括分析进程中的阶段）都按 apk 的 SHA-256 记录
+        report = instrument.summarize(instrument.load_records(instrument_path))
+        self.assertEqual({item['item'] for item in report['items']}, {r['sha256'] for r in records.values()})
+        stages = next(item for item in report['items'] if item['item'] == record['sha256'])['stages']
+        self.assertTrue({'read_apk', 'parse_dex', 'convert_method', 'infer_vector', 'write_features'} <= set(stages))
+
+        # 已完成的 apk 再次运行时跳过，新位置的副本也记录下来
+        shutil.copy(os.path.join(self.apk_dir, 'a.apk'), os.path.join(self.apk_dir, 'moved.apk'))
+        stats = self.run_pipeline()
+        self.assertEqual((stats['apks'], stats['skipped'], stats['duplicates']), (1, 1, 2))
+        records = self.load_index()
+        self.assertEqual(records['moved.apk']['duplicate_of'], record['apk'])
+        self.assertEqual(records[os.path.basename(record['apk'])], record)
+
+    @mock.patch('pipeline.infer_vectors', side_effect=RuntimeError('inference failed'))
+    def test_stage_error_is_recorded(self, _):
+        _write_fixture_apk(os.path.join(self.apk_dir, 'a.apk'))
+        stats = self.run_pipeline()
+        self.assertEqual(stats['failed_apks'], 1)
+        record = self.load_index()['a.apk']
+        self.assertEqual(record['errors'], ['classes.dex: RuntimeError: inference failed'])
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, record['sha256'], '.done')))
+        # 失败的 apk 再次运行时重试，index.jsonl 中仍然只有一条记录
+        self.run_pipeline()
+        with open(os.path.join(self.output_dir, INDEX_FILE), encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    @mock.patch.object(Supervisor, 'run', side_effect=RuntimeError('supervisor failed'))
+    def test_supervisor_error_stops_pipeline(self, _):
+        # 远多于队列容量的 apk，分析阶段出错后读取线程不能阻塞在已满的队列上
+        for i in range(20):
+            _write_fixture_apk(os.path.join(self.apk_dir, f'{i}.apk'), str(i).encode())
+        errors = []
+
+        def run():
+            try:
+                self.run_pipeline(queue_size=1, io_threads=2)
+            except RuntimeError as e:
+                errors.append(e)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([str(e) for e in errors], ['supervisor failed'])
+
+
+def _blocking_scan(apk_path, output_dir):
+    """代替 scan_apk，直到工作目录中出现 release 文件才结束"""
+    scan_service.mark_started(output_dir)
+    release = os.path.join(os.path.dirname(output_dir), 'release')
+    deadline = time.time() + 30
+    while not os.path.exists(release) and time.time() < deadline:
+        time.sleep(0.01)
+    return []
+
+
+def _wait_for(predicate, timeout=30):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError('等待超时')
+        time.sleep(0.02)
+
+
+class ScanServiceTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.mkdtemp()
+        corpus_path = os.path.join(cls.model_dir, 'corpus.txt')
+        cls.model_path = os.path.join(cls.model_dir, 'ast2vec.model')
+        write_corpus_file((ast_tokens(ast) for ast in dex_to_ast(fixture_path('small'))), corpus_path)
+        train_model(corpus_path, cls.model_path, vector_size=8, epochs=1, workers=1)
+        apk = io.BytesIO()
+        with zipfile.ZipFile(apk, 'w') as z:
+            z.write(fixture_path('small'), 'classes.dex')
+        cls.apk = apk.getvalue()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_dir)
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.service = None
+        self.client = web.app.test_client()
+
+    def tearDown(self):
+        # 放行还在等待的任务
+        with open(os.path.join(self.work_dir, 'release'), 'w'):
+            pass
+        if self.service is not None:
+            self.service.shutdown()
+        shutil.rmtree(self.work_dir)
+
+    def start(self, **kwargs):
+        self.service = scan_service.ScanService(self.work_dir, workers=1, model_path=self.model_path, **kwargs)
+        patcher = mock.patch.object(web, 'scan_service', self.service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, data):
+        return self.client.post('/scan', data={'apk': (io.BytesIO(data), 'a.apk')},
+                                content_type='multipart/form-data')
+
+    def status(self, job_id):
+        return self.client.get(f'/scan/{job_id}').get_json()['status']
+
+    def test_scan_and_poll(self):
+        self.start()
+        response = self.post(self.apk)
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()['job_id']
+        self.assertEqual(response.headers['Location'], f'/scan/{job_id}')
+        _wait_for(lambda: self.status(job_id) in (scan_service.STATUS_DONE, scan_service.STATUS_FAILED))
+
+        response = self.client.get(f'/scan/{job_id}')
+        job = response.get_json()
+        self.assertEqual(job['status'], scan_service.STATUS_DONE, job['error'])
+        dex, = job['result']
+        self.assertEqual(dex['dex'], 'classes')
+        self.assertGreater(dex['methods'], 0)
+        # 返回给客户端的结果不包含服务器上的路径
+        self.assertEqual(dex['features'], 'classes')
+        self.assertNotIn(self.work_dir, response.get_data(as_text=True))
+        self.assertEqual(self.client.get('/scan/missing').status_code, 404)
+
+    @mock.patch.object(scan_service, 'scan_apk', _blocking_scan)
+    def test_queued_and_queue_full(self):
+        self.start(max_pending=2)
+        first = self.post(b'apk a').get_json()
+        _wait_for(lambda: self.status(first['job_id']) == scan_service.STATUS_RUNNING)
+
+        # 只有一个工作进程，第二个任务已经交给进程池，但还在排队
+        second = self.post(b'apk b').get_json()
+        self.assertTrue(second['created'])
+        self.assertEqual(self.status(second['job_id']), scan_service.STATUS_QUEUED)
+
+        response = self.post(b'apk c')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '30')
+
+        with open(os.path.join(self.work_dir, 'release'), 'w'):
+            pass
+        for job in (first, second):
+            _wait_for(lambda: self.status(job['job_id']) == scan_service.STATUS_DONE)
+
+    @mock.patch.object(scan_service, 'scan_apk', _blocking_scan)
+    def test_single_flight(self):
+        self.start()
+        first = self.post(b'apk a').get_json()
+        _wait_for(lambda: self.status(first['job_id']) == scan_service.STATUS_RUNNING)
+
+        # 正在分析的 apk 再次提交得到同一个任务
+        response = self.post(b'apk a')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['job_id'], first['job_id'])
+        self.assertFalse(response.get_json()['created'])
+        self.assertEqual(self.service.attached, 1)
+        self.assertEqual(self.service.stats()['active'], 1)
+
+    @mock.patch.object(scan_service, 'scan_apk', _blocking_scan)
+    def test_result_ttl(self):
+        self.start(result_ttl=60)
+        with open(os.path.join(self.work_dir, 'release'), 'w'):
+            pass
+        job_id = self.post(b'apk a').get_json()['job_id']
+        _wait_for(lambda: self.status(job_id) == scan_service.STATUS_DONE)
+
+        # 有效期内直接返回已有结果
+        response = self.post(b'apk a')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['job_id'], job_id)
+        self.assertEqual(self.service.cache_hits, 1)
+
+        # 结果过期后任务被清理，再次提交重新分析
+        self.service.get(job_id).finished -= 120
+        self.assertEqual(self.client.get(f'/scan/{job_id}').status_code, 404)
+        os.remove(os.path.join(self.work_dir, 'release'))
+        response = self.post(b'apk a')
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.get_json()['created'])
+        self.assertNotEqual(response.get_json()['job_id'], job_id)
+
+
 if __name__ == '__main__':
     unittest.main()